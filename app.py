@@ -1,28 +1,1166 @@
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, render_template, request, jsonify, send_file, Response, g, has_request_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 import os
 import zipfile
 import shutil
 import subprocess
+import json
+import base64
+import mmap
+import threading
+import tempfile
+import time
+import uuid
+import hashlib
+import errno
+import gzip
+import zlib
+import codecs
+import re
+import sys
+import argparse
+import cProfile
+import pstats
+import io
+import hmac
+import struct
+import html
+import bisect
+import heapq
+import math
+import atexit
+import urllib.request
+import urllib.error
+import functools
+from contextlib import contextmanager
+from array import array
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# Optional accelerators: zstd response compression and a faster JSON encoder
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+class FastJSONProvider(DefaultJSONProvider):
+    """JSON provider that encodes with orjson when it is installed and enabled"""
+    
+    def dumps(self, obj, **kwargs):
+        with trace_span('json_encode'):
+            return self.encode(obj, **kwargs)
+    
+    def encode(self, obj, **kwargs):
+        # Flask asks for compact output outside debug mode, which is what orjson writes
+        if orjson is not None and self._app.config.get('JSON_FAST_ENCODER', True) and 'indent' not in kwargs:
+            try:
+                option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_SORT_KEYS if self.sort_keys else 0)
+                return orjson.dumps(obj, default=self.default, option=option).decode('utf-8')
+            except TypeError:
+                pass  # Fall back for types orjson refuses (e.g. integers beyond 64 bits)
+        return super().dumps(obj, **kwargs)
+
 app = Flask(__name__)
+app.json_provider_class = FastJSONProvider
+app.json = FastJSONProvider(app)
 CORS(app)
 
 # Configuration
-UPLOAD_FOLDER = os.path.join(os.path.dirname(__file__), 'projects')
+UPLOAD_FOLDER = os.environ.get('TEXHANDLER_PROJECTS_DIR', os.path.join(os.path.dirname(__file__), 'projects'))
 ALLOWED_EXTENSIONS = {'zip'}
 MAX_CONTENT_LENGTH = 100 * 1024 * 1024  # 100MB
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.bmp', '.svg', '.webp'}
+# Auxiliary files produced by LaTeX builds (PDFs are handled separately)
+AUX_EXTENSIONS = [
+    '.aux', '.log', '.out', '.toc', '.lof', '.lot', '.fls', '.fdb_latexmk',
+    '.synctex.gz', '.bbl', '.blg', '.bcf', '.run.xml', '.nav', '.snm',
+    '.vrb', '.idx', '.ilg', '.ind', '.glo', '.gls', '.glg', '.acn', '.acr',
+    '.alg', '.loa', '.thm', '.figlist', '.makefile', '.xdv', '.dvi'
+]
+# Already-compressed formats that are stored rather than deflated in downloads
+INCOMPRESSIBLE_EXTENSIONS = {
+    '.pdf', '.png', '.jpg', '.jpeg', '.gif', '.webp', '.zip', '.gz', '.tgz',
+    '.bz2', '.xz', '.7z', '.mp3', '.mp4', '.woff', '.woff2'
+}
+ARCHIVE_CACHE_ENABLED = True  # Keep finished download archives keyed by project content
+# Binary assets neither the editor nor a build writes; open_directory may hardlink these.
+# PDFs are left out since compiles rewrite output PDFs in place.
+HARDLINK_EXTENSIONS = IMAGE_EXTENSIONS | {
+    '.eps', '.ps', '.tif', '.tiff', '.ttf', '.otf', '.pfb', '.woff', '.woff2', '.zip', '.gz'
+}
+# Snapshot builds skip build outputs before linking, so included PDFs can be symlinked too
+SNAPSHOT_LINK_EXTENSIONS = HARDLINK_EXTENSIONS | {'.pdf'}
+OPEN_DIRECTORY_MODES = ('auto', 'reflink', 'copy')
+FICLONE = 0x40049409  # Linux ioctl that makes a copy-on-write clone of a file
+# Output of build_assets.py: content-hashed bundles plus a manifest
+ASSET_DIST_FOLDER = os.path.join(os.path.dirname(__file__), 'static', 'dist')
+ASSET_MAX_AGE = 365 * 24 * 3600  # Hashed bundles never change, so cache them for a year
+COMPRESS_MIN_BYTES = 1024  # JSON responses smaller than this are sent uncompressed
+COMPRESS_MIMETYPES = {'application/json', 'application/x-ndjson'}
+STREAM_JSON_MIN_BYTES = 4 * 1024 * 1024  # Text files above this are streamed into the JSON response
+STREAM_JSON_MIN_ITEMS = 5000  # File trees with more entries than this are encoded incrementally
+BULK_MAX_FILES = 500  # Maximum number of paths accepted by the bulk file endpoint
+IO_WORKERS = min(32, (os.cpu_count() or 1) * 4)  # Threads used for parallel file reads
+PAGED_READ_MAX_LINES = 20000  # Upper bound on lines returned by one paged read
+LINE_INDEX_CACHE_SIZE = 64  # Number of line-offset indexes kept in memory
+
+# ZIP import limits (apply to the uploaded archive and all archives nested in it)
+ZIP_MAX_UNCOMPRESSED_BYTES = 2 * 1024 * 1024 * 1024  # 2GB
+ZIP_MAX_ENTRIES = 50000
+ZIP_MAX_COMPRESSION_RATIO = 200  # Checked for members of at least 1MB
+ZIP_MAX_NESTING_DEPTH = 5
+ZIP_PARALLEL_MEMBER_BYTES = 4 * 1024 * 1024  # Members at least this large are extracted on the I/O pool
+
+# Compile backend: 'local' runs pdflatex here, 'remote' ships a content-addressed
+# snapshot of the project to compile_worker.py processes, 'snapshot' builds in a
+# private copy of the sources on a RAM-backed filesystem
+COMPILE_BACKEND = os.environ.get('TEXHANDLER_COMPILE_BACKEND', 'local')
+COMPILE_WORKERS = [url.strip() for url in os.environ.get('TEXHANDLER_COMPILE_WORKERS', '').split(',') if url.strip()]
+COMPILE_WORKER_TIMEOUT = 300  # Seconds to wait for a worker to finish a build
+SNAPSHOT_BUILD_ROOT = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()  # Where snapshot builds run
+WORKER_HEALTH_TTL = 2.0  # Seconds a worker health check result is reused
+DIGEST_CACHE_SIZE = 50000  # Number of file hashes kept for building snapshots
+COMPILE_PROFILES = ('full', 'draft')
+DRAFT_JOB_SUFFIX = '-draft'  # Draft builds write <name>-draft.pdf next to the full build's <name>.pdf
+# Optional deduplication: project files share identical content through
+# hardlinks into a hash-addressed store under projects/.blobs
+BLOB_STORE_ENABLED = os.environ.get('TEXHANDLER_BLOB_STORE', '') == '1'
+BLOB_MIN_BYTES = 8 * 1024  # Smaller files are not worth an extra inode
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
+app.config['ZIP_MAX_UNCOMPRESSED_BYTES'] = ZIP_MAX_UNCOMPRESSED_BYTES
+app.config['ZIP_MAX_ENTRIES'] = ZIP_MAX_ENTRIES
+app.config['ZIP_MAX_COMPRESSION_RATIO'] = ZIP_MAX_COMPRESSION_RATIO
+app.config['ZIP_MAX_NESTING_DEPTH'] = ZIP_MAX_NESTING_DEPTH
+app.config['ARCHIVE_CACHE_ENABLED'] = ARCHIVE_CACHE_ENABLED
+app.config['COMPRESS_MIN_BYTES'] = COMPRESS_MIN_BYTES
+app.config['JSON_FAST_ENCODER'] = True
+app.config['COMPILE_BACKEND'] = COMPILE_BACKEND
+app.config['COMPILE_WORKERS'] = COMPILE_WORKERS
+app.config['SNAPSHOT_BUILD_ROOT'] = SNAPSHOT_BUILD_ROOT
+app.config['BLOB_STORE_ENABLED'] = BLOB_STORE_ENABLED
+app.config['BLOB_MIN_BYTES'] = BLOB_MIN_BYTES
 
 # Ensure upload folder exists
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# Shared thread pool for blocking file I/O (threads are started lazily on first use)
+io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix='texhandler-io')
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def cache_path(*parts):
+    """Path inside the hidden cache directory of the projects folder"""
+    return os.path.join(UPLOAD_FOLDER, '.cache', *parts)
+
+def purge_project_caches(project_name):
+    """Drop everything cached for a project (after it was deleted or renamed)"""
+    cache_root = cache_path()
+    if not os.path.isdir(cache_root):
+        return
+    for kind in os.listdir(cache_root):
+        path = os.path.join(cache_root, kind, project_name)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.isfile(path):
+            os.remove(path)
+    shutil.rmtree(snapshot_build_dir(os.path.join(UPLOAD_FOLDER, project_name)), ignore_errors=True)
+
+# Fallback locks for platforms without fcntl (only serialize within one process)
+project_thread_locks = {}
+project_thread_locks_guard = threading.Lock()
+
+@contextmanager
+def named_lock(name, blocking=True):
+    """Exclusive lock shared by all threads and worker processes, yielding whether it was taken.
+
+    The lock is an flock on a file under .cache/locks. With blocking=False it
+    is only taken when it is free right now.
+    """
+    if fcntl is None:
+        with project_thread_locks_guard:
+            lock = project_thread_locks.setdefault(name, threading.Lock())
+        acquired = lock.acquire(blocking)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                lock.release()
+        return
+    
+    lock_dir = cache_path('locks')
+    os.makedirs(lock_dir, exist_ok=True)
+    with open(os.path.join(lock_dir, name + '.lock'), 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+def project_lock(project_name, blocking=True):
+    """Hold an exclusive lock on a project for the duration of a build-like operation.
+
+    It serializes compiles and cleans across threads and across worker processes.
+    """
+    return named_lock(project_name, blocking)
+
+def serialized_per_project(view):
+    """Decorator that runs a view while holding the project's lock"""
+    @functools.wraps(view)
+    def wrapper(project_name, *args, **kwargs):
+        if not os.path.isdir(os.path.join(UPLOAD_FOLDER, project_name)):
+            return view(project_name, *args, **kwargs)  # Let the view report the 404
+        queued_at = time.perf_counter()
+        with project_lock(project_name):
+            waited = time.perf_counter() - queued_at
+            LOCK_WAIT_SECONDS.observe(waited, operation=view.__name__)
+            record_span('lock_wait', queued_at, waited)
+            return view(project_name, *args, **kwargs)
+    return wrapper
+
+def is_build_artifact(filename):
+    """Whether a file name looks like an auxiliary file written by a LaTeX build"""
+    lower = filename.lower()
+    if lower.endswith('.synctex.gz') or lower.endswith('.synctex') or lower.endswith('.run.xml'):
+        return True
+    if lower.endswith(('-eps-converted-to.pdf', '_svg-tex.pdf', '.pdf_tex')):
+        return True  # Graphics converted for pdflatex
+    return os.path.splitext(lower)[1] in AUX_EXTENSIONS
+
+def is_output_pdf(filename, sibling_files):
+    """Whether a PDF was produced by compiling a .tex file next to it (fully or as a draft)"""
+    stem, ext = os.path.splitext(filename)
+    if stem.endswith(DRAFT_JOB_SUFFIX) and stem[:-len(DRAFT_JOB_SUFFIX)] + '.tex' in sibling_files:
+        return ext.lower() == '.pdf'
+    return ext.lower() == '.pdf' and stem + '.tex' in sibling_files
+
+def file_etag(stat_result):
+    """Build a cheap ETag from a file's mtime and size"""
+    return f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+
+# Line-offset indexes for paged reads, keyed by absolute path and validated by (mtime, size)
+line_index_cache = OrderedDict()
+line_index_lock = threading.Lock()
+
+def build_line_index(full_path, size):
+    """Return an array with the byte offset at which every line of a file starts"""
+    offsets = array('Q', [0])
+    if size == 0:
+        return offsets
+    with open(full_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        pos = mm.find(b'\n')
+        while pos != -1:
+            offsets.append(pos + 1)
+            pos = mm.find(b'\n', pos + 1)
+    return offsets
+
+def get_line_index(full_path, stat_result):
+    """Return the cached line-offset index for a file, rebuilding it when the file changed"""
+    key = os.path.abspath(full_path)
+    version = (stat_result.st_mtime_ns, stat_result.st_size)
+    with line_index_lock:
+        entry = line_index_cache.get(key)
+        if entry and entry[0] == version:
+            line_index_cache.move_to_end(key)
+            cache_lookup('line_index', hit=True)
+            return entry[1]
+    
+    cache_lookup('line_index', hit=False)
+    stored = snapshot_index_payload('lines', full_path, version)
+    if stored is not None:
+        offsets = array('Q')
+        offsets.frombytes(stored)
+    else:
+        offsets = build_line_index(full_path, stat_result.st_size)
+        mark_index_dirty(full_path)
+    with line_index_lock:
+        line_index_cache[key] = (version, offsets)
+        line_index_cache.move_to_end(key)
+        while len(line_index_cache) > LINE_INDEX_CACHE_SIZE:
+            line_index_cache.popitem(last=False)
+    return offsets
+
+def read_line_range(full_path, stat_result, offset, limit):
+    """Read `limit` lines starting at line `offset` (0-based) through a memory map.
+
+    Returns (text, total_lines). Concatenating consecutive pages reproduces the
+    file byte for byte, since every page keeps the newline that ends its last line.
+    """
+    offsets = get_line_index(full_path, stat_result)
+    total_lines = len(offsets)
+    if offset >= total_lines or stat_result.st_size == 0:
+        return '', total_lines
+    
+    start = offsets[offset]
+    end = offsets[offset + limit] if offset + limit < total_lines else stat_result.st_size
+    with open(full_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return mm[start:end].decode('utf-8'), total_lines
+
+# Metrics exposed at /metrics in the Prometheus text format. Each process keeps
+# its own values in memory and periodically writes a snapshot under
+# .cache/metrics, which the process answering /metrics adds up.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+METRICS_FLUSH_INTERVAL = 5.0  # Seconds between snapshot writes of one process
+METRICS_EXITED_FILE = 'exited.json'  # Counters and histograms of processes that have exited
+DISK_USAGE_TTL = 60.0  # Seconds the per-project disk usage is reused between scrapes
+metrics_registry = []
+
+class Metric:
+    kind = None
+    
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}  # Tuple of label values -> value
+        self.lock = threading.Lock()
+        metrics_registry.append(self)
+    
+    def key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+    
+    def snapshot(self):
+        with self.lock:
+            return [[list(key), copy_metric_value(value)] for key, value in self.values.items()]
+
+def copy_metric_value(value):
+    return [list(value[0]), value[1], value[2]] if isinstance(value, list) else value
+
+class Counter(Metric):
+    kind = 'counter'
+    
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+    
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+    
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+    
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+class Histogram(Metric):
+    kind = 'histogram'
+    
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+    
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                # Per-bucket counts (not cumulative; the last one is +Inf), sum, count
+                series = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+    
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+COMPILE_PASS_SECONDS = Histogram('texhandler_compile_pass_seconds',
+                                 'Duration of one pdflatex, bibtex or biber run', ('tool', 'step'))
+COMPILE_SECONDS = Histogram('texhandler_compile_seconds',
+                            'Total compile latency, excluding the wait for the project lock', ('backend', 'outcome'))
+COMPILES_TOTAL = Counter('texhandler_compiles_total',
+                         'Compiles by outcome (success, failure, timeout)', ('backend', 'outcome'))
+COMPILES_IN_FLIGHT = Gauge('texhandler_compiles_in_flight', 'Compiles currently running')
+LOCK_WAIT_SECONDS = Histogram('texhandler_project_lock_wait_seconds',
+                              'Time spent queued for a project lock', ('operation',))
+SYNCTEX_SECONDS = Histogram('texhandler_synctex_resolve_seconds',
+                            'SyncTeX resolve latency', ('direction',))
+HTTP_REQUEST_SECONDS = Histogram('texhandler_http_request_seconds',
+                                 'Time to produce a response (streamed bodies excluded)', ('endpoint', 'method'))
+HTTP_REQUESTS_TOTAL = Counter('texhandler_http_requests_total', 'Requests by status', ('endpoint', 'method', 'status'))
+HTTP_REQUEST_BYTES = Histogram('texhandler_http_request_bytes', 'Request body size', ('endpoint',), SIZE_BUCKETS)
+HTTP_RESPONSE_BYTES = Histogram('texhandler_http_response_bytes',
+                                'Response body size as sent (streamed bodies excluded)', ('endpoint',), SIZE_BUCKETS)
+CACHE_REQUESTS_TOTAL = Counter('texhandler_cache_requests_total', 'Cache lookups by result', ('cache', 'result'))
+PROJECT_DISK_BYTES = Gauge('texhandler_project_disk_bytes', 'Disk space used by each project', ('project',))
+
+def cache_lookup(cache, hit):
+    CACHE_REQUESTS_TOTAL.inc(cache=cache, result='hit' if hit else 'miss')
+
+def observe_duration(histogram, **labels):
+    """Decorator that records how long a view takes in a histogram"""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# Admission control: expensive endpoints belong to a class with a number of
+# requests that run at once and a bounded queue, per process. Queued requests
+# are admitted in priority order, and bulk classes never take the slots kept
+# for interactive ones (saves, SyncTeX). A full queue gets a fast 503 and a
+# client or project over its share a 429, both with Retry-After.
+ADMISSION_CONTROL_ENABLED = os.environ.get('TEXHANDLER_ADMISSION_CONTROL', '1') == '1'
+ADMISSION_CLASSES = {
+    # Class: (requests running at once, requests queued, priority; lower is admitted first)
+    'save': (16, 64, 0),
+    'synctex': (8, 32, 0),
+    'upload': (4, 16, 1),
+    'search': (4, 16, 1),
+    'download': (4, 16, 2),
+    'compile': (os.cpu_count() or 1, 16, 2),
+}
+ADMISSION_MAX_ACTIVE = 32  # Requests of all classes running at once
+ADMISSION_RESERVED_SLOTS = 8  # Of those, only usable by priority 0 classes
+ADMISSION_PER_PROJECT = 4  # Running and queued requests of one class for one project
+ADMISSION_PER_CLIENT = int(os.environ.get('TEXHANDLER_ADMISSION_PER_CLIENT', 8))  # Running and queued requests of one class from one client address; 0: no limit
+ADMISSION_QUEUE_TIMEOUT = 30  # Seconds a request waits for a slot before it gets a 503
+ADMISSION_MAX_RETRY_AFTER = 60  # Seconds
+app.config['ADMISSION_CONTROL_ENABLED'] = ADMISSION_CONTROL_ENABLED
+app.config['ADMISSION_CLASSES'] = ADMISSION_CLASSES
+app.config['ADMISSION_QUEUE_TIMEOUT'] = ADMISSION_QUEUE_TIMEOUT
+app.config['ADMISSION_PER_CLIENT'] = ADMISSION_PER_CLIENT
+
+ADMISSION_WAIT_SECONDS = Histogram('texhandler_admission_wait_seconds',
+                                   'Time admitted requests spent queued for a slot', ('admission_class',))
+ADMISSION_REJECTED_TOTAL = Counter('texhandler_admission_rejected_total',
+                                   'Requests turned away by admission control', ('admission_class', 'reason'))
+ADMISSION_ACTIVE = Gauge('texhandler_admission_active', 'Requests holding an admission slot', ('admission_class',))
+
+class AdmissionController:
+    """Slots and wait queues of the admission classes in this process"""
+    
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.active = {}  # Class -> running requests
+        self.holders = {}  # (class, 'project' or 'client', name) -> running and queued requests
+        self.waiting = []  # Sorted (priority, sequence, class) tickets
+        self.sequence = 0
+        self.service_seconds = {}  # Class -> moving average of how long a request holds its slot
+    
+    def runnable(self, admission_class, limits):
+        concurrency, _, priority = limits[admission_class]
+        total = sum(self.active.values())
+        reserved = 0 if priority == 0 else ADMISSION_RESERVED_SLOTS
+        return self.active.get(admission_class, 0) < concurrency and total < ADMISSION_MAX_ACTIVE - reserved
+    
+    def retry_after(self, admission_class, limits):
+        queued = sum(1 for ticket in self.waiting if ticket[2] == admission_class)
+        seconds = self.service_seconds.get(admission_class, 1.0) * (queued + 1) / limits[admission_class][0]
+        return min(ADMISSION_MAX_RETRY_AFTER, max(1, math.ceil(seconds)))
+    
+    def acquire(self, admission_class, owners, limits, timeout):
+        """Wait for a slot. Returns None once admitted, else (status, reason, Retry-After seconds)."""
+        _, queue_limit, priority = limits[admission_class]
+        with self.condition:
+            for kind, name, limit in owners:
+                if self.holders.get((admission_class, kind, name), 0) >= limit:
+                    return 429, kind, self.retry_after(admission_class, limits)
+            
+            ticket = None
+            if self.waiting or not self.runnable(admission_class, limits):
+                if sum(1 for t in self.waiting if t[2] == admission_class) >= queue_limit:
+                    return 503, 'queue_full', self.retry_after(admission_class, limits)
+                self.sequence += 1
+                ticket = (priority, self.sequence, admission_class)
+                bisect.insort(self.waiting, ticket)
+            for kind, name, _ in owners:
+                key = (admission_class, kind, name)
+                self.holders[key] = self.holders.get(key, 0) + 1
+            
+            if ticket is not None:
+                deadline = time.monotonic() + timeout
+                # The first ticket whose class has a free slot goes next
+                while next((t for t in self.waiting if self.runnable(t[2], limits)), None) != ticket:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.waiting.remove(ticket)
+                        self.forget(admission_class, owners)
+                        self.condition.notify_all()
+                        return 503, 'timeout', self.retry_after(admission_class, limits)
+                    self.condition.wait(remaining)
+                self.waiting.remove(ticket)
+            self.active[admission_class] = self.active.get(admission_class, 0) + 1
+        ADMISSION_ACTIVE.inc(admission_class=admission_class)
+        return None
+    
+    def forget(self, admission_class, owners):
+        for kind, name, _ in owners:
+            key = (admission_class, kind, name)
+            self.holders[key] -= 1
+            if not self.holders[key]:
+                del self.holders[key]
+    
+    def release(self, admission_class, owners, held_seconds):
+        with self.condition:
+            self.active[admission_class] -= 1
+            self.forget(admission_class, owners)
+            average = self.service_seconds.get(admission_class, held_seconds)
+            self.service_seconds[admission_class] = 0.8 * average + 0.2 * held_seconds
+            self.condition.notify_all()
+        ADMISSION_ACTIVE.dec(admission_class=admission_class)
+
+admission_controller = AdmissionController()
+
+def admission_controlled(admission_class):
+    """Decorator that runs a view once its admission class has a free slot.
+
+    The slot is held until the response is closed, so streamed downloads count
+    until the last byte is sent.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if not app.config.get('ADMISSION_CONTROL_ENABLED', ADMISSION_CONTROL_ENABLED):
+                return view(*args, **kwargs)
+            owners = []
+            per_client = app.config.get('ADMISSION_PER_CLIENT', ADMISSION_PER_CLIENT)
+            if per_client:
+                owners.append(('client', request.remote_addr or '', per_client))
+            if kwargs.get('project_name'):
+                owners.append(('project', kwargs['project_name'], ADMISSION_PER_PROJECT))
+            
+            queued_at = time.perf_counter()
+            rejected = admission_controller.acquire(admission_class, owners, app.config.get('ADMISSION_CLASSES', ADMISSION_CLASSES),
+                                                    app.config.get('ADMISSION_QUEUE_TIMEOUT', ADMISSION_QUEUE_TIMEOUT))
+            if rejected is not None:
+                status, reason, retry_after = rejected
+                ADMISSION_REJECTED_TOTAL.inc(admission_class=admission_class, reason=reason)
+                if status == 429:
+                    error = f'Too many {admission_class} requests for this {reason}, retry later'
+                else:
+                    error = f'Server busy with {admission_class} requests, retry later'
+                response = jsonify({'error': error})
+                response.status_code = status
+                response.headers['Retry-After'] = str(retry_after)
+                return response
+            
+            admitted_at = time.perf_counter()
+            ADMISSION_WAIT_SECONDS.observe(admitted_at - queued_at, admission_class=admission_class)
+            record_span('admission_wait', queued_at, admitted_at - queued_at)
+            
+            def release():
+                admission_controller.release(admission_class, owners, time.perf_counter() - admitted_at)
+            try:
+                response = app.make_response(view(*args, **kwargs))
+            except BaseException:
+                release()
+                raise
+            if response.direct_passthrough and hasattr(response.response, 'close'):
+                # send_file: the server gets the file wrapper itself and only closes that
+                close_file = response.response.close
+                
+                def close():
+                    try:
+                        close_file()
+                    finally:
+                        release()
+                response.response.close = close
+            elif response.is_streamed:
+                response.direct_passthrough = False  # So the response's own close runs
+                response.call_on_close(release)
+            else:
+                release()
+            return response
+        return wrapper
+    return decorator
+
+def metrics_snapshot():
+    return {
+        metric.name: {'kind': metric.kind, 'series': metric.snapshot()}
+        for metric in metrics_registry if metric is not PROJECT_DISK_BYTES
+    }
+
+# Exit handlers only act in the process that imported this copy of the module
+loaded_in_pid = os.getpid()
+metrics_flush_state = {'flushed_at': 0.0, 'pid': None}
+metrics_flush_lock = threading.Lock()
+
+def flush_metrics(force=False, create=True):
+    """Write this process's metrics to its snapshot file, at most every METRICS_FLUSH_INTERVAL.
+
+    With create=False nothing is written unless the metrics directory exists.
+    """
+    now = time.monotonic()
+    if not force and now - metrics_flush_state['flushed_at'] < METRICS_FLUSH_INTERVAL:
+        return
+    metrics_dir = cache_path('metrics')
+    if not create and not os.path.isdir(metrics_dir):
+        return
+    metrics_flush_state['flushed_at'] = now
+    try:
+        os.makedirs(metrics_dir, exist_ok=True)
+        atomic_write_text(os.path.join(metrics_dir, f'{os.getpid()}.json'), json.dumps(metrics_snapshot()))
+    except OSError:
+        pass  # Metrics must never break a request
+
+def metrics_flush_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        flush_metrics(force=True, create=False)
+
+def start_metrics_flusher():
+    """Keep this process's snapshot fresh while it is idle (once per process, also after a fork)"""
+    if metrics_flush_state['pid'] == os.getpid():
+        return
+    with metrics_flush_lock:
+        if metrics_flush_state['pid'] != os.getpid():
+            metrics_flush_state['pid'] = os.getpid()
+            threading.Thread(target=metrics_flush_loop, name='texhandler-metrics', daemon=True).start()
+
+def flush_metrics_at_exit():
+    if os.getpid() == loaded_in_pid:  # Not the master's copy inherited by a forked worker
+        flush_metrics(force=True, create=False)
+
+atexit.register(flush_metrics_at_exit)
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True  # Exists, but belongs to another user
+    return True
+
+def merge_metric_series(total, series):
+    for labels, value in series:
+        key = tuple(labels)
+        current = total.get(key)
+        if current is None:
+            total[key] = copy_metric_value(value)
+        elif isinstance(value, list):
+            current[0] = [a + b for a, b in zip(current[0], value[0])]
+            current[1] += value[1]
+            current[2] += value[2]
+        else:
+            total[key] = current + value
+
+def retire_metrics_snapshot(metrics_dir, path):
+    """Fold an exited process's counters and histograms into METRICS_EXITED_FILE and delete its snapshot.
+
+    Keeping them stops the summed counters from going down, which Prometheus
+    would read as a counter reset. Gauges of an exited process are dropped.
+    """
+    exited_path = os.path.join(metrics_dir, METRICS_EXITED_FILE)
+    with named_lock('metrics'):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return  # Another process retired it first
+        except ValueError:
+            snapshot = {}
+        try:
+            with open(exited_path, 'r', encoding='utf-8') as f:
+                exited = json.load(f)
+        except (OSError, ValueError):
+            exited = {}
+        for name, data in snapshot.items():
+            if data['kind'] == 'gauge':
+                continue
+            total = {tuple(labels): value for labels, value in exited.get(name, {}).get('series', [])}
+            merge_metric_series(total, data['series'])
+            exited[name] = {'kind': data['kind'], 'series': [[list(labels), value] for labels, value in total.items()]}
+        atomic_write_text(exited_path, json.dumps(exited))
+        os.remove(path)
+
+def collect_metrics():
+    """Values of every metric summed over all live processes and the retired ones: name -> {labels: value}"""
+    merged = {metric.name: {} for metric in metrics_registry}
+    snapshots = [metrics_snapshot()]
+    metrics_dir = cache_path('metrics')
+    if os.path.isdir(metrics_dir):
+        for name in os.listdir(metrics_dir):
+            path = os.path.join(metrics_dir, name)
+            pid = name[:-len('.json')]
+            if not name.endswith('.json') or not pid.isdigit() or int(pid) == os.getpid():
+                continue
+            try:
+                if not process_alive(int(pid)):
+                    retire_metrics_snapshot(metrics_dir, path)
+                    continue
+                with open(path, 'r', encoding='utf-8') as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        try:
+            with open(os.path.join(metrics_dir, METRICS_EXITED_FILE), 'r', encoding='utf-8') as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            pass
+    for snapshot in snapshots:
+        for name, data in snapshot.items():
+            if name in merged:
+                merge_metric_series(merged[name], data['series'])
+    return merged
+
+disk_usage_state = {'folder': None, 'measured_at': 0.0, 'usage': {}}
+
+def project_disk_usage():
+    """Bytes allocated by each project, re-measured at most every DISK_USAGE_TTL seconds"""
+    now = time.monotonic()
+    if disk_usage_state['folder'] == UPLOAD_FOLDER and now - disk_usage_state['measured_at'] < DISK_USAGE_TTL:
+        return disk_usage_state['usage']
+    usage = {}
+    for project_name in os.listdir(UPLOAD_FOLDER):
+        project_path = os.path.join(UPLOAD_FOLDER, project_name)
+        if project_name.startswith('.') or not os.path.isdir(project_path):
+            continue
+        total = 0
+        for root, dirs, files in os.walk(project_path):
+            for file in files:
+                try:
+                    stat_result = os.lstat(os.path.join(root, file))
+                except OSError:
+                    continue
+                blocks = getattr(stat_result, 'st_blocks', None)
+                total += blocks * 512 if blocks is not None else stat_result.st_size
+        usage[project_name] = total
+    disk_usage_state.update(folder=UPLOAD_FOLDER, measured_at=now, usage=usage)
+    return usage
+
+def format_label_value(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values, extra=None):
+    pairs = [f'{name}="{format_label_value(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def render_metrics(merged):
+    """Render metric values in the Prometheus text exposition format"""
+    lines = []
+    for metric in metrics_registry:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for key, value in sorted(merged[metric.name].items()):
+            if metric.kind != 'histogram':
+                lines.append(f'{metric.name}{format_labels(metric.labelnames, key)} {value}')
+                continue
+            counts, total, count = value
+            cumulative = 0
+            for bound, bucket_count in zip(metric.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                labels = format_labels(metric.labelnames, key, f'le="{le}"')
+                lines.append(f'{metric.name}_bucket{labels} {cumulative}')
+            lines.append(f'{metric.name}_sum{format_labels(metric.labelnames, key)} {total}')
+            lines.append(f'{metric.name}_count{format_labels(metric.labelnames, key)} {count}')
+    return '\n'.join(lines) + '\n'
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    """Record latency and sizes per endpoint (runs after compression, so sizes are as sent)"""
+    started = g.get('request_started')
+    if started is None:
+        return response
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint, method=request.method)
+    HTTP_REQUESTS_TOTAL.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    if request.content_length:
+        HTTP_REQUEST_BYTES.observe(request.content_length, endpoint=endpoint)
+    if not response.is_streamed and not response.direct_passthrough:
+        HTTP_RESPONSE_BYTES.observe(response.calculate_content_length() or 0, endpoint=endpoint)
+    start_metrics_flusher()
+    flush_metrics()
+    return response
+
+@app.route('/metrics')
+def metrics():
+    merged = collect_metrics()
+    merged[PROJECT_DISK_BYTES.name] = {(name,): size for name, size in project_disk_usage().items()}
+    return Response(render_metrics(merged), mimetype='text/plain; version=0.0.4')
+
+# Request tracing: handlers wrap filesystem walks, file reads, subprocesses and
+# serialization in trace_span(); the spans are summed into a Server-Timing
+# header and, when TRACE_LOG is set, appended to it as one JSON line per request
+TRACING_ENABLED = True
+TRACE_LOG = os.environ.get('TEXHANDLER_TRACE_LOG')  # Path of a JSON-lines trace file, or None
+ADMIN_TOKEN = os.environ.get('TEXHANDLER_ADMIN_TOKEN')  # Enables admin-only features when set
+PROFILE_SAMPLE_INTERVAL = 0.005  # Seconds between stack samples of the sampling profiler
+app.config['TRACING_ENABLED'] = TRACING_ENABLED
+app.config['TRACE_LOG'] = TRACE_LOG
+app.config['ADMIN_TOKEN'] = ADMIN_TOKEN
+trace_log_lock = threading.Lock()
+
+def record_span(name, start, duration):
+    """Add a span (start given as a perf_counter value) to the current request's trace"""
+    spans = g.get('trace_spans') if has_request_context() else None
+    if spans is not None:
+        spans.append((name, start - g.request_started, duration))
+
+@contextmanager
+def trace_span(name):
+    """Record how long the enclosed block takes as a span of the current request"""
+    if not has_request_context() or g.get('trace_spans') is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, start, time.perf_counter() - start)
+
+def server_timing_header(spans, total):
+    """Sum spans by name into a Server-Timing value (durations in milliseconds)"""
+    totals = OrderedDict()
+    for name, _, duration in spans:
+        spent, count = totals.get(name, (0.0, 0))
+        totals[name] = (spent + duration, count + 1)
+    entries = []
+    for name, (spent, count) in totals.items():
+        entry = f'{name};dur={spent * 1000:.1f}'
+        if count > 1:
+            entry += f';desc="{count}x"'
+        entries.append(entry)
+    entries.append(f'total;dur={total * 1000:.1f}')
+    return ', '.join(entries)
+
+def is_admin_request():
+    token = app.config.get('ADMIN_TOKEN', ADMIN_TOKEN)
+    return bool(token) and hmac.compare_digest(request.headers.get('X-Admin-Token', ''), token)
+
+def require_admin(view):
+    """Decorator for admin-only views: needs an X-Admin-Token header matching ADMIN_TOKEN"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not is_admin_request():
+            return jsonify({'error': 'Admin token required'}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+class SamplingProfiler:
+    """Sample the stack of one thread at a fixed interval and count identical stacks"""
+    
+    def __init__(self, thread_id, interval=PROFILE_SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='texhandler-sampler', daemon=True)
+    
+    def start(self):
+        self.thread.start()
+    
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                frame = frame.f_back
+            if stack:
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+    
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+    
+    def folded(self):
+        """Stacks in the folded format read by flamegraph tools"""
+        return ''.join(f'{stack} {count}\n' for stack, count in sorted(self.stacks.items()))
+
+@app.before_request
+def start_request_trace():
+    if app.config.get('TRACING_ENABLED', TRACING_ENABLED):
+        g.trace_spans = []
+    
+    # Admins can profile a single request with an X-Profile header
+    mode = request.headers.get('X-Profile')
+    if mode in ('cprofile', 'sample') and is_admin_request():
+        if mode == 'cprofile':
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+        else:
+            g.profiler = SamplingProfiler(threading.get_ident())
+            g.profiler.start()
+
+def save_profile(profiler):
+    """Store a finished profile under .cache/profiles and return its id"""
+    profile_id = time.strftime('%Y%m%d-%H%M%S') + '-' + uuid.uuid4().hex[:8]
+    profile_dir = cache_path('profiles')
+    os.makedirs(profile_dir, exist_ok=True)
+    if isinstance(profiler, SamplingProfiler):
+        atomic_write_text(os.path.join(profile_dir, profile_id + '.folded'), profiler.folded())
+    else:
+        profiler.dump_stats(os.path.join(profile_dir, profile_id + '.prof'))
+    return profile_id
+
+@app.after_request
+def finish_request_trace(response):
+    """Attach the Server-Timing header, write the trace log and store a requested profile"""
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        if isinstance(profiler, SamplingProfiler):
+            profiler.stop()
+        else:
+            profiler.disable()
+        response.headers['X-Profile-Id'] = save_profile(profiler)
+    
+    spans = g.get('trace_spans')
+    if spans is None:
+        return response
+    total = time.perf_counter() - g.request_started
+    response.headers['Server-Timing'] = server_timing_header(spans, total)
+    
+    trace_log = app.config.get('TRACE_LOG', TRACE_LOG)
+    if trace_log:
+        record = {
+            'time': time.time(),
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'duration_ms': round(total * 1000, 3),
+            'spans': [
+                {'name': name, 'start_ms': round(start * 1000, 3), 'duration_ms': round(duration * 1000, 3)}
+                for name, start, duration in spans
+            ],
+        }
+        try:
+            with trace_log_lock, open(trace_log, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record) + '\n')
+        except OSError:
+            pass
+    return response
+
+@app.route('/api/admin/profiles')
+@require_admin
+def list_profiles():
+    profile_dir = cache_path('profiles')
+    names = sorted(os.listdir(profile_dir), reverse=True) if os.path.isdir(profile_dir) else []
+    return jsonify({'profiles': [
+        {'id': os.path.splitext(name)[0], 'type': 'sample' if name.endswith('.folded') else 'cprofile'}
+        for name in names if name.endswith(('.prof', '.folded'))
+    ]})
+
+@app.route('/api/admin/profiles/<profile_id>')
+@require_admin
+def get_profile(profile_id):
+    """Return a stored profile: pstats text (or the raw file with ?download=1) or folded stacks"""
+    if not re.fullmatch(r'[\w-]+', profile_id):
+        return jsonify({'error': 'Invalid profile id'}), 400
+    folded_path = cache_path('profiles', profile_id + '.folded')
+    prof_path = cache_path('profiles', profile_id + '.prof')
+    if os.path.exists(folded_path):
+        return send_file(folded_path, mimetype='text/plain')
+    if not os.path.exists(prof_path):
+        return jsonify({'error': 'Profile not found'}), 404
+    if request.args.get('download') == '1':
+        return send_file(prof_path, mimetype='application/octet-stream', as_attachment=True,
+                         download_name=profile_id + '.prof')
+    sort = request.args.get('sort', 'cumulative')
+    if sort not in pstats.Stats.sort_arg_dict_default:
+        return jsonify({'error': f'Unknown sort key: {sort}'}), 400
+    output = io.StringIO()
+    pstats.Stats(prof_path, stream=output).sort_stats(sort).print_stats(50)
+    return Response(output.getvalue(), mimetype='text/plain')
+
+def accepted_encodings(accept_encoding):
+    """Parse an Accept-Encoding header into {coding: quality}"""
+    accepted = {}
+    for part in accept_encoding.split(','):
+        name, _, params = part.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            accepted[name.strip().lower()] = quality
+    return accepted
+
+def negotiate_encoding(accept_encoding):
+    """Pick the response compression from an Accept-Encoding header (None for identity)"""
+    accepted = accepted_encodings(accept_encoding)
+    if zstandard is not None and accepted.get('zstd', 0) > 0:
+        return 'zstd'
+    if accepted.get('gzip', 0) > 0:
+        return 'gzip'
+    return None
+
+def compress_stream(chunks, encoding):
+    """Compress an iterable of chunks incrementally, flushing after each one"""
+    if encoding == 'zstd':
+        compressor = zstandard.ZstdCompressor(level=3).compressobj()
+        flush_mode = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+    else:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 writes a gzip header
+        flush_mode = zlib.Z_SYNC_FLUSH
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        data = compressor.compress(chunk) + compressor.flush(flush_mode)
+        if data:
+            yield data
+    yield compressor.flush()
+
+@app.after_request
+def compress_response(response):
+    """Compress JSON and NDJSON responses for clients that accept it"""
+    if (response.status_code < 200 or response.status_code in (204, 304)
+            or response.mimetype not in COMPRESS_MIMETYPES
+            or 'Content-Encoding' in response.headers
+            or response.direct_passthrough):
+        return response
+    
+    encoding = negotiate_encoding(request.headers.get('Accept-Encoding', ''))
+    response.vary.add('Accept-Encoding')
+    if encoding is None:
+        return response
+    
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < app.config.get('COMPRESS_MIN_BYTES', COMPRESS_MIN_BYTES):
+            return response
+        if encoding == 'zstd':
+            data = zstandard.ZstdCompressor(level=3).compress(data)
+        else:
+            data = gzip.compress(data, compresslevel=6)
+        response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+def stream_json_response(obj):
+    """Encode obj incrementally instead of building the whole JSON document in memory"""
+    encoder = json.JSONEncoder(sort_keys=True, separators=(',', ':'))
+    
+    def generate():
+        buffer = []
+        size = 0
+        for piece in encoder.iterencode(obj):
+            buffer.append(piece)
+            size += len(piece)
+            if size >= 64 * 1024:
+                yield ''.join(buffer)
+                buffer = []
+                size = 0
+        if buffer:
+            yield ''.join(buffer)
+    
+    return Response(generate(), mimetype='application/json')
+
+def is_utf8_file(full_path):
+    """Check in constant memory that a file decodes as UTF-8"""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        with open(full_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                decoder.decode(chunk)
+        decoder.decode(b'', final=True)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+def stream_text_file_response(full_path, file_path, etag):
+    """Send {"content": ..., "path": ..., "type": "text"} with the content streamed from disk"""
+    def generate():
+        yield '{"content":"'
+        with open(full_path, 'r', encoding='utf-8') as f:
+            for chunk in iter(lambda: f.read(256 * 1024), ''):
+                # json.dumps escapes the chunk; strip the surrounding quotes
+                yield json.dumps(chunk)[1:-1]
+        yield '","path":' + json.dumps(file_path) + ',"type":"text"}'
+    
+    response = Response(generate(), mimetype='application/json')
+    response.headers['ETag'] = etag
+    return response
+
+# Asset manifest from build_assets.py, reloaded when the file changes
+asset_manifest_cache = {'version': None, 'manifest': {}}
+
+def load_asset_manifest():
+    manifest_path = os.path.join(ASSET_DIST_FOLDER, 'manifest.json')
+    try:
+        mtime = os.path.getmtime(manifest_path)
+    except OSError:
+        return {}
+    if asset_manifest_cache['version'] != (manifest_path, mtime):
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+        asset_manifest_cache.update(version=(manifest_path, mtime), manifest=manifest)
+    return asset_manifest_cache['manifest']
+
+@app.context_processor
+def inject_asset_url():
+    def asset_url(name):
+        """URL of a built bundle, or None when the assets have not been built"""
+        hashed_name = load_asset_manifest().get(name)
+        return f'/assets/{hashed_name}' if hashed_name else None
+    return {'asset_url': asset_url}
+
+@app.route('/assets/<path:filename>')
+def serve_asset(filename):
+    """Serve a fingerprinted bundle, preferring a precompressed variant"""
+    if filename not in load_asset_manifest().values():
+        return jsonify({'error': 'Asset not found'}), 404
+    
+    full_path = os.path.join(ASSET_DIST_FOLDER, filename)
+    mimetype = 'text/css' if filename.endswith('.css') else 'application/javascript'
+    accepted = accepted_encodings(request.headers.get('Accept-Encoding', ''))
+    
+    encoding = None
+    for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if accepted.get(candidate, 0) > 0 and os.path.exists(full_path + suffix):
+            encoding = candidate
+            full_path += suffix
+            break
+    
+    response = send_file(full_path, mimetype=mimetype, max_age=ASSET_MAX_AGE, conditional=True)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = f'public, max-age={ASSET_MAX_AGE}, immutable'
+    return response
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -41,7 +1179,173 @@ def project_page(project_name):
 def favicon():
     return '', 204  # No content
 
+class ZipLimitError(Exception):
+    """Raised when an archive exceeds one of the configured import limits"""
+
+# Progress of running ZIP imports, keyed by the client-supplied upload id. It is
+# written to files under the cache directory so that whichever worker process
+# receives a progress poll can answer it.
+IMPORT_PROGRESS_TTL = 300  # Seconds a finished import stays queryable
+IMPORT_PROGRESS_INTERVAL = 0.5  # Minimum seconds between two writes of byte counts
+import_progress = {}  # Imports running in this process: upload_id -> {'fields', 'written_at'}
+import_progress_lock = threading.Lock()
+
+def valid_upload_id(upload_id):
+    return bool(upload_id) and re.fullmatch(r'[A-Za-z0-9_-]{1,64}', upload_id) is not None
+
+def update_import_progress(upload_id, **fields):
+    if not upload_id:
+        return
+    with import_progress_lock:
+        entry = import_progress.setdefault(upload_id, {'fields': {}, 'written_at': 0})
+        entry['fields'].update(fields)
+        now = time.time()
+        # State changes are always written, byte counts at most every interval
+        if 'state' not in fields and now - entry['written_at'] < IMPORT_PROGRESS_INTERVAL:
+            return
+        entry['written_at'] = now
+        progress = dict(entry['fields'])
+        if 'finished_at' in fields:
+            del import_progress[upload_id]
+    
+    progress_dir = cache_path('imports')
+    os.makedirs(progress_dir, exist_ok=True)
+    atomic_write_text(os.path.join(progress_dir, upload_id + '.json'), json.dumps(progress))
+    
+    if 'finished_at' in fields:
+        # Drop finished imports nobody asked about for a while
+        for name in os.listdir(progress_dir):
+            path = os.path.join(progress_dir, name)
+            try:
+                if os.path.getmtime(path) < now - IMPORT_PROGRESS_TTL:
+                    os.remove(path)
+            except OSError:
+                pass
+
+def read_import_progress(upload_id):
+    try:
+        with open(cache_path('imports', upload_id + '.json'), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def safe_member_path(target_dir, member_name):
+    """Map an archive member name to a path inside target_dir (like ZipFile.extract)"""
+    parts = [p for p in member_name.replace('\\', '/').split('/') if p not in ('', '.', '..')]
+    if not parts:
+        return None
+    return os.path.join(target_dir, *parts)
+
+class ZipImporter:
+    """Extract an archive and every archive nested in it in a single pass.
+
+    Nested archives are put on a work queue as they are extracted instead of
+    re-walking the tree. Entry count, uncompressed bytes and compression ratio
+    are checked against the limits before anything is written, and the bytes
+    actually written are counted as well so a member that lies about its size
+    is caught too. Large members are extracted in parallel on the I/O pool.
+    """
+    
+    def __init__(self, upload_id=None):
+        self.upload_id = upload_id
+        self.max_bytes = app.config.get('ZIP_MAX_UNCOMPRESSED_BYTES', ZIP_MAX_UNCOMPRESSED_BYTES)
+        self.max_entries = app.config.get('ZIP_MAX_ENTRIES', ZIP_MAX_ENTRIES)
+        self.max_ratio = app.config.get('ZIP_MAX_COMPRESSION_RATIO', ZIP_MAX_COMPRESSION_RATIO)
+        self.max_depth = app.config.get('ZIP_MAX_NESTING_DEPTH', ZIP_MAX_NESTING_DEPTH)
+        self.declared_bytes = 0
+        self.written_bytes = 0
+        self.entries = 0
+        self.archives = 0
+        self.warnings = []
+        self.lock = threading.Lock()
+    
+    def run(self, archive, target_dir):
+        """Extract `archive` (a path or seekable file object) into target_dir"""
+        queue = deque([(archive, target_dir, 0)])
+        while queue:
+            source, extract_dir, depth = queue.popleft()
+            try:
+                nested = self.extract_archive(source, extract_dir)
+            except (zipfile.BadZipFile, OSError) as e:
+                if depth == 0:
+                    raise
+                print(f"Warning: Could not extract nested zip {source}: {e}")
+                self.warnings.append(f'Could not extract nested zip {os.path.basename(source)}: {e}')
+                continue
+            if depth > 0:
+                os.remove(source)  # Remove nested zip after extraction
+            for nested_path in nested:
+                if depth + 1 > self.max_depth:
+                    self.warnings.append(f'Skipped {os.path.basename(nested_path)}: archives nested too deeply')
+                    continue
+                queue.append((nested_path, os.path.dirname(nested_path), depth + 1))
+        update_import_progress(self.upload_id, state='done', finished_at=time.time())
+    
+    def check_limits(self, members):
+        """Validate the central directory of one archive against the remaining budget"""
+        self.entries += len(members)
+        if self.entries > self.max_entries:
+            raise ZipLimitError(f'Archive has too many entries (limit is {self.max_entries})')
+        for member in members:
+            if member.file_size >= 1024 * 1024 and member.file_size > member.compress_size * self.max_ratio:
+                raise ZipLimitError(f'Suspicious compression ratio for {member.filename}')
+            self.declared_bytes += member.file_size
+        if self.declared_bytes > self.max_bytes:
+            raise ZipLimitError(f'Archive is too large when extracted (limit is {self.max_bytes} bytes)')
+    
+    def extract_archive(self, source, extract_dir):
+        """Extract one archive and return the paths of the archives found inside it"""
+        nested = []
+        with zipfile.ZipFile(source, 'r') as zip_ref:
+            members = [m for m in zip_ref.infolist() if not m.is_dir()]
+            self.check_limits(members)
+            self.archives += 1
+            update_import_progress(self.upload_id, state='extracting', archives=self.archives,
+                                   entries_total=self.entries, bytes_total=self.declared_bytes)
+            
+            for member in zip_ref.infolist():
+                if member.is_dir():
+                    target = safe_member_path(extract_dir, member.filename)
+                    if target:
+                        os.makedirs(target, exist_ok=True)
+            
+            futures = []
+            for member in members:
+                target = safe_member_path(extract_dir, member.filename)
+                if not target:
+                    continue
+                if member.file_size >= ZIP_PARALLEL_MEMBER_BYTES:
+                    futures.append(io_executor.submit(self.extract_member, zip_ref, member, target))
+                else:
+                    self.extract_member(zip_ref, member, target)
+                if target.lower().endswith('.zip'):
+                    nested.append(target)
+            # Surface the first failure from the parallel extractions
+            for future in futures:
+                future.result()
+        return nested
+    
+    def extract_member(self, zip_ref, member, target):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        written = 0
+        with zip_ref.open(member) as src, open(target, 'wb') as dst:
+            while True:
+                chunk = src.read(1024 * 1024)
+                if not chunk:
+                    break
+                written += len(chunk)
+                if written > member.file_size:
+                    raise ZipLimitError(f'{member.filename} is larger than its header claims')
+                dst.write(chunk)
+                with self.lock:
+                    self.written_bytes += len(chunk)
+                    if self.written_bytes > self.max_bytes:
+                        raise ZipLimitError(f'Archive is too large when extracted (limit is {self.max_bytes} bytes)')
+        with self.lock:
+            update_import_progress(self.upload_id, bytes_done=self.written_bytes)
+
 @app.route('/api/upload', methods=['POST'])
+@admission_controlled('upload')
 def upload_file():
     if 'file' not in request.files:
         return jsonify({'error': 'No file part'}), 400
@@ -54,95 +1358,289 @@ def upload_file():
         # Create a project directory
         project_name = os.path.splitext(file.filename)[0]
         project_path = os.path.join(UPLOAD_FOLDER, project_name)
+        upload_id = request.form.get('upload_id')
+        if not valid_upload_id(upload_id):
+            upload_id = uuid.uuid4().hex
+        update_import_progress(upload_id, state='receiving', project_name=project_name)
         
-        # Remove existing project if it exists
-        if os.path.exists(project_path):
-            shutil.rmtree(project_path)
-        
-        os.makedirs(project_path, exist_ok=True)
-        
-        # Save zip file
-        zip_path = os.path.join(project_path, file.filename)
-        file.save(zip_path)
-        
-        # Extract zip file
+        # Extract into a hidden staging directory so a failed import leaves any
+        # existing project untouched
+        staging_path = tempfile.mkdtemp(prefix='.import-', dir=UPLOAD_FOLDER)
         try:
-            with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                zip_ref.extractall(project_path)
-            os.remove(zip_path)  # Remove zip after extraction
-            
-            # Handle nested zip files
-            def extract_nested_zips(directory):
-                for root, dirs, files in os.walk(directory):
-                    for file in files:
-                        if file.endswith('.zip'):
-                            nested_zip_path = os.path.join(root, file)
-                            try:
-                                with zipfile.ZipFile(nested_zip_path, 'r') as nested_zip:
-                                    # Extract to the same directory as the zip
-                                    extract_dir = os.path.dirname(nested_zip_path)
-                                    nested_zip.extractall(extract_dir)
-                                os.remove(nested_zip_path)  # Remove nested zip after extraction
-                                # Recursively check for more nested zips
-                                extract_nested_zips(extract_dir)
-                            except Exception as e:
-                                print(f"Warning: Could not extract nested zip {nested_zip_path}: {e}")
+            # Read the archive straight from the request's spooled upload
+            importer = ZipImporter(upload_id)
+            importer.run(file.stream, staging_path)
+            dedup = intern_tree(staging_path) if blob_store_enabled() else None
             
-            extract_nested_zips(project_path)
+            # Replace existing project if it exists
+            replaced = os.path.exists(project_path)
+            if replaced:
+                shutil.rmtree(project_path)
+            os.rename(staging_path, project_path)
+            if replaced and dedup is not None:
+                io_executor.submit(collect_blob_garbage)
             
             return jsonify({
                 'success': True,
                 'project_name': project_name,
+                'upload_id': upload_id,
+                'warnings': importer.warnings or None,
+                'dedup': dedup,
                 'message': 'File uploaded and extracted successfully'
             })
+        except ZipLimitError as e:
+            update_import_progress(upload_id, state='failed', error=str(e), finished_at=time.time())
+            return jsonify({'error': f'Archive rejected: {str(e)}'}), 400
         except Exception as e:
+            update_import_progress(upload_id, state='failed', error=str(e), finished_at=time.time())
             return jsonify({'error': f'Failed to extract zip: {str(e)}'}), 500
+        finally:
+            if os.path.exists(staging_path):
+                shutil.rmtree(staging_path, ignore_errors=True)
     
     return jsonify({'error': 'Invalid file type'}), 400
 
+@app.route('/api/upload/progress/<upload_id>')
+def upload_progress(upload_id):
+    """Report the progress of a running ZIP import"""
+    progress = read_import_progress(upload_id) if valid_upload_id(upload_id) else None
+    if progress is None:
+        return jsonify({'error': 'Unknown upload'}), 404
+    return jsonify(progress)
+
+def atomic_replace(target, write):
+    """Create target by calling write(tmp_path) and renaming the result into place.
+
+    Readers never see a half-written file, and a target that is a hardlink is
+    replaced rather than modified, so the other links keep their content.
+    """
+    directory = os.path.dirname(target) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(target) + '.', suffix='.tmp')
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, target)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def atomic_write_text(target, content):
+    def write(tmp_path):
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+    atomic_replace(target, write)
+
+def reflink_file(src, dst):
+    """Clone src to dst sharing extents (btrfs, XFS, ...); raises OSError if unsupported"""
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, 'Reflinks are not supported on this platform')
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+    shutil.copystat(src, dst)
+
+def place_file(src, dst, mode):
+    """Materialize src at dst and return how it was done ('cloned', 'linked' or 'copied')"""
+    method = []
+    
+    def write(tmp_path):
+        if mode in ('auto', 'reflink'):
+            try:
+                reflink_file(src, tmp_path)
+                method.append('cloned')
+                return
+            except OSError:
+                pass
+        name = os.path.basename(src)
+        if mode == 'auto' and os.path.splitext(name)[1].lower() in HARDLINK_EXTENSIONS \
+                and not is_build_artifact(name):
+            try:
+                os.remove(tmp_path)
+                os.link(src, tmp_path)
+                method.append('linked')
+                return
+            except OSError:
+                pass
+        shutil.copy2(src, tmp_path)
+        method.append('copied')
+    
+    atomic_replace(dst, write)
+    return method[0]
+
+def files_match(src, dst, src_stat, verify_hash):
+    """Whether dst already holds the same content as src"""
+    try:
+        dst_stat = os.stat(dst)
+    except OSError:
+        return False
+    if (src_stat.st_dev, src_stat.st_ino) == (dst_stat.st_dev, dst_stat.st_ino):
+        return True
+    if src_stat.st_size != dst_stat.st_size:
+        return False
+    if src_stat.st_mtime_ns == dst_stat.st_mtime_ns:
+        return True
+    if verify_hash:
+        return file_digest(src) == file_digest(dst)
+    return False
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def sync_directory(src_root, dst_root, mode='auto', verify_hash=False):
+    """Bring dst_root in line with src_root, touching only files that changed.
+
+    Files are compared by size and mtime (and content hash when verify_hash is
+    set). Files that disappeared from the source are removed, except build
+    artifacts, which are kept so the next compile can reuse them.
+    """
+    stats = {'copied': 0, 'cloned': 0, 'linked': 0, 'unchanged': 0, 'removed': 0}
+    seen_files = set()
+    seen_dirs = set()
+    ancestors = {}  # Directory -> (st_dev, st_ino) of it and its parents, to stop at symlink loops
+    
+    # Symlinked directories are copied like real ones, as copytree does
+    for root, dirs, files in os.walk(src_root, followlinks=True):
+        root_stat = os.stat(root)
+        chain = ancestors.pop(root, frozenset()) | {(root_stat.st_dev, root_stat.st_ino)}
+        kept = []
+        for name in dirs:
+            try:
+                dir_stat = os.stat(os.path.join(root, name))
+            except OSError:
+                continue
+            if (dir_stat.st_dev, dir_stat.st_ino) not in chain:
+                kept.append(name)
+                ancestors[os.path.join(root, name)] = chain
+        dirs[:] = kept
+        rel_root = os.path.relpath(root, src_root)
+        dst_dir = os.path.normpath(os.path.join(dst_root, rel_root))
+        seen_dirs.add(dst_dir)
+        if os.path.isfile(dst_dir) or os.path.islink(dst_dir):
+            os.remove(dst_dir)
+        os.makedirs(dst_dir, exist_ok=True)
+        
+        for file in files:
+            src_file = os.path.join(root, file)
+            dst_file = os.path.join(dst_dir, file)
+            seen_files.add(dst_file)
+            try:
+                src_stat = os.stat(src_file)
+            except OSError:
+                continue  # Dangling symlink
+            if os.path.isdir(dst_file) and not os.path.islink(dst_file):
+                shutil.rmtree(dst_file)
+            if files_match(src_file, dst_file, src_stat, verify_hash):
+                dst_stat = os.stat(dst_file)
+                # Interned files share their inode with other projects, so leave their metadata alone
+                if dst_stat.st_nlink == 1 and src_stat.st_mtime_ns != dst_stat.st_mtime_ns:
+                    shutil.copystat(src_file, dst_file)
+                stats['unchanged'] += 1
+                continue
+            stats[place_file(src_file, dst_file, mode)] += 1
+    
+    # Remove what no longer exists in the source
+    for root, dirs, files in os.walk(dst_root, topdown=False):
+        if TIKZ_EXTERNAL_DIR in os.path.relpath(root, dst_root).split(os.sep):
+            continue  # Externalized figures of earlier builds
+        for file in files:
+            dst_file = os.path.join(root, file)
+            if dst_file in seen_files or is_build_artifact(file) or is_output_pdf(file, files):
+                continue
+            os.remove(dst_file)
+            stats['removed'] += 1
+        if os.path.normpath(root) not in seen_dirs and not os.listdir(root):
+            os.rmdir(root)
+    return stats
+
 @app.route('/api/open_directory', methods=['POST'])
+@admission_controlled('upload')
 def open_directory():
     data = request.json
     directory_path = data.get('path', '')
+    mode = data.get('mode', 'auto')
+    verify_hash = bool(data.get('verify_hash', False))
     
     if not os.path.exists(directory_path) or not os.path.isdir(directory_path):
         return jsonify({'error': 'Invalid directory path'}), 400
     
-    # Copy directory to projects folder
+    if mode not in OPEN_DIRECTORY_MODES:
+        return jsonify({'error': f'Invalid mode (expected one of: {", ".join(OPEN_DIRECTORY_MODES)})'}), 400
+    
+    # Sync directory into the projects folder
     project_name = os.path.basename(directory_path.rstrip('/'))
     project_path = os.path.join(UPLOAD_FOLDER, project_name)
     
-    if os.path.exists(project_path):
-        shutil.rmtree(project_path)
+    if os.path.exists(project_path) and not os.path.isdir(project_path):
+        os.remove(project_path)
     
-    shutil.copytree(directory_path, project_path)
+    # Re-opening only copies files that changed since the last open
+    try:
+        stats = sync_directory(directory_path, project_path, mode, verify_hash)
+        if blob_store_enabled():
+            stats['dedup'] = intern_tree(project_path)
+    except Exception as e:
+        return jsonify({'error': f'Failed to open directory: {str(e)}'}), 500
     
     return jsonify({
         'success': True,
         'project_name': project_name,
+        'sync': stats,
         'message': 'Directory opened successfully'
     })
 
 @app.route('/api/projects')
 def list_projects():
     projects = []
+    inodes = {}  # (device, inode) -> size, to count shared content once
     if os.path.exists(UPLOAD_FOLDER):
         for item in os.listdir(UPLOAD_FOLDER):
+            # Hidden directories hold staging areas and caches, not projects
+            if item.startswith('.'):
+                continue
             item_path = os.path.join(UPLOAD_FOLDER, item)
             if os.path.isdir(item_path):
                 # Get project info
-                size = sum(
-                    os.path.getsize(os.path.join(dirpath, filename))
-                    for dirpath, dirnames, filenames in os.walk(item_path)
-                    for filename in filenames
-                )
+                with trace_span('fs_walk'):
+                    size, disk_size = project_sizes(item_path, inodes)
                 modified_time = os.path.getmtime(item_path)
                 projects.append({
                     'name': item,
                     'size': size,
+                    'disk_size': disk_size,
                     'modified': modified_time
                 })
-    return jsonify({'projects': projects})
+    return jsonify({
+        'projects': projects,
+        'storage': {
+            'logical_size': sum(project['size'] for project in projects),
+            'physical_size': sum(inodes.values())
+        }
+    })
+
+def project_sizes(project_path, inodes):
+    """Logical size of a project and its share of the disk space.
+
+    A file hardlinked from several places (an interned blob) is split evenly
+    between the projects linking it; the link kept by the blob store doesn't
+    count as a user. Every inode seen is recorded in `inodes`.
+    """
+    size = 0
+    disk_size = 0
+    store_link = 1 if blob_store_enabled() else 0
+    for dirpath, dirnames, filenames in os.walk(project_path):
+        for filename in filenames:
+            try:
+                stat_result = os.stat(os.path.join(dirpath, filename))
+            except OSError:
+                continue  # Dangling symlink
+            size += stat_result.st_size
+            users = stat_result.st_nlink - store_link if stat_result.st_nlink > 1 else 1
+            disk_size += stat_result.st_size // max(1, users)
+            inodes[(stat_result.st_dev, stat_result.st_ino)] = stat_result.st_size
+    return size, disk_size
 
 @app.route('/api/projects/<project_name>', methods=['DELETE'])
 def delete_project(project_name):
@@ -153,6 +1651,9 @@ def delete_project(project_name):
     
     try:
         shutil.rmtree(project_path)
+        purge_project_caches(project_name)
+        if blob_store_enabled():
+            io_executor.submit(collect_blob_garbage)
         return jsonify({
             'success': True,
             'message': 'Project deleted successfully'
@@ -183,6 +1684,7 @@ def rename_project(project_name):
     
     try:
         shutil.move(old_project_path, new_project_path)
+        purge_project_caches(project_name)
         return jsonify({
             'success': True,
             'project_name': new_name,
@@ -237,6 +1739,8 @@ def list_files(project_name):
         tree = []
         try:
             for item in sorted(os.listdir(path)):
+                if item == TIKZ_EXTERNAL_DIR:
+                    continue  # Generated figures, not sources
                 item_path = os.path.join(path, item)
                 rel_path = os.path.relpath(item_path, base_path)
                 
@@ -258,11 +1762,20 @@ def list_files(project_name):
             pass
         return tree
     
-    file_tree = get_file_tree(project_path, project_path)
+    with trace_span('fs_walk'):
+        file_tree = get_file_tree(project_path, project_path)
+    
+    # Encode very large trees incrementally
+    def count_entries(tree):
+        return sum(1 + count_entries(item.get('children', [])) for item in tree)
+    
+    if count_entries(file_tree) > STREAM_JSON_MIN_ITEMS:
+        return stream_json_response({'files': file_tree})
     return jsonify({'files': file_tree})
 
 
 @app.route('/api/file/<project_name>/<path:file_path>', methods=['PUT'])
+@admission_controlled('save')
 def save_file(project_name, file_path):
     project_path = os.path.join(UPLOAD_FOLDER, project_name)
     full_path = os.path.join(project_path, file_path)
@@ -276,13 +1789,16 @@ def save_file(project_name, file_path):
     
     try:
         os.makedirs(os.path.dirname(full_path), exist_ok=True)
-        with open(full_path, 'w', encoding='utf-8') as f:
-            f.write(content)
+        # Write to a temporary file and rename it over the old one, which also
+        # keeps edits from reaching files hardlinked from elsewhere
+        with trace_span('file_write'):
+            atomic_write_text(full_path, content)
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/upload_file/<project_name>', methods=['POST'])
+@admission_controlled('upload')
 def upload_file_to_project(project_name):
     if 'file' not in request.files:
         return jsonify({'error': 'No file part'}), 400
@@ -309,7 +1825,9 @@ def upload_file_to_project(project_name):
     
     try:
         file_path = os.path.join(target_path, file.filename)
-        file.save(file_path)
+        atomic_replace(file_path, file.save)
+        if blob_store_enabled():
+            intern_file(file_path)
         return jsonify({
             'success': True,
             'message': 'File uploaded successfully',
@@ -441,31 +1959,147 @@ def get_file_or_image(project_name, file_path):
         return jsonify({'error': 'Path is a directory'}), 400
     
     # Check if it's an image
-    image_extensions = {'.png', '.jpg', '.jpeg', '.gif', '.bmp', '.svg', '.webp'}
     file_ext = os.path.splitext(full_path)[1].lower()
     
-    if file_ext in image_extensions:
+    if file_ext in IMAGE_EXTENSIONS:
         return send_file(full_path)
     
+    # Let the client skip the download when its cached copy is still current
+    stat_result = os.stat(full_path)
+    etag = file_etag(stat_result)
+    if 'If-None-Match' in request.headers:
+        matched = request.if_none_match.contains_weak(etag.strip('"'))
+        cache_lookup('http_etag', hit=matched)
+        if matched:
+            return '', 304, {'ETag': etag}
+    
+    # Paged mode: return a range of lines plus the total line count
+    if 'offset' in request.args or 'limit' in request.args:
+        try:
+            offset = max(0, int(request.args.get('offset', 0)))
+            limit = min(PAGED_READ_MAX_LINES, max(1, int(request.args.get('limit', 1000))))
+        except ValueError:
+            return jsonify({'error': 'offset and limit must be integers'}), 400
+        try:
+            with trace_span('file_read'):
+                content, total_lines = read_line_range(full_path, stat_result, offset, limit)
+        except UnicodeDecodeError:
+            return jsonify({'error': 'File is not a text file'}), 400
+        response = jsonify({
+            'content': content,
+            'path': file_path,
+            'type': 'text',
+            'offset': offset,
+            'limit': limit,
+            'total_lines': total_lines,
+            'next_offset': min(offset + limit, total_lines),
+            'size': stat_result.st_size
+        })
+        response.headers['ETag'] = etag
+        return response
+    
+    # Very large files are streamed into the response instead of read whole
+    if stat_result.st_size >= STREAM_JSON_MIN_BYTES:
+        if not is_utf8_file(full_path):
+            return jsonify({'error': 'File is not a text file'}), 400
+        return stream_text_file_response(full_path, file_path, etag)
+    
     # Otherwise, try to read as text
     try:
-        with open(full_path, 'r', encoding='utf-8') as f:
+        with trace_span('file_read'), open(full_path, 'r', encoding='utf-8') as f:
             content = f.read()
-        return jsonify({
+        response = jsonify({
             'content': content,
             'path': file_path,
             'type': 'text'
         })
+        response.headers['ETag'] = etag
+        return response
     except UnicodeDecodeError:
         return jsonify({'error': 'File is not a text file'}), 400
 
-@app.route('/api/tex_files/<project_name>')
-@app.route('/api/projects/<project_name>/tex_files')
-def list_tex_files(project_name):
-    """List all .tex files in a project"""
-    project_path = os.path.join(UPLOAD_FOLDER, project_name)
+def read_project_file(project_path, file_path, known_etag=None):
+    """Read one file for the bulk endpoint and return a JSON-serializable record"""
+    full_path = os.path.join(project_path, file_path)
     
-    if not os.path.exists(project_path):
+    # Security check
+    if not os.path.abspath(full_path).startswith(os.path.abspath(project_path)):
+        return {'path': file_path, 'error': 'Invalid path'}
+    
+    try:
+        stat_result = os.stat(full_path)
+    except FileNotFoundError:
+        return {'path': file_path, 'error': 'File not found'}
+    except OSError as e:
+        return {'path': file_path, 'error': str(e)}
+    
+    if os.path.isdir(full_path):
+        return {'path': file_path, 'error': 'Path is a directory'}
+    
+    etag = file_etag(stat_result)
+    if known_etag:
+        cache_lookup('http_etag', hit=known_etag == etag)
+    if known_etag and known_etag == etag:
+        return {'path': file_path, 'etag': etag, 'unchanged': True}
+    
+    try:
+        if os.path.splitext(full_path)[1].lower() in IMAGE_EXTENSIONS:
+            with open(full_path, 'rb') as f:
+                content = base64.b64encode(f.read()).decode('ascii')
+            return {'path': file_path, 'etag': etag, 'type': 'image', 'encoding': 'base64', 'content': content}
+        with open(full_path, 'r', encoding='utf-8') as f:
+            content = f.read()
+        return {'path': file_path, 'etag': etag, 'type': 'text', 'content': content}
+    except UnicodeDecodeError:
+        return {'path': file_path, 'error': 'File is not a text file'}
+    except OSError as e:
+        return {'path': file_path, 'error': str(e)}
+
+@app.route('/api/files/<project_name>/bulk', methods=['POST'])
+def get_files_bulk(project_name):
+    """Stream the contents of several files as NDJSON, one record per line.
+
+    The request body is ``{"paths": [...], "etags": {path: etag}}``. Files whose
+    current ETag matches the one supplied are returned as ``unchanged`` without
+    content. Reads run in parallel on the shared I/O thread pool and records are
+    written in completion order.
+    """
+    project_path = os.path.join(UPLOAD_FOLDER, project_name)
+    
+    if not os.path.exists(project_path):
+        return jsonify({'error': 'Project not found'}), 404
+    
+    data = request.get_json(silent=True) or {}
+    paths = data.get('paths')
+    known_etags = data.get('etags') or {}
+    
+    if not isinstance(paths, list) or not all(isinstance(p, str) for p in paths):
+        return jsonify({'error': 'paths must be a list of file paths'}), 400
+    if not isinstance(known_etags, dict):
+        return jsonify({'error': 'etags must be an object mapping paths to ETags'}), 400
+    if len(paths) > BULK_MAX_FILES:
+        return jsonify({'error': f'Too many paths (maximum is {BULK_MAX_FILES})'}), 400
+    
+    # Drop duplicates but keep the caller's order for submission
+    paths = list(dict.fromkeys(paths))
+    futures = [
+        io_executor.submit(read_project_file, project_path, path, known_etags.get(path))
+        for path in paths
+    ]
+    
+    def generate():
+        for future in as_completed(futures):
+            yield json.dumps(future.result()) + '\n'
+    
+    return Response(generate(), mimetype='application/x-ndjson')
+
+@app.route('/api/tex_files/<project_name>')
+@app.route('/api/projects/<project_name>/tex_files')
+def list_tex_files(project_name):
+    """List all .tex files in a project"""
+    project_path = os.path.join(UPLOAD_FOLDER, project_name)
+    
+    if not os.path.exists(project_path):
         return jsonify({'error': 'Project not found'}), 404
     
     tex_files = []
@@ -494,6 +2128,7 @@ def list_tex_files(project_name):
     return jsonify({'tex_files': tex_files})
 
 @app.route('/api/clean/<project_name>', methods=['POST', 'GET'])
+@serialized_per_project
 def clean_project(project_name):
     """Remove all compilation-generated files"""
     project_path = os.path.join(UPLOAD_FOLDER, project_name)
@@ -502,12 +2137,7 @@ def clean_project(project_name):
         return jsonify({'error': 'Project not found'}), 404
     
     # List of file extensions to remove (auxiliary files, not PDFs)
-    extensions_to_remove = [
-        '.aux', '.log', '.out', '.toc', '.lof', '.lot', '.fls', '.fdb_latexmk',
-        '.synctex.gz', '.bbl', '.blg', '.bcf', '.run.xml', '.nav', '.snm',
-        '.vrb', '.idx', '.ilg', '.ind', '.glo', '.gls', '.glg', '.acn', '.acr',
-        '.alg', '.loa', '.thm', '.figlist', '.makefile', '.xdv', '.dvi'
-    ]
+    extensions_to_remove = AUX_EXTENSIONS
     
     removed_files = []
     errors = []
@@ -564,6 +2194,8 @@ def clean_project(project_name):
         return jsonify({'error': f'Failed to clean project: {str(e)}'}), 500
 
 @app.route('/api/compile/<project_name>')
+@admission_controlled('compile')
+@serialized_per_project
 def compile_latex(project_name):
     project_path = os.path.join(UPLOAD_FOLDER, project_name)
     
@@ -616,9 +2248,7 @@ def compile_latex(project_name):
             return jsonify({'error': 'No main LaTeX file found'}), 404
     
     # Compile LaTeX
-    compile_dir = os.path.dirname(main_file)
     main_filename = os.path.basename(main_file)
-    base_name = os.path.splitext(main_filename)[0]
     
     # Validate that the file exists and is readable
     try:
@@ -628,6 +2258,511 @@ def compile_latex(project_name):
     except OSError:
         return jsonify({'error': 'Cannot read LaTeX file'}), 400
     
+    # Focus compile: the file open in the editor selects the \include to typeset
+    focus_file = request.args.get('focus')
+    if not focus_file and request.is_json:
+        focus_file = request.json.get('focus')
+    focus = None
+    if focus_file:
+        focus_path = os.path.abspath(os.path.join(project_path, focus_file))
+        if not focus_path.startswith(os.path.abspath(project_path) + os.sep):
+            return jsonify({'error': 'Invalid focus file path'}), 400
+        focus = os.path.relpath(focus_path, os.path.dirname(os.path.abspath(main_file)))
+    
+    # Draft profile: one pass with placeholder figures into <name>-draft.pdf
+    profile = request.args.get('profile')
+    if not profile and request.is_json:
+        profile = request.json.get('profile')
+    profile = profile or 'full'
+    if profile not in COMPILE_PROFILES:
+        return jsonify({'error': f'Unknown compile profile: {profile}'}), 400
+    
+    backend = app.config.get('COMPILE_BACKEND', COMPILE_BACKEND)
+    started = time.perf_counter()
+    COMPILES_IN_FLIGHT.inc()
+    try:
+        payload, status = compile_backend().compile(project_path, main_file, focus, profile)
+    finally:
+        COMPILES_IN_FLIGHT.dec()
+    if payload.get('success'):
+        outcome = 'success'
+    elif payload.get('error') == 'Compilation timeout':
+        outcome = 'timeout'
+    else:
+        outcome = 'failure'
+    COMPILE_SECONDS.observe(time.perf_counter() - started, backend=backend, outcome=outcome)
+    COMPILES_TOTAL.inc(backend=backend, outcome=outcome)
+    if payload.get('success'):
+        payload['profile'] = profile
+        payload['pdf_path'] = os.path.relpath(payload.pop('pdf_file'), project_path)
+        synctex_file = payload.pop('synctex_file')
+        payload['synctex_path'] = os.path.relpath(synctex_file, project_path) if synctex_file else None
+        schedule_page_jobs(project_name, payload['pdf_path'].replace(os.sep, '/'))
+    return jsonify(payload), status
+
+def run_build_step(tool, step, args, **kwargs):
+    """subprocess.run for one run of a build tool, timed into the per-pass histogram"""
+    with trace_span(tool), COMPILE_PASS_SECONDS.time(tool=tool, step=step):
+        return subprocess.run(args, **kwargs)
+
+TEX_COMMENT_RE = re.compile(r'(?<!\\)%.*')
+TEX_INCLUDE_RE = re.compile(r'\\(include|input)\s*\{([^}]+)\}')
+INCLUDE_GRAPH_MAX_FILES = 500  # Files followed when looking for the \include of a file
+BIB_RESOURCE_RE = re.compile(r'\\(?:bibliography|addbibresource)\s*(?:\[[^\]]*\])?\{([^}]+)\}')
+
+def tex_input_file(base_dir, name):
+    """File an \\include or \\input argument refers to, or None if it does not exist"""
+    path = os.path.normpath(os.path.join(base_dir, name.strip()))
+    for candidate in (path + '.tex', path) if not path.endswith('.tex') else (path,):
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+def tex_includes(path):
+    """(command, argument) of each \\include and \\input in a file, outside comments"""
+    try:
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            content = TEX_COMMENT_RE.sub('', f.read())
+    except OSError:
+        return []
+    return TEX_INCLUDE_RE.findall(content)
+
+def find_focus_include(main_file, focus_file):
+    """(name, all names) of the \\include of main_file that contains focus_file.
+
+    Names are the \\include arguments, relative to the directory of main_file.
+    The chapter is the one whose file is focus_file or \\inputs it, directly or
+    through other files; name is None when focus_file is in no chapter.
+    """
+    base_dir = os.path.dirname(os.path.abspath(main_file))
+    focus_file = os.path.normpath(os.path.join(base_dir, focus_file))
+    
+    def follow_inputs(path, seen, includes):
+        """Collect the files reachable from path via \\input and, in document
+        order, the \\include names met on the way"""
+        if path in seen or len(seen) >= INCLUDE_GRAPH_MAX_FILES:
+            return
+        seen.add(path)
+        for command, name in tex_includes(path):
+            name = name.strip()
+            if command == 'include':
+                includes.append(name[:-4] if name.endswith('.tex') else name)
+            elif tex_input_file(base_dir, name):
+                follow_inputs(tex_input_file(base_dir, name), seen, includes)
+    
+    includes = []
+    follow_inputs(os.path.abspath(main_file), set(), includes)
+    for name in includes:
+        chapter_file = tex_input_file(base_dir, name)
+        chapter_files = set()
+        if chapter_file:
+            follow_inputs(chapter_file, chapter_files, [])
+        if focus_file in chapter_files:
+            return name, includes
+    return None, includes
+
+def seed_draft_job(compile_dir, base_name, bib_files):
+    """Give the draft job the .aux and .bbl of the full build when those are newer
+    than its own, so a single draft pass has references and citations.
+
+    Returns whether the draft's .bbl is the full build's and no .bib file
+    changed after it was written; the caller still has to check that the
+    draft cites the same keys (see draft_bbl_current).
+    """
+    for ext in ('.aux', '.bbl'):
+        full = os.path.join(compile_dir, base_name + ext)
+        draft = os.path.join(compile_dir, base_name + DRAFT_JOB_SUFFIX + ext)
+        if os.path.exists(full) and (not os.path.exists(draft) or os.path.getmtime(full) > os.path.getmtime(draft)):
+            shutil.copy2(full, draft)
+    bbl_file = os.path.join(compile_dir, base_name + DRAFT_JOB_SUFFIX + '.bbl')
+    if not os.path.exists(bbl_file):
+        return False
+    bbl_mtime = os.path.getmtime(bbl_file)
+    full_bbl = os.path.join(compile_dir, base_name + '.bbl')
+    if not os.path.exists(full_bbl) or os.path.getmtime(full_bbl) != bbl_mtime:
+        return False  # Written by an earlier draft's own bibliography run
+    return all(os.path.getmtime(bib) <= bbl_mtime for bib in bib_files if os.path.exists(bib))
+
+def draft_bbl_current(compile_dir, base_name, tool):
+    """Whether the draft's first pass asks the bibliography tool for exactly what
+    the full build did, so the full build's .bbl can stand in for a run"""
+    draft_key = bibliography_key(compile_dir, base_name + DRAFT_JOB_SUFFIX, tool)
+    return draft_key is not None and draft_key == bibliography_key(compile_dir, base_name, tool)
+
+# Figure cache: TikZ pictures are externalized into TIKZ_EXTERNAL_DIR and their
+# PDFs kept per project under a key of the picture's code and the preamble;
+# EPS and SVG graphics are converted once per content hash
+FIGURE_CACHE_ENABLED = True
+FIGURE_BUILD_WORKERS = os.cpu_count() or 1  # pdflatex processes building figures at once
+FIGURE_CACHE_TTL = 7 * 24 * 3600  # Seconds an unused cached figure is kept
+# Externalized figures are written next to the main file: TeX may only write below its
+# working directory (openout_any=p). The file tree, downloads and directory syncs skip it.
+TIKZ_EXTERNAL_DIR = '.tikz-cache'
+app.config['FIGURE_CACHE_ENABLED'] = FIGURE_CACHE_ENABLED
+
+# Externalize in "list and make" mode: the document pass writes <job>.figlist
+# and a .md5 of each picture's code, and TeXHandler builds the figures itself.
+# Guarded for LaTeX releases before 2020-10, which have no hooks.
+TIKZ_EXTERNALIZE_PREAMBLE = (
+    '\\ifdefined\\AddToHook\\AddToHook{package/tikz/after}{\\usetikzlibrary{external}'
+    '\\tikzexternalize[mode=list and make,prefix=' + TIKZ_EXTERNAL_DIR + '/]}\\fi'
+)
+TIKZ_RE = re.compile(r'\\usepackage\s*(?:\[[^\]]*\])?\{[^}]*\b(?:tikz|pgfplots)\b')
+TIKZ_MD5_RE = re.compile(r'\{([0-9A-Fa-f]{32})\}')
+SVG_PACKAGE_RE = re.compile(r'\\usepackage\s*(?:\[[^\]]*\])?\{[^}]*\bsvg\b')
+
+def figure_cache_dir(project_path):
+    """Figure cache of a project built on this server, or None when the cache is off"""
+    if not app.config.get('FIGURE_CACHE_ENABLED', FIGURE_CACHE_ENABLED):
+        return None
+    return cache_path('figures', os.path.basename(os.path.normpath(project_path)))
+
+def uses_tikz(tex_content):
+    """Whether a document loads TikZ and does not externalize it on its own"""
+    tex_content = TEX_COMMENT_RE.sub('', tex_content)
+    return bool(TIKZ_RE.search(tex_content)) and '\\tikzexternalize' not in tex_content
+
+def preamble_digest(compile_dir, tex_content, preamble):
+    """Hash of everything besides a picture's code that shapes a figure: the main
+    file's preamble, the files it \\inputs, the injected options and the
+    project's own .sty/.cls files"""
+    hasher = hashlib.sha256()
+    hasher.update(''.join(preamble).encode('utf-8'))
+    main_preamble = tex_content.split('\\begin{document}', 1)[0]
+    hasher.update(main_preamble.encode('utf-8'))
+    pending = [name for command, name in TEX_INCLUDE_RE.findall(TEX_COMMENT_RE.sub('', main_preamble)) if command == 'input']
+    seen = set()
+    while pending and len(seen) < INCLUDE_GRAPH_MAX_FILES:
+        path = tex_input_file(compile_dir, pending.pop(0))
+        if path is None or path in seen or not path.startswith(os.path.join(compile_dir, '')):
+            continue
+        seen.add(path)
+        hasher.update(os.path.relpath(path, compile_dir).encode('utf-8') + b'\0')
+        hasher.update(file_digest(path).encode('ascii'))
+        pending.extend(name for command, name in tex_includes(path) if command == 'input')
+    for root, dirs, files in os.walk(compile_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.') and d != TIKZ_EXTERNAL_DIR)
+        for file in sorted(files):
+            if file.endswith(('.sty', '.cls')):
+                hasher.update(file.encode('utf-8'))
+                hasher.update(file_digest(os.path.join(root, file)).encode('ascii'))
+    return hasher.hexdigest()
+
+def link_or_copy(src, dst):
+    """Put src at dst as a hardlink (a copy across file systems) unless it already is"""
+    try:
+        if os.path.samefile(src, dst):
+            return
+        os.remove(dst)
+    except FileNotFoundError:
+        pass
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+def store_figure_file(src, dst):
+    """Copy a finished file into a cache directory"""
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    atomic_replace(dst, lambda tmp_path: shutil.copyfile(src, tmp_path))
+
+def graphics_conversions(compile_dir, tex_content):
+    """(source, converter args, [(cached suffix, output path)]) for the EPS and SVG files of a project.
+
+    EPS files become <name>-eps-converted-to.pdf, the file graphicx' epstopdf
+    support looks for; SVG files become svg-inkscape/<name>_svg-tex.pdf(_tex)
+    as written by the svg package, when the document loads it.
+    """
+    svg_package = bool(SVG_PACKAGE_RE.search(TEX_COMMENT_RE.sub('', tex_content))) and shutil.which('inkscape')
+    epstopdf = shutil.which('epstopdf')
+    for root, dirs, files in os.walk(compile_dir):
+        dirs[:] = [d for d in dirs if not d.startswith('.') and d not in (TIKZ_EXTERNAL_DIR, 'svg-inkscape')]
+        for file in files:
+            stem, ext = os.path.splitext(file)
+            source = os.path.join(root, file)
+            if ext.lower() == '.eps' and epstopdf:
+                target = os.path.join(root, stem + '-eps-converted-to.pdf')
+                yield source, ['epstopdf', f'--outfile={target}', source], [('.pdf', target)]
+            elif ext.lower() == '.svg' and svg_package:
+                target = os.path.join(root, 'svg-inkscape', stem + '_svg-tex.pdf')
+                yield source, ['inkscape', f'--export-filename={target}', '--export-type=pdf', '--export-latex', source], \
+                    [('.pdf', target), ('.pdf_tex', target + '_tex')]
+
+def convert_graphics(compile_dir, tex_content, cache_dir):
+    """Convert EPS/SVG graphics that are not converted yet, reusing conversions of
+    the same content from the figure cache. Returns the counts for the payload."""
+    stats = {'cached': 0, 'converted': 0, 'failed': []}
+    jobs = []
+    for source, args, outputs in graphics_conversions(compile_dir, tex_content):
+        if all(os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(source) for _, path in outputs):
+            continue  # Converted by an earlier build
+        # SVG output refers to its own file name, so the name is part of the key
+        key = cached_file_digest(source, os.stat(source)) + '-' + hashlib.sha256(
+            os.path.basename(outputs[0][1]).encode('utf-8')).hexdigest()[:8]
+        cached = [(os.path.join(cache_dir, 'graphics', key + suffix), path) for suffix, path in outputs]
+        if all(os.path.exists(cached_file) for cached_file, _ in cached):
+            for cached_file, path in cached:
+                os.utime(cached_file)  # Newer than the source, so the packages don't convert again
+                link_or_copy(cached_file, path)
+            stats['cached'] += 1
+        else:
+            jobs.append((source, args, cached))
+    
+    def convert(job):
+        source, args, cached = job
+        for _, path in cached:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.exists(path):
+                os.remove(path)  # May be a link into the cache
+        with trace_span('convert_graphics'):
+            subprocess.run(args, cwd=compile_dir, capture_output=True, timeout=60, check=True)
+        for cached_file, path in cached:
+            store_figure_file(path, cached_file)
+    
+    if jobs:
+        with ThreadPoolExecutor(max_workers=min(len(jobs), FIGURE_BUILD_WORKERS)) as pool:
+            futures = {pool.submit(convert, job): job[0] for job in jobs}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                    stats['converted'] += 1
+                except (OSError, subprocess.SubprocessError):
+                    stats['failed'].append(os.path.relpath(futures[future], compile_dir).replace(os.sep, '/'))
+    stats['failed'].sort()
+    return stats
+
+def read_figure_key(compile_dir, name):
+    """Key the local PDF of a figure was built or restored with, or None"""
+    try:
+        with open(os.path.join(compile_dir, name + '.key'), 'r', encoding='ascii') as f:
+            return f.read().strip()
+    except (OSError, ValueError):
+        return None
+
+def write_figure_key(compile_dir, name, key):
+    atomic_write_text(os.path.join(compile_dir, name + '.key'), key)
+
+def build_external_figures(compile_dir, job_name, source_arg, preamble_key, cache_dir):
+    """Bring the figures listed by the last document pass up to date.
+
+    As in the makefile TikZ writes, a figure is stale when its PDF is missing
+    or older than its .md5, which the document pass rewrites when the
+    picture's code changes; it is also stale when the <name>.key next to it,
+    written with each figure, holds another key of that checksum and the
+    preamble digest, i.e. the preamble changed. Stale figures are linked from
+    the cache under their key, or else built in parallel, one pdflatex process
+    each, and stored. Returns the counts for the payload.
+    """
+    stats = {'externalized': 0, 'cached': 0, 'built': 0, 'failed': []}
+    try:
+        with open(os.path.join(compile_dir, job_name + '.figlist'), 'r', encoding='utf-8') as f:
+            names = [line.strip() for line in f if line.strip()]
+    except OSError:
+        return stats
+    stats['externalized'] = len(names)
+    
+    stale = []
+    for name in names:
+        md5_file = os.path.join(compile_dir, name + '.md5')
+        pdf_file = os.path.join(compile_dir, name + '.pdf')
+        try:
+            with open(md5_file, 'r', encoding='utf-8') as f:
+                match = TIKZ_MD5_RE.search(f.read())
+        except OSError:
+            match = None
+        if not match:
+            stale.append((name, None, None))  # Built without caching
+            continue
+        key = hashlib.sha256(f'{match.group(1).lower()}:{preamble_key}'.encode('ascii')).hexdigest()
+        cached_pdf = os.path.join(cache_dir, 'tikz', key + '.pdf')
+        if os.path.exists(pdf_file) and os.path.getmtime(pdf_file) >= os.path.getmtime(md5_file) \
+                and read_figure_key(compile_dir, name) == key:
+            if not os.path.exists(cached_pdf):
+                store_figure_file(pdf_file, cached_pdf)  # Seeds the cache from builds before it
+            continue
+        if os.path.exists(cached_pdf):
+            os.utime(cached_pdf)  # Newer than the .md5, and kept from expiring
+            link_or_copy(cached_pdf, pdf_file)
+            if os.path.exists(cached_pdf[:-4] + '.dpth'):
+                link_or_copy(cached_pdf[:-4] + '.dpth', os.path.join(compile_dir, name + '.dpth'))
+            write_figure_key(compile_dir, name, key)
+            stats['cached'] += 1
+        else:
+            stale.append((name, cached_pdf, key))
+    
+    def build(figure):
+        # The command TikZ' makefile runs for a figure, with our preamble
+        name, cached_pdf, key = figure
+        pdf_file = os.path.join(compile_dir, name + '.pdf')
+        for path in (pdf_file, os.path.join(compile_dir, name + '.key')):
+            if os.path.exists(path):
+                os.remove(path)  # The PDF may be a link into the cache; pdflatex would overwrite that in place
+        result = run_build_step('pdflatex', 'figure',
+            ['pdflatex', '-halt-on-error', '-interaction=batchmode', '-output-directory', compile_dir, '-jobname', name,
+             f'\\def\\tikzexternalrealjob{{{job_name}}}' + source_arg],
+            cwd=compile_dir, capture_output=True, text=True, timeout=60)
+        if result.returncode != 0 or not os.path.exists(pdf_file):
+            raise subprocess.CalledProcessError(result.returncode, name)
+        if cached_pdf:
+            store_figure_file(pdf_file, cached_pdf)
+            if os.path.exists(os.path.join(compile_dir, name + '.dpth')):
+                store_figure_file(os.path.join(compile_dir, name + '.dpth'), cached_pdf[:-4] + '.dpth')
+            write_figure_key(compile_dir, name, key)
+    
+    if stale:
+        with ThreadPoolExecutor(max_workers=min(len(stale), FIGURE_BUILD_WORKERS)) as pool:
+            futures = {pool.submit(build, figure): figure[0] for figure in stale}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                    stats['built'] += 1
+                except (OSError, subprocess.SubprocessError):
+                    stats['failed'].append(futures[future])
+    stats['failed'].sort()
+    return stats
+
+def prune_figure_cache(cache_dir):
+    """Drop cached figures and conversions that no build used for FIGURE_CACHE_TTL"""
+    cutoff = time.time() - FIGURE_CACHE_TTL
+    for kind in ('tikz', 'graphics'):
+        directory = os.path.join(cache_dir, kind)
+        if not os.path.isdir(directory):
+            continue
+        for entry in os.scandir(directory):
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+
+# Bibliography cache: the .bbl of a bibtex/biber run, keyed by what the run reads
+BIB_CACHE_ENABLED = True
+BIB_CACHE_MAX_ENTRIES = 50  # .bbl files kept per project, least recently used dropped first
+app.config['BIB_CACHE_ENABLED'] = BIB_CACHE_ENABLED
+AUX_BIB_RE = re.compile(r'\\(citation|bibdata|bibstyle|@input)\{([^}]*)\}')
+BCF_DATASOURCE_RE = re.compile(r'<bcf:datasource[^>]*>([^<]+)</bcf:datasource>')
+
+def bib_cache_dir(project_path):
+    """Bibliography cache of a project built on this server, or None when the cache is off"""
+    if not app.config.get('BIB_CACHE_ENABLED', BIB_CACHE_ENABLED):
+        return None
+    return cache_path('bibliography', os.path.basename(os.path.normpath(project_path)))
+
+def bibliography_key(compile_dir, job_name, tool):
+    """Cache key of the bibliography run for a job, or None when its input is missing.
+
+    For bibtex that is the \\citation keys in order, the \\bibdata databases and
+    the \\bibstyle of the .aux (following the \\@input of \\include chapters);
+    for biber the .bcf, which holds the citations, data sources and all
+    biblatex options. The content of the .bib (and local .bst) files is added.
+    """
+    hasher = hashlib.sha256(tool.encode('ascii') + b'\0')
+    sources = []
+    if tool == 'biber':
+        try:
+            with open(os.path.join(compile_dir, job_name + '.bcf'), 'rb') as f:
+                bcf = f.read()
+        except OSError:
+            return None
+        hasher.update(bcf)
+        sources = [html.unescape(name.strip()) for name in BCF_DATASOURCE_RE.findall(bcf.decode('utf-8', 'replace'))]
+    else:
+        citations = []
+        pending = [job_name + '.aux']
+        seen = set()
+        while pending:
+            name = pending.pop(0)
+            if name in seen or len(seen) >= INCLUDE_GRAPH_MAX_FILES:
+                continue
+            seen.add(name)
+            try:
+                with open(os.path.join(compile_dir, name), 'r', encoding='utf-8', errors='replace') as f:
+                    entries = AUX_BIB_RE.findall(f.read())
+            except OSError:
+                if name == job_name + '.aux':
+                    return None
+                continue
+            for command, argument in entries:
+                if command == '@input':
+                    pending.append(argument)
+                elif command == 'citation':
+                    citations.extend(argument.split(','))
+                elif command == 'bibdata':
+                    hasher.update(b'bibdata\0' + argument.encode('utf-8') + b'\0')
+                    sources.extend(n.strip() if n.strip().endswith('.bib') else n.strip() + '.bib' for n in argument.split(','))
+                else:
+                    hasher.update(b'bibstyle\0' + argument.encode('utf-8') + b'\0')
+                    sources.append(argument.strip() + '.bst')
+        hasher.update('\0'.join(dict.fromkeys(key.strip() for key in citations)).encode('utf-8'))
+    
+    for name in sources:
+        path = os.path.join(compile_dir, name)
+        hasher.update(b'\0' + name.encode('utf-8') + b'\0')
+        if os.path.isfile(path):  # Others come from the TeX installation
+            hasher.update(cached_file_digest(path, os.stat(path)).encode('ascii'))
+    return hasher.hexdigest()
+
+def restore_cached_bbl(cache_dir, key, bbl_file):
+    """Put the cached .bbl for key in place. Returns None when there is none, else
+    whether that changed the job's .bbl (if not, no extra pass is needed)."""
+    cached_bbl = os.path.join(cache_dir, key + '.bbl')
+    try:
+        with open(cached_bbl, 'rb') as f:
+            content = f.read()
+    except OSError:
+        return None
+    os.utime(cached_bbl)  # Most recently used
+    try:
+        with open(bbl_file, 'rb') as f:
+            if f.read() == content:
+                return False
+    except OSError:
+        pass
+    shutil.copyfile(cached_bbl, bbl_file)
+    return True
+
+def store_cached_bbl(cache_dir, key, bbl_file):
+    """Keep the .bbl a bibliography run wrote, dropping the least recently used beyond BIB_CACHE_MAX_ENTRIES"""
+    if not os.path.exists(bbl_file):
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    store_figure_file(bbl_file, os.path.join(cache_dir, key + '.bbl'))
+    entries = sorted((entry.stat().st_mtime, entry.path) for entry in os.scandir(cache_dir)
+                     if entry.is_file() and entry.name.endswith('.bbl'))
+    for _, path in entries[:-BIB_CACHE_MAX_ENTRIES]:
+        os.remove(path)
+
+def run_latex_pipeline(main_file, focus=None, profile='full', figure_cache=None, bib_cache=None):
+    """Run the pdflatex and bibliography passes for main_file in its directory.
+
+    Returns (payload, status), where payload is what the compile endpoint sends
+    back, except that a successful build reports absolute 'pdf_file' and
+    'synctex_file' paths instead of project-relative ones. This is shared by
+    the local backend and the remote compile workers.
+    
+    With focus (the path of the file being edited, relative to main_file's
+    directory) only the \\include containing it is typeset, through an
+    \\includeonly given on the command line; the other chapters' .aux files
+    from earlier builds keep references and page numbers right. Without those
+    .aux files it builds everything, and 'focus' in the payload is None.
+    
+    The 'draft' profile builds the job <name>-draft with graphicx in draft mode
+    (figures become boxes) in a single pass, starting from the .aux and .bbl
+    of the last full build; bibtex/biber and a second pass only run when a .bib
+    file is newer than that .bbl.
+    
+    With figure_cache (a directory kept between builds) EPS and SVG graphics
+    are converted ahead of pdflatex and TikZ pictures are externalized and
+    built in parallel after the first pass, each reused from the cache while
+    its content and the preamble are unchanged. Drafts don't build figures.
+    
+    With bib_cache the .bbl of each bibtex/biber run is kept under a key of its
+    citations, databases and style, and restored instead of running the tool
+    when they come back unchanged.
+    """
+    compile_dir = os.path.dirname(main_file)
+    main_filename = os.path.basename(main_file)
+    base_name = os.path.splitext(main_filename)[0]
+    job_name = base_name + DRAFT_JOB_SUFFIX if profile == 'draft' else base_name
+    
     try:
         compilation_log = []
         
@@ -639,7 +2774,7 @@ def compile_latex(project_name):
             with open(main_file, 'r', encoding='utf-8') as f:
                 tex_content = f.read()
                 if not tex_content.strip():
-                    return jsonify({'error': f'LaTeX file "{main_filename}" appears to be empty or contains only whitespace. Please add valid LaTeX content before compiling.'}), 400
+                    return {'error': f'LaTeX file "{main_filename}" appears to be empty or contains only whitespace. Please add valid LaTeX content before compiling.'}, 400
                 # Check for biblatex (modern bibliography system)
                 if '\\usepackage{biblatex}' in tex_content or '\\addbibresource' in tex_content:
                     needs_biber = True
@@ -647,17 +2782,55 @@ def compile_latex(project_name):
                 elif '\\bibliography' in tex_content or '\\bibliographystyle' in tex_content:
                     needs_bibtex = True
         except Exception as e:
-            return jsonify({'error': f'Error reading LaTeX file: {str(e)}'}), 400
+            return {'error': f'Error reading LaTeX file: {str(e)}'}, 400
         
         # Ensure compile_dir exists and is absolute
         compile_dir = os.path.abspath(compile_dir)
         
+        draft_bbl_usable = False
+        if profile == 'draft':
+            bib_files = [os.path.join(compile_dir, name if name.endswith('.bib') else name + '.bib')
+                         for names in BIB_RESOURCE_RE.findall(TEX_COMMENT_RE.sub('', tex_content))
+                         for name in (n.strip() for n in names.split(',')) if name]
+            draft_bbl_usable = seed_draft_job(compile_dir, base_name, bib_files)
+        
+        # Focus compile: typeset one chapter, with the same jobname so the
+        # outputs and the other chapters' aux files are the usual ones
+        preamble = []
+        focus_include = None
+        if focus:
+            focus_include, includes = find_focus_include(main_file, focus)
+            missing_aux = [name for name in [job_name] + includes
+                           if name != focus_include and not os.path.exists(os.path.join(compile_dir, name + '.aux'))]
+            if focus_include and missing_aux:
+                compilation_log.append(f"=== Focus compile: building everything, no .aux yet for {', '.join(missing_aux)} ===\n")
+                focus_include = None
+            elif focus_include:
+                preamble.append(f'\\includeonly{{{focus_include}}}')
+                compilation_log.append(f"=== Focus compile: only \\include{{{focus_include}}} ===\n")
+        
+        if profile == 'draft':
+            preamble.append('\\PassOptionsToPackage{draft}{graphicx}')
+        
+        externalize = False
+        if figure_cache:
+            graphics_stats = convert_graphics(compile_dir, tex_content, figure_cache)
+            if graphics_stats['failed']:
+                compilation_log.append(f"=== Could not convert {', '.join(graphics_stats['failed'])} ===\n")
+            # Drafts typeset pictures inline: in list and make mode a draft job
+            # would leave out every picture, as it never builds figures itself
+            if uses_tikz(tex_content) and profile != 'draft':
+                externalize = True
+                os.makedirs(os.path.join(compile_dir, TIKZ_EXTERNAL_DIR), exist_ok=True)
+                preamble.append(TIKZ_EXTERNALIZE_PREAMBLE)
+        source_arg = ''.join(preamble) + f'\\input{{{main_filename}}}' if preamble else main_filename
+        
         # First pdflatex pass - generates .aux file with reference information
         # Use absolute path for main_file to avoid path issues
         main_file_abs = os.path.abspath(main_file)
         
-        result1 = subprocess.run(
-            ['pdflatex', '-synctex=1', '-interaction=nonstopmode', '-output-directory', compile_dir, '-jobname', base_name, main_filename],
+        result1 = run_build_step('pdflatex', 'first',
+            ['pdflatex', '-synctex=1', '-interaction=nonstopmode', '-output-directory', compile_dir, '-jobname', job_name, source_arg],
             cwd=compile_dir,
             capture_output=True,
             text=True,
@@ -688,14 +2861,27 @@ def compile_latex(project_name):
                             error_msg = 'LaTeX compilation failed: Emergency stop (file may be empty or invalid)'
                         break
             
-            return jsonify({
+            return {
                 'success': False,
                 'error': error_msg,
                 'log': '\n'.join(compilation_log)
-            }), 500
+            }, 500
+        
+        figure_stats = None
+        if externalize:
+            # \includeonly only picks chapters; it does not change how a picture looks
+            figure_options = [part for part in preamble if not part.startswith('\\includeonly')]
+            with trace_span('figures'):
+                figure_stats = build_external_figures(compile_dir, job_name, source_arg,
+                                                      preamble_digest(compile_dir, tex_content, figure_options), figure_cache)
+            compilation_log.append(f"=== Figures: {figure_stats['cached']} from cache, {figure_stats['built']} built ===\n")
+            if figure_stats['failed']:
+                compilation_log.append(f"=== Figures that failed to build: {', '.join(figure_stats['failed'])} ===\n")
+        if figure_cache:
+            prune_figure_cache(figure_cache)
         
         # Double-check .aux file for citations (in case source file check missed something)
-        aux_file = os.path.join(compile_dir, base_name + '.aux')
+        aux_file = os.path.join(compile_dir, job_name + '.aux')
         if os.path.exists(aux_file):
             try:
                 with open(aux_file, 'r', encoding='utf-8') as f:
@@ -710,58 +2896,89 @@ def compile_latex(project_name):
             except:
                 pass
         
+        # A draft reuses the bibliography of the full build while it cites the
+        # same keys from the same databases
+        if draft_bbl_usable and (needs_biber or needs_bibtex):
+            draft_bbl_usable = draft_bbl_current(compile_dir, base_name, 'biber' if needs_biber else 'bibtex')
+        if draft_bbl_usable:
+            needs_biber = needs_bibtex = False
+        
+        # Reuse the .bbl of an earlier run with the same citations, databases and style
+        bib_tool = 'biber' if needs_biber else 'bibtex' if needs_bibtex else None
+        bib_key = None
+        bib_cache_hit = False
+        bib_returncode = None
+        if bib_tool and bib_cache:
+            bib_key = bibliography_key(compile_dir, job_name, bib_tool)
+            restored = restore_cached_bbl(bib_cache, bib_key, os.path.join(compile_dir, job_name + '.bbl')) if bib_key else None
+            bib_cache_hit = restored is not None
+            cache_lookup('bibliography', hit=bib_cache_hit)
+            if restored is False:
+                needs_biber = needs_bibtex = False  # The .bbl in place is current; no extra pass
+        
         # Run bibliography processor if needed
-        if needs_biber:
+        if bib_cache_hit:
+            compilation_log.append(f"=== Bibliography unchanged, {bib_tool} skipped and .bbl taken from the cache ===\n")
+        elif needs_biber:
             try:
-                result_biber = subprocess.run(
-                    ['biber', base_name],
+                result_biber = run_build_step('biber', 'bibliography',
+                    ['biber', job_name],
                     cwd=compile_dir,
                     capture_output=True,
                     text=True,
                     timeout=60
                 )
                 compilation_log.append("=== Biber pass ===\n" + result_biber.stdout + result_biber.stderr)
+                bib_returncode = result_biber.returncode
             except FileNotFoundError:
                 compilation_log.append("=== Warning: biber not found, skipping bibliography processing ===\n")
             except Exception as e:
                 compilation_log.append(f"=== Biber error: {str(e)} ===\n")
         elif needs_bibtex:
             try:
-                result_bibtex = subprocess.run(
-                    ['bibtex', base_name],
+                result_bibtex = run_build_step('bibtex', 'bibliography',
+                    ['bibtex', job_name],
                     cwd=compile_dir,
                     capture_output=True,
                     text=True,
                     timeout=60
                 )
                 compilation_log.append("=== BibTeX pass ===\n" + result_bibtex.stdout + result_bibtex.stderr)
+                bib_returncode = result_bibtex.returncode
             except FileNotFoundError:
                 compilation_log.append("=== Warning: bibtex not found, skipping bibliography processing ===\n")
             except Exception as e:
                 compilation_log.append(f"=== BibTeX error: {str(e)} ===\n")
         
+        if bib_key and bib_returncode is not None and bib_returncode <= (1 if bib_tool == 'bibtex' else 0):  # bibtex: 1 means warnings
+            store_cached_bbl(bib_cache, bib_key, os.path.join(compile_dir, job_name + '.bbl'))
+        
         # Check if first pass had critical errors (non-zero return code usually indicates failure)
         if result1.returncode != 0 and 'Fatal error occurred' in result1.stderr:
             # If there's a fatal error, return early with the error message
-            return jsonify({
+            return {
                 'success': False,
                 'error': 'LaTeX compilation failed with fatal error',
                 'log': '\n'.join(compilation_log)
-            }), 500
+            }, 500
         
         # Second pdflatex pass - reads .aux and resolves references
-        result2 = subprocess.run(
-            ['pdflatex', '-synctex=1', '-interaction=nonstopmode', '-output-directory', compile_dir, '-jobname', base_name, main_filename],
-            cwd=compile_dir,
-            capture_output=True,
-            text=True,
-            timeout=60
-        )
-        compilation_log.append("=== Second pdflatex pass ===\n" + result2.stdout + result2.stderr)
+        # (a draft only needs it to pick up a bibliography that was just built)
+        if profile == 'draft' and not (needs_bibtex or needs_biber):
+            result2 = None
+        else:
+            result2 = run_build_step('pdflatex', 'second',
+                ['pdflatex', '-synctex=1', '-interaction=nonstopmode', '-output-directory', compile_dir, '-jobname', job_name, source_arg],
+                cwd=compile_dir,
+                capture_output=True,
+                text=True,
+                timeout=60
+            )
+            compilation_log.append("=== Second pdflatex pass ===\n" + result2.stdout + result2.stderr)
         
         # Check if there are unresolved references that need another pass
-        needs_third_pass = needs_bibtex or needs_biber
-        if not needs_third_pass and os.path.exists(aux_file):
+        needs_third_pass = (needs_bibtex or needs_biber) and profile != 'draft'
+        if not needs_third_pass and result2 is not None and profile != 'draft' and os.path.exists(aux_file):
             try:
                 with open(aux_file, 'r', encoding='utf-8') as f:
                     aux_content = f.read()
@@ -773,8 +2990,8 @@ def compile_latex(project_name):
         
         # Third pdflatex pass - finalizes all references
         if needs_third_pass:
-            result3 = subprocess.run(
-                ['pdflatex', '-synctex=1', '-interaction=nonstopmode', '-output-directory', compile_dir, '-jobname', base_name, main_filename],
+            result3 = run_build_step('pdflatex', 'third',
+                ['pdflatex', '-synctex=1', '-interaction=nonstopmode', '-output-directory', compile_dir, '-jobname', job_name, source_arg],
                 cwd=compile_dir,
                 capture_output=True,
                 text=True,
@@ -782,32 +2999,480 @@ def compile_latex(project_name):
             )
             compilation_log.append("=== Third pdflatex pass ===\n" + result3.stdout + result3.stderr)
         
-        pdf_path = os.path.join(compile_dir, base_name + '.pdf')
-        synctex_path = os.path.join(compile_dir, base_name + '.synctex.gz')
+        pdf_path = os.path.join(compile_dir, job_name + '.pdf')
+        synctex_path = os.path.join(compile_dir, job_name + '.synctex.gz')
         
         # Combine all logs
         full_log = '\n'.join(compilation_log)
         
         if os.path.exists(pdf_path):
-            return jsonify({
+            payload = {
                 'success': True,
-                'pdf_path': os.path.relpath(pdf_path, project_path),
-                'synctex_path': os.path.relpath(synctex_path, project_path) if os.path.exists(synctex_path) else None,
+                'pdf_file': pdf_path,
+                'synctex_file': synctex_path if os.path.exists(synctex_path) else None,
                 'log': full_log
-            })
+            }
+            if focus:
+                payload['focus'] = focus_include
+            if profile == 'draft':
+                payload['bibliography_reused'] = draft_bbl_usable
+            if bib_tool and bib_cache:
+                payload['bibliography_cache'] = {'tool': bib_tool, 'hit': bib_cache_hit}
+            if figure_cache:
+                payload['graphics'] = graphics_stats
+                payload['figures'] = figure_stats
+            return payload, 200
         else:
-            return jsonify({
+            return {
                 'success': False,
                 'error': 'PDF generation failed',
                 'log': full_log
-            }), 500
+            }, 500
             
     except subprocess.TimeoutExpired:
-        return jsonify({'error': 'Compilation timeout'}), 500
+        return {'error': 'Compilation timeout'}, 500
     except FileNotFoundError:
-        return jsonify({'error': 'pdflatex not found. Please install LaTeX distribution.'}), 500
+        return {'error': 'pdflatex not found. Please install LaTeX distribution.'}, 500
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return {'error': str(e)}, 500
+
+def rewrite_synctex_paths(synctex_file, old_dir, new_dir):
+    """Point the Input: records of a synctex file at new_dir instead of old_dir.
+
+    pdflatex records absolute source paths, so a synctex file produced in a
+    different directory (on a compile worker, in a scratch build directory)
+    has to be rewritten before synctex can map it back to the project.
+    """
+    old_prefix = os.path.join(old_dir, '').encode('utf-8')
+    new_prefix = os.path.join(new_dir, '').encode('utf-8')
+    if old_prefix == new_prefix:
+        return
+    
+    def write(tmp_path):
+        with gzip.open(synctex_file, 'rb') as src, gzip.open(tmp_path, 'wb', compresslevel=6) as dst:
+            for line in src:
+                if line.startswith(b'Input:'):
+                    line = line.replace(old_prefix, new_prefix, 1)
+                dst.write(line)
+    atomic_replace(synctex_file, write)
+
+# sha256 of project files keyed by path, reused while (mtime, size) is unchanged
+digest_cache = OrderedDict()
+digest_cache_lock = threading.Lock()
+
+def cached_file_digest(path, stat_result):
+    key = os.path.abspath(path)
+    version = (stat_result.st_mtime_ns, stat_result.st_size)
+    with digest_cache_lock:
+        entry = digest_cache.get(key)
+        if entry and entry[0] == version:
+            digest_cache.move_to_end(key)
+            cache_lookup('file_digest', hit=True)
+            return entry[1]
+    
+    cache_lookup('file_digest', hit=False)
+    stored = snapshot_index_payload('digests', path, version)
+    if stored is not None:
+        digest = stored.hex()
+    else:
+        digest = file_digest(path)
+        mark_index_dirty(path)
+    with digest_cache_lock:
+        digest_cache[key] = (version, digest)
+        digest_cache.move_to_end(key)
+        while len(digest_cache) > DIGEST_CACHE_SIZE:
+            digest_cache.popitem(last=False)
+    return digest
+
+def project_snapshot(project_path):
+    """Content-addressed snapshot of a project's sources.
+
+    Returns (manifest, blob_paths): manifest maps each relative path (with
+    forward slashes) to the sha256 of its content, blob_paths maps each digest
+    to one local file holding it. Build artifacts are left out.
+    """
+    manifest = {}
+    blob_paths = {}
+    for path, arcname, stat_result in collect_download_files(project_path, exclude_artifacts=True):
+        digest = cached_file_digest(path, stat_result)
+        manifest[arcname.replace(os.sep, '/')] = digest
+        blob_paths.setdefault(digest, path)
+    return manifest, blob_paths
+
+def blob_store_enabled():
+    return app.config.get('BLOB_STORE_ENABLED', BLOB_STORE_ENABLED)
+
+def blob_path(digest):
+    """Location of a blob; the store lives inside the projects folder so hardlinks work"""
+    return os.path.join(UPLOAD_FOLDER, '.blobs', digest[:2], digest)
+
+def intern_file(path):
+    """Store a project file's content in the blob store, sharing it with identical files.
+
+    A file whose content is new becomes the blob (a second hardlink is added
+    under .blobs; its mode is left alone); a file whose content is already
+    stored is replaced by a link to the existing blob. Files that are
+    small, build outputs or already hardlinked elsewhere are left alone.
+    Returns 'stored', 'linked' or None. All writes through the API replace
+    files by renaming, so editing an interned file leaves the blob untouched.
+    """
+    try:
+        stat_result = os.lstat(path)
+    except OSError:
+        return None
+    if (not os.path.isfile(path) or os.path.islink(path) or stat_result.st_nlink != 1
+            or stat_result.st_size < app.config.get('BLOB_MIN_BYTES', BLOB_MIN_BYTES)):
+        return None
+    
+    blob = blob_path(cached_file_digest(path, stat_result))
+    os.makedirs(os.path.dirname(blob), exist_ok=True)
+    try:
+        os.link(path, blob)
+    except FileExistsError:
+        pass
+    except OSError:
+        return None  # Hardlinks not supported here
+    else:
+        return 'stored'
+    
+    def link_blob(tmp_path):
+        os.remove(tmp_path)
+        os.link(blob, tmp_path)
+    try:
+        atomic_replace(path, link_blob)
+    except OSError:
+        return None  # e.g. the blob reached the filesystem's link limit
+    return 'linked'
+
+def intern_tree(root_path):
+    """Intern every source file under root_path; returns counts and the bytes saved"""
+    stats = {'stored': 0, 'linked': 0, 'saved_bytes': 0}
+    for root, dirs, files in os.walk(root_path):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for file in files:
+            if file.startswith('.') or is_build_artifact(file) or is_output_pdf(file, files):
+                continue
+            path = os.path.join(root, file)
+            result = intern_file(path)
+            if result:
+                stats[result] += 1
+                if result == 'linked':
+                    stats['saved_bytes'] += os.path.getsize(path)
+    return stats
+
+def collect_blob_garbage():
+    """Remove blobs no project links to any more; returns the bytes freed"""
+    freed = 0
+    blob_root = os.path.join(UPLOAD_FOLDER, '.blobs')
+    if not os.path.isdir(blob_root):
+        return 0
+    for prefix in os.listdir(blob_root):
+        prefix_dir = os.path.join(blob_root, prefix)
+        for name in os.listdir(prefix_dir):
+            path = os.path.join(prefix_dir, name)
+            try:
+                stat_result = os.stat(path)
+                if stat_result.st_nlink == 1:
+                    os.remove(path)
+                    freed += stat_result.st_size
+            except OSError:
+                continue
+    return freed
+
+class CompileWorkerError(Exception):
+    """A compile worker could not take or finish a build; another one may"""
+    
+    def __init__(self, message, unreachable=False):
+        super().__init__(message)
+        self.unreachable = unreachable
+
+def worker_request(url, data=None, method=None, content_type='application/json', timeout=30):
+    """Send an HTTP request to a compile worker and return (status, body bytes)"""
+    req = urllib.request.Request(url, data=data, method=method)
+    if data is not None:
+        req.add_header('Content-Type', content_type)
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+    except (urllib.error.URLError, OSError) as e:
+        raise CompileWorkerError(f'{url}: {getattr(e, "reason", e)}', unreachable=True)
+
+def worker_json(url, payload=None, timeout=30):
+    """POST (or GET without payload) JSON to a compile worker; returns (status, object)"""
+    data = json.dumps(payload).encode('utf-8') if payload is not None else None
+    status, body = worker_request(url, data=data, timeout=timeout)
+    try:
+        return status, json.loads(body)
+    except ValueError:
+        raise CompileWorkerError(f'{url}: invalid response (HTTP {status})')
+
+class CompileWorkerPool:
+    """Compile workers with cached health checks and least-loaded ordering"""
+    
+    def __init__(self, urls):
+        self.urls = [url.rstrip('/') for url in urls]
+        self.lock = threading.Lock()
+        self.health = {}  # url -> (checked_at, health dict or None when down)
+        self.in_flight = {url: 0 for url in self.urls}  # Builds this process has dispatched
+    
+    def check(self, url):
+        with self.lock:
+            entry = self.health.get(url)
+        if entry and time.monotonic() - entry[0] < WORKER_HEALTH_TTL:
+            return entry[1]
+        try:
+            status, info = worker_json(url + '/health', timeout=2)
+            info = info if status == 200 else None
+        except CompileWorkerError:
+            info = None
+        with self.lock:
+            self.health[url] = (time.monotonic(), info)
+        return info
+    
+    def mark_down(self, url):
+        with self.lock:
+            self.health[url] = (time.monotonic(), None)
+    
+    def candidates(self):
+        """Healthy workers, least loaded first; all workers if none looks healthy"""
+        healthy = []
+        for url in self.urls:
+            info = self.check(url)
+            if info is None:
+                continue
+            with self.lock:
+                busy = max(info.get('active', 0), self.in_flight[url])
+            healthy.append((busy / max(1, info.get('capacity', 1)), url))
+        if not healthy:
+            return list(self.urls)  # Health may be stale; let the requests decide
+        return [url for _, url in sorted(healthy)]
+    
+    @contextmanager
+    def dispatch(self, url):
+        with self.lock:
+            self.in_flight[url] += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.in_flight[url] -= 1
+
+class LocalCompileBackend:
+    """Run the build with pdflatex in this process"""
+    
+    def compile(self, project_path, main_file, focus=None, profile='full'):
+        return run_latex_pipeline(main_file, focus, profile, figure_cache_dir(project_path), bib_cache_dir(project_path))
+
+class RemoteCompileBackend:
+    """Run builds on compile_worker.py processes.
+
+    The project is sent as a manifest of path -> sha256; only blobs the worker
+    does not have yet are uploaded. The worker sends back the digests of the
+    PDF, SyncTeX and log files, which are fetched into the project. A worker
+    that is down or busy is skipped and the build is retried on the next one.
+    """
+    
+    def __init__(self, urls):
+        self.pool = CompileWorkerPool(urls)
+    
+    def compile(self, project_path, main_file, focus=None, profile='full'):
+        with trace_span('snapshot_hash'):
+            manifest, blob_paths = project_snapshot(project_path)
+        main = os.path.relpath(main_file, project_path).replace(os.sep, '/')
+        errors = []
+        for url in self.pool.candidates():
+            with self.pool.dispatch(url):
+                try:
+                    return self.compile_on(url, project_path, main, manifest, blob_paths, focus, profile)
+                except CompileWorkerError as e:
+                    if e.unreachable:
+                        self.pool.mark_down(url)
+                    errors.append(str(e))
+        return {'error': 'No compile worker available: ' + ('; '.join(errors) or 'none configured')}, 503
+    
+    def upload_blob(self, url, digest, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        status, body = worker_request(f'{url}/blobs/{digest}', data=data, method='PUT',
+                                      content_type='application/octet-stream')
+        if status not in (200, 201):
+            raise CompileWorkerError(f'{url}: upload of {digest} failed (HTTP {status})')
+    
+    def compile_on(self, url, project_path, main, manifest, blob_paths, focus=None, profile='full'):
+        status, result = worker_json(url + '/blobs/missing', {'blobs': sorted(blob_paths)})
+        if status != 200:
+            raise CompileWorkerError(f'{url}: blob check failed (HTTP {status})')
+        missing = result.get('missing', [])
+        futures = [io_executor.submit(self.upload_blob, url, digest, blob_paths[digest]) for digest in missing]
+        for future in as_completed(futures):
+            future.result()
+        
+        status, result = worker_json(url + '/compile', {
+            'project': os.path.basename(project_path),
+            'main': main,
+            'files': manifest,
+            'focus': focus,
+            'profile': profile,
+        }, timeout=COMPILE_WORKER_TIMEOUT)
+        if status in (409, 503):
+            # Busy, or its blob store changed under us; another worker may do it
+            raise CompileWorkerError(f'{url}: {result.get("error", f"HTTP {status}")}')
+        
+        # Fetch the PDF last so it only shows up once the other outputs are in place
+        artifacts = result.pop('artifacts', {})
+        for kind in ('log', 'synctex', 'pdf'):
+            artifact = artifacts.get(kind)
+            if not artifact:
+                continue
+            target = safe_member_path(project_path, artifact['path'])
+            blob_status, data = worker_request(f'{url}/blobs/{artifact["blob"]}', timeout=60)
+            if target is None or blob_status != 200:
+                raise CompileWorkerError(f'{url}: could not fetch {kind} output (HTTP {blob_status})')
+            
+            def write(tmp_path):
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+            atomic_replace(target, write)
+            if kind == 'synctex':
+                rewrite_synctex_paths(target, result['workdir'], os.path.abspath(project_path))
+            artifacts[kind] = target
+        
+        if result.get('success'):
+            result['pdf_file'] = artifacts['pdf']
+            result['synctex_file'] = artifacts.get('synctex')
+        result.pop('workdir', None)
+        result['worker'] = {'url': url, 'uploaded_blobs': len(missing), 'files': len(manifest)}
+        return result, status
+
+class SnapshotCompileBackend:
+    """Build in a private snapshot of the sources on tmpfs.
+
+    The project's inputs are copied into a per-project build directory under
+    SNAPSHOT_BUILD_ROOT (binary assets are symlinked instead), pdflatex runs
+    there, and the outputs are published back with atomic renames. Saves that
+    land during a build don't change what is being compiled, and the many
+    small writes of a build stay in RAM. The build directory is kept between
+    builds so aux files are reused.
+    """
+    
+    def compile(self, project_path, main_file, focus=None, profile='full'):
+        build_dir = snapshot_build_dir(project_path)
+        with trace_span('snapshot_copy'):
+            snapshot_sources(project_path, build_dir)
+        payload, status = run_latex_pipeline(os.path.join(build_dir, os.path.relpath(main_file, project_path)),
+                                             focus, profile, figure_cache_dir(project_path), bib_cache_dir(project_path))
+        with trace_span('publish'):
+            published = publish_build_outputs(build_dir, project_path)
+        if payload.get('success'):
+            payload['pdf_file'] = published[payload['pdf_file']]
+            if payload['synctex_file']:
+                payload['synctex_file'] = published[payload['synctex_file']]
+        return payload, status
+
+def snapshot_build_dir(project_path):
+    """Build directory of a project for snapshot builds"""
+    key = hashlib.sha256(os.path.abspath(project_path).encode('utf-8')).hexdigest()[:16]
+    root = app.config.get('SNAPSHOT_BUILD_ROOT', SNAPSHOT_BUILD_ROOT)
+    return os.path.join(root, 'texhandler-builds', key)
+
+def is_build_output(filename, sibling_files):
+    return is_build_artifact(filename) or is_output_pdf(filename, sibling_files)
+
+def snapshot_sources(project_path, build_dir):
+    """Bring build_dir in line with the project's sources.
+
+    Text sources are copied when their size or mtime changed; files the editor
+    never writes (images, fonts, ...) are symlinked. Build outputs in the
+    project only seed the build directory when it has none yet, e.g. after
+    a reboot emptied the tmpfs.
+    """
+    seen = set()
+    for root, dirs, files in os.walk(project_path):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        dst_dir = os.path.join(build_dir, os.path.relpath(root, project_path))
+        os.makedirs(dst_dir, exist_ok=True)
+        for file in files:
+            if file.startswith('.'):
+                continue
+            src_file = os.path.join(root, file)
+            dst_file = os.path.normpath(os.path.join(dst_dir, file))
+            seen.add(dst_file)
+            try:
+                src_stat = os.stat(src_file)
+            except OSError:
+                continue  # Dangling symlink
+            if is_build_output(file, files):
+                if not os.path.lexists(dst_file):
+                    shutil.copy2(src_file, dst_file)
+                continue
+            if os.path.splitext(file)[1].lower() in SNAPSHOT_LINK_EXTENSIONS:
+                link_target = os.path.abspath(src_file)
+                if not (os.path.islink(dst_file) and os.readlink(dst_file) == link_target):
+                    if os.path.lexists(dst_file):
+                        os.remove(dst_file)
+                    os.symlink(link_target, dst_file)
+                continue
+            if files_match(src_file, dst_file, src_stat, verify_hash=False) and not os.path.islink(dst_file):
+                continue
+            if os.path.lexists(dst_file):
+                os.remove(dst_file)  # Files interned by older versions may be read-only
+            shutil.copy2(src_file, dst_file)
+    
+    # Drop sources that were deleted from the project
+    for root, dirs, files in os.walk(build_dir):
+        dirs[:] = [d for d in dirs if d != TIKZ_EXTERNAL_DIR]
+        for file in files:
+            dst_file = os.path.normpath(os.path.join(root, file))
+            if dst_file not in seen and not is_build_output(file, files):
+                os.remove(dst_file)
+
+def publish_build_outputs(build_dir, project_path):
+    """Copy changed build outputs back into the project, each with an atomic rename.
+
+    The PDFs go last, so a viewer that sees a new PDF also finds the matching
+    SyncTeX file. Returns a map of build directory path -> project path.
+    """
+    outputs = []
+    for root, dirs, files in os.walk(build_dir):
+        dirs[:] = [d for d in dirs if d != TIKZ_EXTERNAL_DIR]  # Figures stay in the build directory
+        for file in files:
+            path = os.path.join(root, file)
+            if is_build_output(file, files) and not os.path.islink(path):
+                outputs.append(path)
+    outputs.sort(key=lambda path: path.lower().endswith('.pdf'))
+    
+    published = {}
+    for path in outputs:
+        target = os.path.join(project_path, os.path.relpath(path, build_dir))
+        published[path] = target
+        if files_match(path, target, os.stat(path), verify_hash=False):
+            continue
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        atomic_replace(target, lambda tmp_path: shutil.copy2(path, tmp_path))
+        if path.endswith('.synctex.gz'):
+            rewrite_synctex_paths(target, build_dir, os.path.abspath(project_path))
+    return published
+
+local_compile_backend = LocalCompileBackend()
+snapshot_compile_backend = SnapshotCompileBackend()
+remote_compile_backends = {}  # Tuple of worker URLs -> RemoteCompileBackend (keeps health state)
+remote_compile_backends_lock = threading.Lock()
+
+def compile_backend():
+    """Backend selected by the COMPILE_BACKEND setting"""
+    kind = app.config.get('COMPILE_BACKEND', COMPILE_BACKEND)
+    if kind == 'snapshot':
+        return snapshot_compile_backend
+    if kind != 'remote':
+        return local_compile_backend
+    urls = tuple(app.config.get('COMPILE_WORKERS', COMPILE_WORKERS))
+    with remote_compile_backends_lock:
+        backend = remote_compile_backends.get(urls)
+        if backend is None:
+            backend = remote_compile_backends[urls] = RemoteCompileBackend(urls)
+    return backend
 
 @app.route('/api/pdf/<project_name>/<path:pdf_path>')
 def get_pdf(project_name, pdf_path):
@@ -838,6 +3503,8 @@ def get_synctex(project_name, synctex_path):
     return send_file(full_path, mimetype='application/gzip')
 
 @app.route('/api/synctex/<project_name>/resolve', methods=['POST'])
+@admission_controlled('synctex')
+@observe_duration(SYNCTEX_SECONDS, direction='forward')
 def resolve_synctex(project_name, synctex_path=None):
     """Resolve PDF coordinates to source file and line number using synctex command"""
     import subprocess
@@ -872,13 +3539,14 @@ def resolve_synctex(project_name, synctex_path=None):
         # Use synctex command-line tool if available
         # Format: synctex edit -o <page>:<x>:<y>:<pdf> <synctex>
         try:
-            result = subprocess.run(
-                ['synctex', 'edit', '-o', f'{page}:{x}:{y}:{pdf_file}', synctex_file],
-                cwd=project_path,
-                capture_output=True,
-                text=True,
-                timeout=5
-            )
+            with trace_span('synctex'):
+                result = subprocess.run(
+                    ['synctex', 'edit', '-o', f'{page}:{x}:{y}:{pdf_file}', synctex_file],
+                    cwd=project_path,
+                    capture_output=True,
+                    text=True,
+                    timeout=5
+                )
             
             if result.returncode == 0 and result.stdout:
                 # Parse output: Input:1:filename.tex
@@ -989,6 +3657,8 @@ def resolve_synctex(project_name, synctex_path=None):
         return jsonify({'error': f'Failed to parse SyncTeX: {str(e)}'}), 500
 
 @app.route('/api/synctex/<project_name>/resolve_reverse', methods=['POST'])
+@admission_controlled('synctex')
+@observe_duration(SYNCTEX_SECONDS, direction='reverse')
 def resolve_synctex_reverse(project_name):
     """Resolve source file and line to PDF coordinates (for editor to PDF mapping)"""
     import subprocess
@@ -1046,13 +3716,14 @@ def resolve_synctex_reverse(project_name):
                 input_num = 1  # Default
             
             # Use synctex view command
-            result = subprocess.run(
-                ['synctex', 'view', '-i', f'{line}:{column}:{input_num}:{full_file_path}', '-o', pdf_file],
-                cwd=project_path,
-                capture_output=True,
-                text=True,
-                timeout=5
-            )
+            with trace_span('synctex'):
+                result = subprocess.run(
+                    ['synctex', 'view', '-i', f'{line}:{column}:{input_num}:{full_file_path}', '-o', pdf_file],
+                    cwd=project_path,
+                    capture_output=True,
+                    text=True,
+                    timeout=5
+                )
             
             if result.returncode == 0 and result.stdout:
                 # Parse output: Page:1
@@ -1081,43 +3752,1569 @@ def resolve_synctex_reverse(project_name):
     except Exception as e:
         return jsonify({'error': f'Failed to parse SyncTeX: {str(e)}'}), 500
 
+# Page previews: the pages of a compiled PDF are rasterized with pdftoppm into
+# small PNGs named after a fingerprint of what is drawn on each page, so pages
+# that did not change are never rendered again and the viewer can show them
+# before PDF.js has drawn anything
+PAGE_PREVIEWS_ENABLED = True
+PAGE_THUMBNAIL_WIDTH = 160  # Pixels
+PAGE_PREVIEW_DPI = 54  # 0.75 pixels per point; the viewer stretches it to the page size
+PAGE_RENDER_BATCH = 16  # Pages rasterized by one pdftoppm process
+PAGE_RENDER_TIMEOUT = 120  # Seconds for one pdftoppm process
+PAGE_IMAGE_KINDS = ('thumb', 'preview')
+app.config['PAGE_PREVIEWS_ENABLED'] = PAGE_PREVIEWS_ENABLED
+
+PDF_OBJECT_RE = re.compile(rb'(\d+)\s+(\d+)\s+obj\b')
+PDF_REF_RE = re.compile(rb'(\d+)\s+(\d+)\s+R(?![^\s()<>\[\]{}/%])')
+PDF_TOKEN_RE = re.compile(rb'[^\s()<>\[\]{}/%]+')
+PDF_WHITESPACE_RE = re.compile(rb'(?:\s|%[^\r\n]*)*')
+PDF_STREAM_RE = re.compile(rb'\s*stream\r?\n')
+PDF_SUBSET_PREFIX_RE = re.compile(r'^[A-Z]{6}\+')
+# Keys that change when other pages use more glyphs of a subset font, but not
+# how the glyphs already on a page look
+PDF_FINGERPRINT_SKIP_KEYS = {'Parent', 'FontFile', 'FontFile2', 'FontFile3', 'CharSet', 'CIDSet',
+                             'Widths', 'W', 'FirstChar', 'LastChar', 'ToUnicode'}
+PAGE_IMAGE_NAME_RE = re.compile(r'^[0-9a-f]{64}-(thumb|preview)\.png$')
+
+class PdfName(str):
+    """A /Name, told apart from strings (which are bytes)"""
+
+PdfRef = namedtuple('PdfRef', ('num', 'gen'))
+
+class PdfStream:
+    def __init__(self, attrs, raw):
+        self.attrs = attrs
+        self.raw = raw
+    
+    def decoded(self):
+        filters = self.attrs.get('Filter')
+        if filters == 'FlateDecode' or filters == ['FlateDecode']:
+            return zlib.decompress(self.raw)
+        return self.raw  # Other filters are hashed as they are
+
+class PdfReader:
+    """Just enough of a PDF parser to walk the page tree of pdfTeX/XeTeX/LuaTeX output.
+
+    Objects are found by scanning for "N G obj" rather than through the xref
+    table, and members of object streams are read as well.
+    """
+    
+    def __init__(self, data):
+        self.data = data
+        self.objects = {}
+        self.digests = {}
+        self.scan()
+    
+    def scan(self):
+        data = self.data
+        pos = 0
+        object_streams = []
+        while True:
+            match = PDF_OBJECT_RE.search(data, pos)
+            if not match:
+                break
+            try:
+                value, pos = self.parse(match.end())
+                value, pos = self.read_stream(value, pos)
+            except (ValueError, IndexError):
+                pos = match.end()
+                continue
+            self.objects[int(match.group(1))] = value
+            if isinstance(value, PdfStream) and value.attrs.get('Type') == 'ObjStm':
+                object_streams.append(value)
+        
+        for stream in object_streams:
+            content = stream.decoded()
+            first = stream.attrs['First']
+            header = content[:first].split()
+            for i in range(0, 2 * stream.attrs['N'], 2):
+                num = int(header[i])
+                if num not in self.objects:
+                    self.objects[num] = self.parse(first + int(header[i + 1]), content)[0]
+    
+    def read_stream(self, attrs, pos):
+        """Turn a dictionary followed by stream data into a PdfStream"""
+        match = PDF_STREAM_RE.match(self.data, pos)
+        if not isinstance(attrs, dict) or not match:
+            return attrs, pos
+        start = match.end()
+        length = attrs.get('Length')
+        if isinstance(length, int) and self.data.startswith(
+                b'endstream', PDF_WHITESPACE_RE.match(self.data, start + length).end()):
+            end = start + length
+        else:
+            end = self.data.index(b'endstream', start)  # Length is indirect or wrong
+            while end > start and self.data[end - 1] in b'\r\n':
+                end -= 1
+        return PdfStream(attrs, self.data[start:end]), self.data.index(b'endstream', end) + len(b'endstream')
+    
+    def parse(self, pos, data=None):
+        """Parse the value at pos, returning (value, position after it)"""
+        data = self.data if data is None else data
+        pos = PDF_WHITESPACE_RE.match(data, pos).end()
+        char = data[pos:pos + 1]
+        if data.startswith(b'<<', pos):
+            result = {}
+            pos += 2
+            while True:
+                pos = PDF_WHITESPACE_RE.match(data, pos).end()
+                if data.startswith(b'>>', pos):
+                    return result, pos + 2
+                key, pos = self.parse(pos, data)
+                if not isinstance(key, PdfName):
+                    raise ValueError('Dictionary key is not a name')
+                result[key], pos = self.parse(pos, data)
+        if char == b'[':
+            result = []
+            pos += 1
+            while True:
+                pos = PDF_WHITESPACE_RE.match(data, pos).end()
+                if data.startswith(b']', pos):
+                    return result, pos + 1
+                value, pos = self.parse(pos, data)
+                result.append(value)
+        if char == b'<':
+            end = data.index(b'>', pos)
+            return bytes.fromhex(re.sub(rb'\s', b'', data[pos + 1:end]).decode('ascii')), end + 1
+        if char == b'(':
+            depth = 0
+            end = pos
+            while True:
+                byte = data[end]
+                if byte == 0x5c:  # Backslash escapes the next byte
+                    end += 2
+                    continue
+                if byte == 0x28:
+                    depth += 1
+                elif byte == 0x29:
+                    depth -= 1
+                    if depth == 0:
+                        return data[pos + 1:end], end + 1
+                end += 1
+        if char == b'/':
+            match = PDF_TOKEN_RE.match(data, pos + 1)
+            name = match.group() if match else b''
+            name = re.sub(rb'#([0-9A-Fa-f]{2})', lambda m: bytes([int(m.group(1), 16)]), name)
+            return PdfName(name.decode('latin-1')), pos + 1 + len(match.group() if match else b'')
+        match = PDF_REF_RE.match(data, pos)
+        if match:
+            return PdfRef(int(match.group(1)), int(match.group(2))), match.end()
+        match = PDF_TOKEN_RE.match(data, pos)
+        if not match:
+            raise ValueError(f'Unexpected byte at {pos}')
+        token = match.group()
+        if token in (b'true', b'false'):
+            return token == b'true', match.end()
+        if token == b'null':
+            return None, match.end()
+        try:
+            return (float(token) if b'.' in token else int(token)), match.end()
+        except ValueError:
+            raise ValueError(f'Unknown token {token[:20]!r}') from None
+    
+    def resolve(self, value):
+        while isinstance(value, PdfRef):
+            value = self.objects.get(value.num)
+        return value
+    
+    def pages(self):
+        """Page dictionaries in document order, with inherited attributes filled in"""
+        catalog = next((value for value in self.objects.values()
+                        if isinstance(value, dict) and value.get('Type') == 'Catalog'), None)
+        if catalog is None:
+            raise ValueError('No document catalog')
+        pages = []
+        stack = [(self.resolve(catalog.get('Pages')), {})]
+        seen = set()
+        while stack:
+            node, inherited = stack.pop()
+            if not isinstance(node, dict) or id(node) in seen:
+                continue
+            seen.add(id(node))
+            attrs = dict(inherited)
+            for key in ('Resources', 'MediaBox', 'CropBox', 'Rotate'):
+                if key in node:
+                    attrs[key] = node[key]
+            kids = self.resolve(node.get('Kids'))
+            if isinstance(kids, list):
+                stack.extend((self.resolve(kid), attrs) for kid in reversed(kids))
+            else:
+                page = dict(node)
+                page.update(attrs)
+                pages.append(page)
+        return pages
+    
+    def digest(self, value, visiting=()):
+        """Stable hash of a value with references replaced by what they point to"""
+        if isinstance(value, PdfRef):
+            if value.num in self.digests:
+                return self.digests[value.num]
+            if value.num in visiting:
+                return b'cycle'
+            result = self.digest(self.objects.get(value.num), visiting + (value.num,))
+            self.digests[value.num] = result
+            return result
+        hasher = hashlib.sha256()
+        if isinstance(value, PdfStream):
+            hasher.update(b'stream' + self.digest(value.attrs, visiting) + hashlib.sha256(value.raw).digest())
+        elif isinstance(value, dict):
+            hasher.update(b'dict')
+            for key in sorted(value):
+                if key not in PDF_FINGERPRINT_SKIP_KEYS:
+                    hasher.update(key.encode('latin-1') + b'\0' + self.digest(value[key], visiting))
+        elif isinstance(value, list):
+            hasher.update(b'list')
+            for item in value:
+                hasher.update(self.digest(item, visiting))
+        elif isinstance(value, PdfName):
+            hasher.update(b'name' + PDF_SUBSET_PREFIX_RE.sub('', value).encode('latin-1'))
+        else:
+            hasher.update(repr(value).encode('latin-1', 'replace'))
+        return hasher.digest()
+    
+    def page_fingerprint(self, page):
+        hasher = hashlib.sha256()
+        for key in ('MediaBox', 'CropBox', 'Rotate', 'Resources'):
+            hasher.update(key.encode('ascii') + self.digest(page.get(key)))
+        contents = self.resolve(page.get('Contents'))
+        for stream in contents if isinstance(contents, list) else [contents]:
+            stream = self.resolve(stream)
+            if isinstance(stream, PdfStream):
+                hasher.update(stream.decoded())
+        return hasher.hexdigest()
+    
+    def page_size(self, page):
+        """Width and height of a page in points, after rotation"""
+        box = [self.resolve(v) for v in self.resolve(page.get('CropBox') or page.get('MediaBox')) or [0, 0, 612, 792]]
+        width, height = abs(box[2] - box[0]), abs(box[3] - box[1])
+        if (self.resolve(page.get('Rotate')) or 0) % 180:
+            width, height = height, width
+        return round(width, 2), round(height, 2)
+
+def read_page_fingerprints(pdf_file):
+    """[{fingerprint, width, height}] for each page, or [] if the PDF cannot be parsed"""
+    with trace_span('file_read'):
+        with open(pdf_file, 'rb') as f:
+            data = f.read()
+    try:
+        reader = PdfReader(data)
+        return [dict(zip(('width', 'height'), reader.page_size(page)), fingerprint=reader.page_fingerprint(page))
+                for page in reader.pages()]
+    except (ValueError, KeyError, IndexError, TypeError, zlib.error, RecursionError):
+        return []
+
+page_jobs_pending = set()  # (job, project, pdf path) queued but not started yet
+page_jobs_pending_lock = threading.Lock()
+
+def page_previews_available():
+    return app.config.get('PAGE_PREVIEWS_ENABLED', PAGE_PREVIEWS_ENABLED) and shutil.which('pdftoppm') is not None
+
+def page_image_path(project_name, fingerprint, kind):
+    return cache_path('pages', project_name, f'{fingerprint}-{kind}.png')
+
+def page_manifest(project_name, pdf_path):
+    """Fingerprints of the pages of a project's PDF, reread only when the PDF changed"""
+    full_path = os.path.join(UPLOAD_FOLDER, project_name, pdf_path)
+    stat_result = os.stat(full_path)
+    manifest_file = cache_path('pages', project_name, 'manifest.json')
+    try:
+        with open(manifest_file, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+    
+    entry = manifest.get(pdf_path)
+    version = [stat_result.st_mtime_ns, stat_result.st_size]
+    cache_lookup('page_manifest', entry is not None and entry['version'] == version)
+    if entry is None or entry['version'] != version:
+        manifest = {path: other for path, other in manifest.items()
+                    if os.path.exists(os.path.join(UPLOAD_FOLDER, project_name, path))}
+        entry = manifest[pdf_path] = {'version': version, 'pages': read_page_fingerprints(full_path)}
+        os.makedirs(os.path.dirname(manifest_file), exist_ok=True)
+        atomic_write_text(manifest_file, json.dumps(manifest))
+    return entry['pages'], manifest
+
+def run_page_batches(page_numbers, run):
+    """Call run(batch) for runs of up to PAGE_RENDER_BATCH consecutive pages in
+    parallel, merging the {page number: result} dicts they return"""
+    batches = []
+    for number in sorted(page_numbers):
+        if batches and batches[-1][-1] == number - 1 and len(batches[-1]) < PAGE_RENDER_BATCH:
+            batches[-1].append(number)
+        else:
+            batches.append([number])
+    
+    results = {}
+    with ThreadPoolExecutor(max_workers=min(len(batches), os.cpu_count() or 1) or 1) as pool:
+        for future in as_completed([pool.submit(run, batch) for batch in batches]):
+            try:
+                results.update(future.result())
+            except (OSError, subprocess.SubprocessError):
+                continue  # Those pages are tried again after the next compile
+    return results
+
+def rasterize_pages(pdf_file, page_numbers, kind, out_dir):
+    """Render pages with pdftoppm, returning {page number: png path}"""
+    size_args = ['-scale-to', str(PAGE_THUMBNAIL_WIDTH)] if kind == 'thumb' else ['-r', str(PAGE_PREVIEW_DPI)]
+    
+    def render(batch):
+        prefix = os.path.join(out_dir, f'{kind}-{batch[0]}')
+        with trace_span('pdftoppm'):
+            subprocess.run(['pdftoppm', '-png', *size_args, '-f', str(batch[0]), '-l', str(batch[-1]), pdf_file, prefix],
+                           capture_output=True, timeout=PAGE_RENDER_TIMEOUT, check=True)
+        # pdftoppm zero-pads the page number to the width of the page count
+        return {int(name.rsplit('-', 1)[1][:-4]): os.path.join(out_dir, name)
+                for name in os.listdir(out_dir) if name.startswith(os.path.basename(prefix) + '-')}
+    
+    return run_page_batches(page_numbers, render)
+
+@contextmanager
+def stable_pdf_copy(project_name, pdf_path):
+    """Yield (pages, manifest, path of a copy of the PDF) for work on a PDF's pages.
+
+    Tools run on a copy, so a compile that replaces the PDF meanwhile cannot mix
+    pages of two builds under the fingerprints in the manifest. Yields None when
+    the PDF is gone or was replaced before it was copied; the job queued by that
+    compile picks it up.
+    """
+    full_path = os.path.join(UPLOAD_FOLDER, project_name, pdf_path)
+    if not os.path.exists(full_path):
+        yield None
+        return
+    pages, manifest = page_manifest(project_name, pdf_path)
+    work_root = cache_path('pages', project_name)
+    os.makedirs(work_root, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=work_root) as work_dir:
+        pdf_copy = os.path.join(work_dir, 'document.pdf')
+        shutil.copyfile(full_path, pdf_copy)
+        yield (pages, manifest, pdf_copy) if read_page_fingerprints(pdf_copy) == pages else None
+
+def drop_unused_page_files(directory, name_re, manifest):
+    """Remove cached per-page files whose fingerprint no PDF of the project has anymore"""
+    wanted = {page['fingerprint'] for entry in manifest.values() for page in entry['pages']}
+    for name in os.listdir(directory):
+        if name_re.match(name) and name[:64] not in wanted:
+            os.remove(os.path.join(directory, name))
+
+def render_page_previews(project_name, pdf_path):
+    """Rasterize the pages of a PDF that have no images yet and drop images of
+    pages that no longer exist. Returns the number of images rendered."""
+    with named_lock(project_name + '.pages'), stable_pdf_copy(project_name, pdf_path) as snapshot:
+        if snapshot is None:
+            return 0
+        pages, manifest, pdf_copy = snapshot
+        rendered = 0
+        for kind in PAGE_IMAGE_KINDS:
+            missing = {number: page['fingerprint'] for number, page in enumerate(pages, 1)
+                       if not os.path.exists(page_image_path(project_name, page['fingerprint'], kind))}
+            if not missing:
+                continue
+            for number, png_file in rasterize_pages(pdf_copy, missing, kind, os.path.dirname(pdf_copy)).items():
+                if number in missing:
+                    os.replace(png_file, page_image_path(project_name, missing[number], kind))
+                    rendered += 1
+        drop_unused_page_files(cache_path('pages', project_name), PAGE_IMAGE_NAME_RE, manifest)
+        return rendered
+
+def schedule_page_job(job, project_name, pdf_path):
+    """Queue job(project_name, pdf_path) on the I/O pool unless it is queued already"""
+    key = (job.__name__, project_name, pdf_path)
+    with page_jobs_pending_lock:
+        if key in page_jobs_pending:
+            return
+        page_jobs_pending.add(key)
+    
+    def run():
+        with page_jobs_pending_lock:
+            page_jobs_pending.discard(key)
+        return job(project_name, pdf_path)
+    io_executor.submit(run)
+
+def schedule_page_jobs(project_name, pdf_path):
+    """Start the per-page work for a freshly built PDF in the background"""
+    if page_previews_available():
+        schedule_page_job(render_page_previews, project_name, pdf_path)
+    if page_text_available():
+        schedule_page_job(index_page_text, project_name, pdf_path)
+
+@app.route('/api/pages/<project_name>/<path:pdf_path>')
+def list_page_previews(project_name, pdf_path):
+    """Page sizes and, where they are ready, thumbnail and preview image URLs"""
+    project_path = os.path.join(UPLOAD_FOLDER, project_name)
+    full_path = os.path.join(project_path, pdf_path)
+    
+    # Security check
+    if not os.path.abspath(full_path).startswith(os.path.abspath(project_path)):
+        return jsonify({'error': 'Invalid path'}), 400
+    
+    if not os.path.exists(full_path):
+        return jsonify({'error': 'PDF not found'}), 404
+    
+    pdf_path = os.path.relpath(full_path, project_path).replace(os.sep, '/')
+    pages, manifest = page_manifest(project_name, pdf_path)
+    available = page_previews_available()
+    result = []
+    pending = False
+    for number, page in enumerate(pages, 1):
+        entry = {'page': number, 'width': page['width'], 'height': page['height'], 'fingerprint': page['fingerprint']}
+        for kind in PAGE_IMAGE_KINDS:
+            name = f"{page['fingerprint']}-{kind}.png"
+            ready = os.path.exists(page_image_path(project_name, page['fingerprint'], kind))
+            entry[kind] = f'/api/page_image/{project_name}/{name}' if ready else None
+            pending = pending or not ready
+        result.append(entry)
+    if pending and available:
+        schedule_page_job(render_page_previews, project_name, pdf_path)
+    return jsonify({'available': available, 'pending': pending and available, 'pages': result})
+
+@app.route('/api/page_image/<project_name>/<name>')
+def get_page_image(project_name, name):
+    """A rendered page image; its name is a content fingerprint, so it never changes"""
+    if not PAGE_IMAGE_NAME_RE.match(name) or project_name.startswith('.') or '/' in project_name:
+        return jsonify({'error': 'Invalid image name'}), 400
+    full_path = cache_path('pages', project_name, name)
+    if not os.path.exists(full_path):
+        return jsonify({'error': 'Image not found'}), 404
+    response = send_file(full_path, mimetype='image/png', max_age=ASSET_MAX_AGE, conditional=True)
+    response.headers['Cache-Control'] = f'private, max-age={ASSET_MAX_AGE}, immutable'
+    return response
+
+# Page text index: pdftotext extracts the words of each page with their boxes
+# once per page fingerprint, and searches run over the cached words
+PAGE_TEXT_INDEX_ENABLED = True
+PAGE_TEXT_CACHE_SIZE = 5000  # Pages of extracted words kept in memory
+PDF_SEARCH_MAX_RESULTS = 1000
+PDF_SEARCH_MAX_QUERY = 500  # Characters
+PDF_SEARCH_MAX_TEXT = 4 * 1024 * 1024  # Characters of page text scanned per query
+PDF_SEARCH_REGEX_TIMEOUT = 2.0  # Seconds a user regex may run; it runs in a child process that is killed after that
+# Reads {pattern, flags, texts, limit} and prints [text index, start, end] of non-empty matches
+PDF_REGEX_SEARCH_SCRIPT = """
+import json, re, sys
+job = json.load(sys.stdin)
+pattern = re.compile(job['pattern'], job['flags'])
+spans = []
+for index, text in enumerate(job['texts']):
+    for match in pattern.finditer(text):
+        if match.end() > match.start():
+            spans.append([index, match.start(), match.end()])
+        if len(spans) > job['limit']:
+            break
+    if len(spans) > job['limit']:
+        break
+json.dump(spans, sys.stdout)
+"""
+app.config['PAGE_TEXT_INDEX_ENABLED'] = PAGE_TEXT_INDEX_ENABLED
+
+PDFTOTEXT_BBOX_RE = re.compile(
+    r'<(page)\b|<(line)\b|<word xMin="([-\d.]+)" yMin="([-\d.]+)" xMax="([-\d.]+)" yMax="([-\d.]+)">(.*?)</word>', re.S)
+PAGE_TEXT_NAME_RE = re.compile(r'^[0-9a-f]{64}\.json$')
+page_text_cache = OrderedDict()  # (project, fingerprint) -> (text, word start offsets, words)
+page_text_cache_lock = threading.Lock()
+
+def page_text_available():
+    return app.config.get('PAGE_TEXT_INDEX_ENABLED', PAGE_TEXT_INDEX_ENABLED) and shutil.which('pdftotext') is not None
+
+def page_text_path(project_name, fingerprint):
+    return cache_path('pagetext', project_name, fingerprint + '.json')
+
+def extract_page_words(pdf_file, batch):
+    """{page number: [[word, x0, y0, x1, y1, line], ...]} for a run of pages.
+
+    Boxes are in points from the top left corner of the page; line numbers
+    count the lines of the page in reading order.
+    """
+    with trace_span('pdftotext'):
+        result = subprocess.run(['pdftotext', '-bbox-layout', '-f', str(batch[0]), '-l', str(batch[-1]), pdf_file, '-'],
+                                capture_output=True, timeout=PAGE_RENDER_TIMEOUT, check=True)
+    pages = []
+    line = -1
+    for match in PDFTOTEXT_BBOX_RE.finditer(result.stdout.decode('utf-8', 'replace')):
+        if match.group(1):
+            pages.append([])
+            line = -1
+        elif match.group(2):
+            line += 1
+        elif pages:
+            pages[-1].append([html.unescape(match.group(7)), *(float(v) for v in match.group(3, 4, 5, 6)), line])
+    return dict(zip(batch, pages))
+
+def index_page_text(project_name, pdf_path):
+    """Extract the words of the pages of a PDF that are not indexed yet and drop
+    the text of pages that no longer exist. Returns the number of pages indexed."""
+    with named_lock(project_name + '.pages'), stable_pdf_copy(project_name, pdf_path) as snapshot:
+        if snapshot is None:
+            return 0
+        pages, manifest, pdf_copy = snapshot
+        missing = {number: page['fingerprint'] for number, page in enumerate(pages, 1)
+                   if not os.path.exists(page_text_path(project_name, page['fingerprint']))}
+        text_dir = cache_path('pagetext', project_name)
+        os.makedirs(text_dir, exist_ok=True)
+        indexed = 0
+        if missing:
+            for number, words in run_page_batches(missing, lambda batch: extract_page_words(pdf_copy, batch)).items():
+                if number in missing:
+                    atomic_write_text(page_text_path(project_name, missing[number]), json.dumps(words))
+                    indexed += 1
+        drop_unused_page_files(text_dir, PAGE_TEXT_NAME_RE, manifest)
+        return indexed
+
+def load_page_text(project_name, fingerprint):
+    """(text, word start offsets, words) of an indexed page, or None if it is not indexed"""
+    key = (project_name, fingerprint)
+    with page_text_cache_lock:
+        entry = page_text_cache.get(key)
+        if entry is not None:
+            page_text_cache.move_to_end(key)
+            return entry
+    try:
+        with open(page_text_path(project_name, fingerprint), 'r', encoding='utf-8') as f:
+            words = json.load(f)
+    except (OSError, ValueError):
+        return None
+    
+    # Words are joined with single spaces, so a phrase matches across words and lines
+    starts = []
+    offset = 0
+    for word in words:
+        starts.append(offset)
+        offset += len(word[0]) + 1
+    entry = (' '.join(word[0] for word in words), starts, words)
+    with page_text_cache_lock:
+        page_text_cache[key] = entry
+        while len(page_text_cache) > PAGE_TEXT_CACHE_SIZE:
+            page_text_cache.popitem(last=False)
+    return entry
+
+def match_rects(words, starts, start, end):
+    """Boxes covering text[start:end] of a page, one per line; partly matched
+    words are cut in proportion to the matched characters"""
+    rects = []
+    i = max(bisect.bisect_right(starts, start) - 1, 0)
+    while i < len(words) and starts[i] < end:
+        text, x0, y0, x1, y1, line = words[i]
+        lo = max(start - starts[i], 0)
+        hi = min(end - starts[i], len(text))
+        if hi > lo:
+            char_width = (x1 - x0) / len(text)
+            left, right = x0 + lo * char_width, x0 + hi * char_width
+            if rects and rects[-1][4] == line:
+                rects[-1][1] = min(rects[-1][1], y0)
+                rects[-1][2] = right
+                rects[-1][3] = max(rects[-1][3], y1)
+            else:
+                rects.append([left, y0, right, y1, line])
+        i += 1
+    return [[round(value, 2) for value in rect[:4]] for rect in rects]
+
+@app.route('/api/pdf_search/<project_name>/<path:pdf_path>')
+@admission_controlled('search')
+def search_pdf_text(project_name, pdf_path):
+    """Find a literal or regex query in a PDF, returning pages and match boxes"""
+    project_path = os.path.join(UPLOAD_FOLDER, project_name)
+    full_path = os.path.join(project_path, pdf_path)
+    
+    # Security check
+    if not os.path.abspath(full_path).startswith(os.path.abspath(project_path)):
+        return jsonify({'error': 'Invalid path'}), 400
+    
+    if not os.path.exists(full_path):
+        return jsonify({'error': 'PDF not found'}), 404
+    
+    query = request.args.get('q', '')
+    if not query or len(query) > PDF_SEARCH_MAX_QUERY:
+        return jsonify({'error': f'Query must have 1 to {PDF_SEARCH_MAX_QUERY} characters'}), 400
+    flags = 0 if request.args.get('case') == '1' else re.IGNORECASE
+    try:
+        pattern = re.compile(query if request.args.get('regex') == '1' else re.escape(query), flags)
+    except re.error as e:
+        return jsonify({'error': f'Invalid regular expression: {e}'}), 400
+    
+    pdf_path = os.path.relpath(full_path, project_path).replace(os.sep, '/')
+    pages, manifest = page_manifest(project_name, pdf_path)
+    available = page_text_available()
+    indexed_pages = []
+    missing = 0
+    scanned = 0
+    truncated = False
+    for number, page in enumerate(pages, 1):
+        indexed = load_page_text(project_name, page['fingerprint'])
+        if indexed is None:
+            missing += 1
+            continue
+        scanned += len(indexed[0])
+        if scanned > PDF_SEARCH_MAX_TEXT:
+            truncated = True
+            break
+        indexed_pages.append((number, indexed))
+    
+    texts = [text for _, (text, _, _) in indexed_pages]
+    if request.args.get('regex') == '1':
+        try:
+            spans = regex_search_spans(pattern, texts, PDF_SEARCH_MAX_RESULTS)
+        except subprocess.TimeoutExpired:
+            return jsonify({'error': 'Regular expression took too long'}), 400
+    else:
+        spans = []
+        for index, text in enumerate(texts):
+            spans.extend([index, *match.span()] for match in pattern.finditer(text))
+            if len(spans) > PDF_SEARCH_MAX_RESULTS:
+                break
+    if len(spans) > PDF_SEARCH_MAX_RESULTS:
+        spans = spans[:PDF_SEARCH_MAX_RESULTS]
+        truncated = True
+    
+    results = []
+    for index, start, end in spans:
+        number, (text, starts, words) = indexed_pages[index]
+        results.append({'page': number, 'text': text[start:end], 'rects': match_rects(words, starts, start, end)})
+    cache_lookup('page_text', not missing)
+    if missing and available:
+        schedule_page_job(index_page_text, project_name, pdf_path)
+    return jsonify({'available': available, 'pending': bool(missing) and available,
+                    'results': results, 'truncated': truncated})
+
+def regex_search_spans(pattern, texts, limit):
+    """Matches of a user regex as [text index, start, end], up to limit + 1 of them.
+
+    Python's re cannot be interrupted, so the search runs in a child process
+    that is killed after PDF_SEARCH_REGEX_TIMEOUT (raises TimeoutExpired).
+    """
+    job = json.dumps({'pattern': pattern.pattern, 'flags': pattern.flags, 'texts': texts, 'limit': limit})
+    result = subprocess.run([sys.executable, '-c', PDF_REGEX_SEARCH_SCRIPT], input=job, capture_output=True,
+                            encoding='utf-8', timeout=PDF_SEARCH_REGEX_TIMEOUT, check=True)
+    return json.loads(result.stdout)
+
+# Citation search: every .bib file of a project is indexed in memory by key and
+# by the words of its authors and titles, validated by (mtime, size)
+BIB_INDEX_CACHE_SIZE = 32  # Parsed .bib files kept in memory
+CITE_SEARCH_MAX_RESULTS = 50
+CITE_SEARCH_MAX_QUERY = 200  # Characters
+BIB_SEARCH_FILTER_SIZE = 500  # Candidates below which further query words are checked entry by entry
+BIB_ENTRY_START_RE = re.compile(rb'(?m)^[ \t]*@')
+BIB_ENTRY_HEAD_RE = re.compile(rb'[ \t]*@[ \t]*([A-Za-z]+)[ \t\r\n]*[{(][ \t\r\n]*([^,\s{}()"#%=]+)[ \t\r\n]*,')
+_BIB_BRACED = rb'\{(?:[^{}]|\{(?:[^{}]|\{(?:[^{}]|\{[^{}]*\})*\})*\})*\}'
+BIB_FIELD_RE = re.compile(
+    rb'[,{(][ \t\r\n]*(author|editor|title|year|date)[ \t\r\n]*=[ \t\r\n]*(' + _BIB_BRACED + rb'|"(?:[^"{}]|' + _BIB_BRACED + rb')*"|[^\s,{}"#]+)',
+    re.IGNORECASE)
+# Accents and commands taking an argument (\emph{...}) are dropped, other commands (\TeX) keep their name
+BIB_TEX_MARKUP_RE = re.compile(r'\\[`\'^"~=.]\s*|\\[A-Za-z]+\s*(?=\{)|\\([A-Za-z]+)\s*|[{}]')
+BIB_WORD_RE = re.compile(r'\w+')
+BIB_SKIPPED_TYPES = {'comment', 'string', 'preamble'}
+bib_index_cache = OrderedDict()  # Absolute path -> ((mtime_ns, size), BibIndex)
+bib_index_lock = threading.Lock()
+
+def bib_field_text(value):
+    """Plain text of a BibTeX field value: delimiters, braces and TeX commands dropped"""
+    value = value.decode('utf-8', 'replace')
+    if value[:1] in '{"' and len(value) > 1:
+        value = value[1:-1]
+    return ' '.join(BIB_TEX_MARKUP_RE.sub(lambda match: match.group(1) or '', value.replace('\\&', '&')).split())
+
+def parse_bib_entry(data):
+    """(key, type, author, title, year) of one entry, or None for @string,
+    @comment, @preamble and text that is not an entry"""
+    head = BIB_ENTRY_HEAD_RE.match(data)
+    if not head or head.group(1).lower().decode('ascii') in BIB_SKIPPED_TYPES:
+        return None
+    fields = {}
+    for match in BIB_FIELD_RE.finditer(data, head.end() - 1):
+        fields.setdefault(match.group(1).lower().decode('ascii'), match.group(2))
+    author = fields.get('author') or fields.get('editor') or b''
+    year = fields.get('year') or fields.get('date') or b''
+    return (head.group(2).decode('utf-8', 'replace'), head.group(1).lower().decode('ascii'),
+            bib_field_text(author), bib_field_text(fields.get('title', b'')), bib_field_text(year)[:4])
+
+class BibIndex:
+    """Entries of a .bib file with a sorted key list and word postings for prefix search.
+
+    Entries are parsed by byte range: an entry runs from an @ at the start of a
+    line to the next one. Building from a previous index of the same file
+    parses only ranges whose bytes changed (matched by length and CRC32).
+    """
+    
+    def __init__(self, path, previous=None, ranges=None):
+        self.path = path
+        self.reparsed = 0
+        # [((length, crc32), entry or None)] in file order; given when loaded from a snapshot
+        self.ranges = self.scan(previous.parsed if previous else {}) if ranges is None else ranges
+        self.parsed = dict(self.ranges)
+        entries = [entry for _, entry in self.ranges if entry]
+        self.entries = entries
+        self.keys = sorted((entry[0].lower(), i) for i, entry in enumerate(entries))
+        # Rank within a tier: newest first, then by key
+        order = sorted(range(len(entries)), key=lambda i: (-int(entries[i][4]) if entries[i][4].isdigit() else 0, entries[i][0].lower()))
+        self.rank = array('I', [0]) * len(entries)
+        for position, i in enumerate(order):
+            self.rank[i] = position
+        self.author_postings = self.build_postings((2,))
+        self.title_postings = self.build_postings((3, 4))
+        self.words = sorted(set(self.author_postings) | set(self.title_postings))
+    
+    def scan(self, reusable):
+        ranges = []
+        with open(self.path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                return ranges
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                starts = [match.start() for match in BIB_ENTRY_START_RE.finditer(mm)]
+                for start, end in zip(starts, starts[1:] + [size]):
+                    data = mm[start:end]
+                    range_key = (end - start, zlib.crc32(data))
+                    if range_key in reusable:
+                        entry = reusable[range_key]
+                    else:
+                        entry = parse_bib_entry(data)
+                        self.reparsed += 1
+                    ranges.append((range_key, entry))
+        return ranges
+    
+    def build_postings(self, fields):
+        postings = {}
+        for i, entry in enumerate(self.entries):
+            for word in set(BIB_WORD_RE.findall(' '.join(entry[field] for field in fields).lower())):
+                postings.setdefault(word, array('I')).append(i)
+        return postings
+    
+    def word_matches(self, prefix):
+        """(entries with an author word starting with prefix, entries with any such word)"""
+        authors = set()
+        matches = set()
+        for position in range(bisect.bisect_left(self.words, prefix), len(self.words)):
+            word = self.words[position]
+            if not word.startswith(prefix):
+                break
+            authors.update(self.author_postings.get(word, ()))
+            matches.update(self.title_postings.get(word, ()))
+        return authors, matches | authors
+    
+    def search(self, query, limit):
+        """Up to limit (tier, rank, entry) matches: keys starting with the query
+        (tier 0), then entries in which every query word starts an author or
+        title word or the year, those with an author match (tier 1) before the
+        rest (tier 2)"""
+        results = []
+        prefix = query.strip().lower()
+        seen = set()
+        for position in range(bisect.bisect_left(self.keys, (prefix,)), len(self.keys)):
+            key, i = self.keys[position]
+            if not key.startswith(prefix) or len(results) >= limit:
+                break
+            results.append((0, self.rank[i], self.entries[i]))
+            seen.add(i)
+        
+        terms = sorted(set(BIB_WORD_RE.findall(prefix)), key=len, reverse=True)
+        if len(terms) > 1:
+            terms = [term for term in terms if len(term) > 1] or terms[:1]  # Single letters match almost everything
+        if len(results) >= limit or not terms:
+            return results
+        candidates = None
+        author_hits = None
+        for term in terms:  # Longest, usually the most selective, first
+            if candidates is not None and len(candidates) <= BIB_SEARCH_FILTER_SIZE:
+                # Few candidates left: checking their words beats merging postings
+                authors = {i for i in candidates if any(word.startswith(term) for word in BIB_WORD_RE.findall(self.entries[i][2].lower()))}
+                candidates = authors | {i for i in candidates - authors
+                                        if any(word.startswith(term) for word in BIB_WORD_RE.findall(f'{self.entries[i][3]} {self.entries[i][4]}'.lower()))}
+            else:
+                authors, matches = self.word_matches(term)
+                candidates = matches if candidates is None else candidates & matches
+            author_hits = authors if author_hits is None else author_hits | authors
+            if not candidates:
+                return results
+        candidates -= seen
+        for tier, members in ((1, candidates & author_hits), (2, candidates - author_hits)):
+            for i in heapq.nsmallest(limit - len(results), members, key=self.rank.__getitem__):
+                results.append((tier, self.rank[i], self.entries[i]))
+        return results
+
+def get_bib_index(full_path, stat_result):
+    """Return the index of a .bib file, reparsing the entries that changed since it was built"""
+    key = os.path.abspath(full_path)
+    version = (stat_result.st_mtime_ns, stat_result.st_size)
+    with bib_index_lock:
+        entry = bib_index_cache.get(key)
+        if entry and entry[0] == version:
+            bib_index_cache.move_to_end(key)
+            cache_lookup('bib_index', hit=True)
+            return entry[1]
+    
+    cache_lookup('bib_index', hit=False)
+    stored = None if entry else snapshot_index_payload('bib', full_path, version)
+    with trace_span('bib_index'):
+        if stored is not None:
+            index = BibIndex(full_path, ranges=decode_bib_ranges(stored))
+        else:
+            index = BibIndex(full_path, entry[1] if entry else None)
+            mark_index_dirty(full_path)
+    with bib_index_lock:
+        bib_index_cache[key] = (version, index)
+        bib_index_cache.move_to_end(key)
+        while len(bib_index_cache) > BIB_INDEX_CACHE_SIZE:
+            bib_index_cache.popitem(last=False)
+    return index
+
+def project_bib_files(project_path):
+    """(path, stat) of each .bib file in a project, outside hidden directories"""
+    bib_files = []
+    for root, dirs, files in os.walk(project_path):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for file in files:
+            if file.lower().endswith('.bib') and not file.startswith('.'):
+                try:
+                    bib_files.append((os.path.join(root, file), os.stat(os.path.join(root, file))))
+                except OSError:
+                    continue  # Dangling symlink
+    return sorted(bib_files)
+
+@app.route('/api/cite_search/<project_name>')
+def search_citations(project_name):
+    """Citation keys of the project's .bib files matching a prefix, best first"""
+    project_path = os.path.join(UPLOAD_FOLDER, project_name)
+    
+    if not os.path.exists(project_path):
+        return jsonify({'error': 'Project not found'}), 404
+    
+    query = request.args.get('q', '')
+    if len(query) > CITE_SEARCH_MAX_QUERY:
+        return jsonify({'error': f'Query must have at most {CITE_SEARCH_MAX_QUERY} characters'}), 400
+    try:
+        limit = min(max(int(request.args.get('limit', 20)), 1), CITE_SEARCH_MAX_RESULTS)
+    except ValueError:
+        return jsonify({'error': 'Invalid limit'}), 400
+    
+    matches = []
+    for full_path, stat_result in project_bib_files(project_path):
+        try:
+            index = get_bib_index(full_path, stat_result)
+        except OSError:
+            continue
+        bib_file = os.path.relpath(full_path, project_path).replace(os.sep, '/')
+        matches.extend((tier, rank, entry, bib_file) for tier, rank, entry in index.search(query, limit))
+    matches.sort(key=lambda match: match[:2])
+    return jsonify({'results': [{'key': key, 'type': entry_type, 'author': author, 'title': title, 'year': year, 'file': bib_file}
+                                for _, _, (key, entry_type, author, title, year), bib_file in matches[:limit]]})
+
+class ZipStream:
+    """Write-only file object that collects zipfile output so it can be streamed.
+
+    zipfile falls back to data descriptors when the target cannot seek, so the
+    archive can be produced front to back without buffering it.
+    """
+    
+    def __init__(self):
+        self.chunks = []
+    
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def collect_download_files(project_path, exclude_artifacts=False):
+    """List (path, arcname, stat) for every file that goes into a project download"""
+    with trace_span('fs_walk'):
+        return walk_download_files(project_path, exclude_artifacts)
+
+def walk_download_files(project_path, exclude_artifacts):
+    entries = []
+    for root, dirs, files in os.walk(project_path):
+        # Skip hidden files and directories, TIKZ_EXTERNAL_DIR among them
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        files = sorted(f for f in files if not f.startswith('.'))
+        
+        for file in files:
+            if exclude_artifacts and (is_build_artifact(file) or is_output_pdf(file, files)):
+                continue
+            file_path = os.path.join(root, file)
+            # Get relative path from project directory
+            arcname = os.path.relpath(file_path, project_path)
+            entries.append((file_path, arcname, os.stat(file_path)))
+    return entries
+
+def project_content_version(entries, *options):
+    """Hash of the file list, sizes and mtimes; changes whenever the download would"""
+    digest = hashlib.sha256(repr(options).encode())
+    for file_path, arcname, stat_result in entries:
+        digest.update(f'{arcname}\0{stat_result.st_size}\0{stat_result.st_mtime_ns}\n'.encode())
+    return digest.hexdigest()[:32]
+
+def generate_project_zip(entries, cache_file=None):
+    """Yield a ZIP archive of `entries` chunk by chunk, optionally teeing it into cache_file.
+
+    The cache file is only published (renamed into place) when the archive was
+    written completely and no file changed while it was being read.
+    """
+    stream = ZipStream()
+    tmp_path = None
+    tmp_file = None
+    if cache_file:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_file), suffix='.tmp')
+        tmp_file = os.fdopen(fd, 'wb')
+    consistent = True
+    
+    def emit():
+        data = stream.drain()
+        if data and tmp_file:
+            tmp_file.write(data)
+        return data
+    
+    try:
+        with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            for file_path, arcname, stat_result in entries:
+                zinfo = zipfile.ZipInfo.from_file(file_path, arcname)
+                zinfo.external_attr |= 0o200 << 16  # Files interned by older versions may be read-only on disk
+                if os.path.splitext(arcname)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+                    zinfo.compress_type = zipfile.ZIP_STORED
+                else:
+                    zinfo.compress_type = zipfile.ZIP_DEFLATED
+                with open(file_path, 'rb') as src, \
+                        zip_file.open(zinfo, 'w', force_zip64=stat_result.st_size > 0x7FFFFFFF) as dst:
+                    while True:
+                        chunk = src.read(256 * 1024)
+                        if not chunk:
+                            break
+                        dst.write(chunk)
+                        data = emit()
+                        if data:
+                            yield data
+                yield emit()
+                current = os.stat(file_path)
+                if (current.st_size, current.st_mtime_ns) != (stat_result.st_size, stat_result.st_mtime_ns):
+                    consistent = False
+        # Central directory
+        yield emit()
+        
+        if tmp_file:
+            tmp_file.close()
+            tmp_file = None
+            if consistent:
+                # Keep only the newest archive per project and variant
+                prefix = os.path.basename(cache_file).rsplit('-', 1)[0] + '-'
+                for old in os.listdir(os.path.dirname(cache_file)):
+                    if old.startswith(prefix) and old.endswith('.zip'):
+                        os.remove(os.path.join(os.path.dirname(cache_file), old))
+                os.replace(tmp_path, cache_file)
+                tmp_path = None
+    finally:
+        if tmp_file:
+            tmp_file.close()
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
 @app.route('/api/download/<project_name>')
+@admission_controlled('download')
 def download_project(project_name):
     project_path = os.path.join(UPLOAD_FOLDER, project_name)
     
     if not os.path.exists(project_path):
         return jsonify({'error': 'Project not found'}), 404
     
-    # Create a temporary zip file
-    import tempfile
-    import io
-    
-    zip_buffer = io.BytesIO()
+    exclude_artifacts = request.args.get('exclude_artifacts', '').lower() in ('1', 'true', 'yes')
     
     try:
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            # Walk through the project directory and add all files
-            for root, dirs, files in os.walk(project_path):
-                # Skip hidden files and directories
-                dirs[:] = [d for d in dirs if not d.startswith('.')]
-                files = [f for f in files if not f.startswith('.')]
-                
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    # Get relative path from project directory
-                    arcname = os.path.relpath(file_path, project_path)
-                    zip_file.write(file_path, arcname)
+        entries = collect_download_files(project_path, exclude_artifacts)
         
-        zip_buffer.seek(0)
+        cache_file = None
+        if app.config.get('ARCHIVE_CACHE_ENABLED', ARCHIVE_CACHE_ENABLED):
+            variant = 'sources' if exclude_artifacts else 'all'
+            version = project_content_version(entries, variant)
+            cache_file = cache_path('archives', project_name, f'{variant}-{version}.zip')
+            # An unchanged project is served straight from the cached archive
+            cache_lookup('download_archive', hit=os.path.exists(cache_file))
+            if os.path.exists(cache_file):
+                return send_file(
+                    cache_file,
+                    mimetype='application/zip',
+                    as_attachment=True,
+                    download_name=f'{project_name}.zip'
+                )
         
-        return send_file(
-            zip_buffer,
-            mimetype='application/zip',
-            as_attachment=True,
-            download_name=f'{project_name}.zip'
-        )
+        response = Response(generate_project_zip(entries, cache_file), mimetype='application/zip')
+        response.headers.set('Content-Disposition', 'attachment', filename=f'{project_name}.zip')
+        return response
     except Exception as e:
         return jsonify({'error': f'Failed to create zip: {str(e)}'}), 500
 
+# Background janitor: when build outputs of all projects together exceed
+# ARTIFACT_DISK_BUDGET, it deletes them from the least recently used projects
+ARTIFACT_DISK_BUDGET = int(os.environ.get('TEXHANDLER_ARTIFACT_BUDGET', 5 * 1024 ** 3))  # Bytes
+JANITOR_ENABLED = os.environ.get('TEXHANDLER_JANITOR', '') == '1'
+JANITOR_INTERVAL = 600  # Seconds between runs
+JANITOR_MIN_IDLE = 3600  # Projects used more recently than this are never evicted
+JANITOR_FILES_PER_SECOND = 200  # Throttle for stat and unlink calls
+ACTIVITY_TOUCH_INTERVAL = 60  # Seconds between updates of a project's last-used marker
+app.config['ARTIFACT_DISK_BUDGET'] = ARTIFACT_DISK_BUDGET
+app.config['JANITOR_ENABLED'] = JANITOR_ENABLED
+app.config['JANITOR_MIN_IDLE'] = JANITOR_MIN_IDLE
+app.config['JANITOR_FILES_PER_SECOND'] = JANITOR_FILES_PER_SECOND
+
+JANITOR_RECLAIMED_BYTES = Counter('texhandler_janitor_reclaimed_bytes_total', 'Bytes of build outputs evicted by the janitor')
+activity_touched = {}  # project -> monotonic time this process last touched its marker
+janitor_state = {'thread': None}
+janitor_state_lock = threading.Lock()
+
+def touch_project_activity(project_name):
+    """Record that a project was used, at most once a minute per process"""
+    now = time.monotonic()
+    if now - activity_touched.get(project_name, -ACTIVITY_TOUCH_INTERVAL) < ACTIVITY_TOUCH_INTERVAL:
+        return
+    activity_touched[project_name] = now
+    marker = cache_path('activity', project_name)
+    try:
+        os.makedirs(os.path.dirname(marker), exist_ok=True)
+        with open(marker, 'a'):
+            pass
+        os.utime(marker)
+    except OSError:
+        pass
+
+def project_last_used(project_name):
+    """When a project was last used: its activity marker, else its directory's mtime"""
+    try:
+        return os.path.getmtime(cache_path('activity', project_name))
+    except OSError:
+        return os.path.getmtime(os.path.join(UPLOAD_FOLDER, project_name))
+
+@app.before_request
+def track_project_activity():
+    project_name = (request.view_args or {}).get('project_name')
+    if project_name and not project_name.startswith('.') and '/' not in project_name:
+        touch_project_activity(project_name)
+    if app.config.get('JANITOR_ENABLED', JANITOR_ENABLED):
+        start_janitor()
+    if app.config.get('INDEX_SNAPSHOTS_ENABLED', INDEX_SNAPSHOTS_ENABLED):
+        start_index_snapshots()
+
+class Throttle:
+    """Sleep as needed to keep an operation below `rate` calls per second"""
+    
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_at = time.monotonic()
+    
+    def wait(self):
+        if not self.interval:
+            return
+        now = time.monotonic()
+        if now < self.next_at:
+            time.sleep(self.next_at - now)
+        self.next_at = max(now, self.next_at) + self.interval
+
+def project_build_outputs(project_path, throttle):
+    """List (path, size) of a project's build outputs (the files clean_project removes)"""
+    outputs = []
+    for root, dirs, files in os.walk(project_path):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for file in files:
+            if is_build_artifact(file) or is_output_pdf(file, files):
+                throttle.wait()
+                path = os.path.join(root, file)
+                try:
+                    outputs.append((path, os.lstat(path).st_size))
+                except OSError:
+                    continue
+    return outputs
+
+def run_janitor(dry_run=False):
+    """One janitor pass; returns its report, or None when another process is running one"""
+    with named_lock('janitor', blocking=False) as acquired:
+        if not acquired:
+            return None
+        return evict_build_outputs(dry_run)
+
+def evict_build_outputs(dry_run):
+    budget = app.config.get('ARTIFACT_DISK_BUDGET', ARTIFACT_DISK_BUDGET)
+    min_idle = app.config.get('JANITOR_MIN_IDLE', JANITOR_MIN_IDLE)
+    throttle = Throttle(app.config.get('JANITOR_FILES_PER_SECOND', JANITOR_FILES_PER_SECOND))
+    report = {
+        'started_at': time.time(),
+        'dry_run': dry_run,
+        'budget_bytes': budget,
+        'evicted_projects': [],
+        'skipped_busy': [],
+        'reclaimed_bytes': 0,
+    }
+    
+    projects = []
+    for name in os.listdir(UPLOAD_FOLDER):
+        project_path = os.path.join(UPLOAD_FOLDER, name)
+        if name.startswith('.') or not os.path.isdir(project_path):
+            continue
+        outputs = project_build_outputs(project_path, throttle)
+        if outputs:
+            projects.append((project_last_used(name), name, outputs))
+    total = sum(size for _, _, outputs in projects for _, size in outputs)
+    report['artifact_bytes_before'] = total
+    
+    # Least recently used first
+    for last_used, name, outputs in sorted(projects):
+        if total <= budget:
+            break
+        if time.time() - last_used < min_idle:
+            continue
+        with project_lock(name, blocking=False) as acquired:
+            if not acquired:
+                report['skipped_busy'].append(name)  # Building right now
+                continue
+            reclaimed = 0
+            for path, size in outputs:
+                throttle.wait()
+                if not dry_run:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        continue
+                reclaimed += size
+            if not dry_run:
+                shutil.rmtree(snapshot_build_dir(os.path.join(UPLOAD_FOLDER, name)), ignore_errors=True)
+                shutil.rmtree(cache_path('pages', name), ignore_errors=True)  # Images of the evicted PDFs
+        total -= reclaimed
+        report['reclaimed_bytes'] += reclaimed
+        report['evicted_projects'].append({'project': name, 'last_used': last_used, 'reclaimed_bytes': reclaimed})
+    
+    if not dry_run:
+        JANITOR_RECLAIMED_BYTES.inc(report['reclaimed_bytes'])
+        if blob_store_enabled():
+            report['blob_garbage_bytes'] = collect_blob_garbage()
+    report['artifact_bytes_after'] = total
+    report['finished_at'] = time.time()
+    if not dry_run:
+        save_janitor_report(report)
+    return report
+
+def save_janitor_report(report):
+    path = cache_path('janitor.json')
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            previous = json.load(f)
+    except (OSError, ValueError):
+        previous = {}
+    atomic_write_text(path, json.dumps({
+        'last_run': report,
+        'total_reclaimed_bytes': previous.get('total_reclaimed_bytes', 0) + report['reclaimed_bytes'],
+        'runs': previous.get('runs', 0) + 1,
+    }))
+
+def janitor_loop():
+    while True:
+        time.sleep(JANITOR_INTERVAL)
+        try:
+            run_janitor()
+        except Exception as e:
+            print(f'Janitor run failed: {e}', file=sys.stderr)
+
+def start_janitor():
+    """Start this process's janitor thread once; the janitor lock lets one process run at a time"""
+    if janitor_state['thread'] is not None:
+        return
+    with janitor_state_lock:
+        if janitor_state['thread'] is None:
+            janitor_state['thread'] = threading.Thread(target=janitor_loop, name='texhandler-janitor', daemon=True)
+            janitor_state['thread'].start()
+
+@app.route('/api/admin/janitor')
+@require_admin
+def janitor_status():
+    """Report of the last janitor run and the bytes reclaimed so far"""
+    try:
+        with open(cache_path('janitor.json'), 'r', encoding='utf-8') as f:
+            status = json.load(f)
+    except (OSError, ValueError):
+        status = {'last_run': None, 'total_reclaimed_bytes': 0, 'runs': 0}
+    status['enabled'] = app.config.get('JANITOR_ENABLED', JANITOR_ENABLED)
+    status['budget_bytes'] = app.config.get('ARTIFACT_DISK_BUDGET', ARTIFACT_DISK_BUDGET)
+    return jsonify(status)
+
+@app.route('/api/admin/janitor/run', methods=['POST'])
+@require_admin
+def janitor_run():
+    """Run the janitor now (?dry_run=1 only reports what it would evict)"""
+    report = run_janitor(dry_run=request.args.get('dry_run') == '1')
+    if report is None:
+        return jsonify({'error': 'The janitor is already running'}), 409
+    return jsonify(report)
+
+# Index snapshots: the in-memory indexes of a project (line offsets, file
+# hashes, parsed .bib files) are written to .cache/indexes/<project>/<kind>.idx
+# so a restarted server starts warm. Snapshots are memory-mapped on first use;
+# an entry is only used while its file's (mtime, size) still match.
+INDEX_SNAPSHOTS_ENABLED = os.environ.get('TEXHANDLER_INDEX_SNAPSHOTS', '1') == '1'
+INDEX_SNAPSHOT_INTERVAL = 60  # Seconds between snapshot writes of one process
+INDEX_PREWARM_PROJECTS = 5  # Most recently active projects loaded when a process starts
+INDEX_SNAPSHOT_KINDS = ('lines', 'digests', 'bib')
+INDEX_SNAPSHOT_MAGIC = b'TXIX'
+INDEX_SNAPSHOT_VERSION = 1  # Bump when the layout of any kind changes; older files are ignored
+INDEX_SNAPSHOT_HEADER = struct.Struct('<4sHI')  # Magic, format version, entry count
+INDEX_SNAPSHOT_ENTRY = struct.Struct('<HqQI')  # Path length, mtime_ns, size, payload length
+BIB_SNAPSHOT_RANGE = struct.Struct('<III')  # Range length, CRC32, length of the fields (0: not an entry)
+app.config['INDEX_SNAPSHOTS_ENABLED'] = INDEX_SNAPSHOTS_ENABLED
+app.config['INDEX_PREWARM_PROJECTS'] = INDEX_PREWARM_PROJECTS
+
+index_snapshots = {}  # Snapshot file -> IndexSnapshot, or None when there is none
+index_snapshot_state = {'dirty': set(), 'written_at': time.monotonic(), 'prewarm': None}
+index_snapshot_lock = threading.Lock()
+
+class IndexSnapshot:
+    """A snapshot file mapped into memory, with the location of each file's payload"""
+    
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count = INDEX_SNAPSHOT_HEADER.unpack_from(self.mm, 0)
+        if magic != INDEX_SNAPSHOT_MAGIC or version != INDEX_SNAPSHOT_VERSION:
+            raise ValueError(f'Unsupported index snapshot {path}')
+        self.entries = {}  # Path relative to the project -> ((mtime_ns, size), payload offset, payload length)
+        offset = INDEX_SNAPSHOT_HEADER.size
+        for _ in range(count):
+            name_length, mtime_ns, size, length = INDEX_SNAPSHOT_ENTRY.unpack_from(self.mm, offset)
+            offset += INDEX_SNAPSHOT_ENTRY.size
+            name = self.mm[offset:offset + name_length].decode('utf-8')
+            offset += name_length
+            if offset + length > len(self.mm):
+                raise ValueError(f'Truncated index snapshot {path}')
+            self.entries[name] = ((mtime_ns, size), offset, length)
+            offset += length
+    
+    def payload(self, name, version):
+        entry = self.entries.get(name)
+        if entry is None or entry[0] != version:
+            return None
+        return self.mm[entry[1]:entry[1] + entry[2]]
+
+def index_snapshot_path(project_name, kind):
+    return cache_path('indexes', project_name, kind + '.idx')
+
+def index_location(path):
+    """(project, path relative to it) of a file inside a project, or None for other files"""
+    rel_path = os.path.relpath(os.path.abspath(path), os.path.abspath(UPLOAD_FOLDER))
+    project_name, _, name = rel_path.partition(os.sep)
+    if not name or project_name == '..' or project_name.startswith('.'):
+        return None
+    return project_name, name.replace(os.sep, '/')
+
+def load_index_snapshot(project_name, kind):
+    """The snapshot of kind for a project, mapped once per process; None when it has none"""
+    path = index_snapshot_path(project_name, kind)
+    with index_snapshot_lock:
+        if path in index_snapshots:
+            return index_snapshots[path]
+    try:
+        snapshot = IndexSnapshot(path)
+    except (OSError, ValueError, struct.error):
+        snapshot = None
+    with index_snapshot_lock:
+        return index_snapshots.setdefault(path, snapshot)
+
+def snapshot_index_payload(kind, path, version):
+    """What the snapshot holds of kind for a file, if the file did not change since it was written"""
+    if not app.config.get('INDEX_SNAPSHOTS_ENABLED', INDEX_SNAPSHOTS_ENABLED):
+        return None
+    location = index_location(path)
+    if location is None:
+        return None
+    snapshot = load_index_snapshot(location[0], kind)
+    payload = snapshot.payload(location[1], version) if snapshot else None
+    cache_lookup('index_snapshot', hit=payload is not None)
+    return payload
+
+def mark_index_dirty(path):
+    """Note that an index of a file was built, so its project's snapshots are written again"""
+    location = index_location(path)
+    if location is not None:
+        with index_snapshot_lock:
+            index_snapshot_state['dirty'].add(location[0])
+
+def encode_bib_ranges(ranges):
+    parts = []
+    for (length, crc), entry in ranges:
+        fields = '\x1f'.join(entry).encode('utf-8') if entry else b''
+        parts.append(BIB_SNAPSHOT_RANGE.pack(length, crc, len(fields)))
+        parts.append(fields)
+    return b''.join(parts)
+
+def decode_bib_ranges(payload):
+    ranges = []
+    offset = 0
+    while offset < len(payload):
+        length, crc, fields_length = BIB_SNAPSHOT_RANGE.unpack_from(payload, offset)
+        offset += BIB_SNAPSHOT_RANGE.size
+        entry = tuple(payload[offset:offset + fields_length].decode('utf-8').split('\x1f')) if fields_length else None
+        offset += fields_length
+        ranges.append(((length, crc), entry))
+    return ranges
+
+def index_snapshot_items(kind, project_path):
+    """(absolute path, version, payload) of this process's in-memory indexes of kind in a project"""
+    prefix = os.path.join(os.path.abspath(project_path), '')
+    if kind == 'lines':
+        with line_index_lock:
+            return [(path, version, offsets.tobytes()) for path, (version, offsets) in line_index_cache.items()
+                    if path.startswith(prefix)]
+    if kind == 'digests':
+        with digest_cache_lock:
+            return [(path, version, bytes.fromhex(digest)) for path, (version, digest) in digest_cache.items()
+                    if path.startswith(prefix)]
+    with bib_index_lock:
+        indexes = [(path, version, index) for path, (version, index) in bib_index_cache.items() if path.startswith(prefix)]
+    return [(path, version, encode_bib_ranges(index.ranges)) for path, version, index in indexes]
+
+def write_index_snapshots(project_name):
+    """Write the project's snapshots from this process's indexes, keeping entries
+    other processes wrote for files this one has not indexed, while still valid"""
+    project_path = os.path.join(UPLOAD_FOLDER, project_name)
+    for kind in INDEX_SNAPSHOT_KINDS:
+        entries = {os.path.relpath(path, project_path).replace(os.sep, '/'): (version, payload)
+                   for path, version, payload in index_snapshot_items(kind, project_path)}
+        previous = load_index_snapshot(project_name, kind)
+        for name, (version, offset, length) in (previous.entries.items() if previous else ()):
+            if name in entries:
+                continue
+            try:
+                stat_result = os.stat(os.path.join(project_path, name))
+            except OSError:
+                continue
+            if (stat_result.st_mtime_ns, stat_result.st_size) == version:
+                entries[name] = (version, previous.mm[offset:offset + length])
+        if not entries:
+            continue
+        
+        def write(tmp_path):
+            with open(tmp_path, 'wb') as f:
+                f.write(INDEX_SNAPSHOT_HEADER.pack(INDEX_SNAPSHOT_MAGIC, INDEX_SNAPSHOT_VERSION, len(entries)))
+                for name, ((mtime_ns, size), payload) in sorted(entries.items()):
+                    encoded = name.encode('utf-8')
+                    f.write(INDEX_SNAPSHOT_ENTRY.pack(len(encoded), mtime_ns, size, len(payload)))
+                    f.write(encoded)
+                    f.write(payload)
+        target = index_snapshot_path(project_name, kind)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        atomic_replace(target, write)
+        with index_snapshot_lock:
+            index_snapshots.pop(target, None)  # Mapped again on next use
+
+def flush_index_snapshots(force=False):
+    """Write the snapshots of projects whose indexes changed, at most every INDEX_SNAPSHOT_INTERVAL"""
+    with index_snapshot_lock:
+        if not force and time.monotonic() - index_snapshot_state['written_at'] < INDEX_SNAPSHOT_INTERVAL:
+            return
+        index_snapshot_state['written_at'] = time.monotonic()
+        dirty, index_snapshot_state['dirty'] = index_snapshot_state['dirty'], set()
+    for project_name in sorted(dirty):
+        if not os.path.isdir(os.path.join(UPLOAD_FOLDER, project_name)):
+            continue  # Deleted or renamed since
+        try:
+            with named_lock('.indexes-' + project_name):  # Processes merge their entries one at a time
+                write_index_snapshots(project_name)
+        except OSError as e:
+            print(f'Could not write index snapshots of {project_name}: {e}', file=sys.stderr)
+
+def prewarm_indexes():
+    """Load the indexes of the most recently active projects from their snapshots
+    (and index their .bib files); returns the names of those projects"""
+    try:
+        names = [name for name in os.listdir(cache_path('activity'))
+                 if os.path.isdir(os.path.join(UPLOAD_FOLDER, name))]
+    except OSError:
+        return []
+    recent = sorted(names, key=project_last_used, reverse=True)[:app.config.get('INDEX_PREWARM_PROJECTS', INDEX_PREWARM_PROJECTS)]
+    for project_name in recent:
+        project_path = os.path.join(UPLOAD_FOLDER, project_name)
+        for kind, load in (('lines', get_line_index), ('digests', cached_file_digest)):
+            snapshot = load_index_snapshot(project_name, kind)
+            for name, (version, _, _) in (snapshot.entries.items() if snapshot else ()):
+                path = os.path.join(project_path, name)
+                try:
+                    stat_result = os.stat(path)
+                except OSError:
+                    continue
+                if (stat_result.st_mtime_ns, stat_result.st_size) == version:
+                    load(path, stat_result)
+        for path, stat_result in project_bib_files(project_path):
+            try:
+                get_bib_index(path, stat_result)
+            except OSError:
+                continue
+    return recent
+
+def run_index_prewarm():
+    try:
+        prewarm_indexes()
+    except Exception as e:
+        print(f'Index prewarm failed: {e}', file=sys.stderr)
+
+def start_index_snapshots():
+    """Prewarm once per process in the background, and write due snapshots on the I/O pool"""
+    if index_snapshot_state['prewarm'] is None:
+        with index_snapshot_lock:
+            if index_snapshot_state['prewarm'] is None:
+                index_snapshot_state['prewarm'] = threading.Thread(target=run_index_prewarm, name='texhandler-prewarm', daemon=True)
+                index_snapshot_state['prewarm'].start()
+    if index_snapshot_state['dirty'] and time.monotonic() - index_snapshot_state['written_at'] >= INDEX_SNAPSHOT_INTERVAL:
+        io_executor.submit(flush_index_snapshots)
+
+def flush_index_snapshots_at_exit():
+    if os.getpid() != loaded_in_pid:
+        return  # A forked gunicorn worker exiting with the master's copy of this module
+    if app.config.get('INDEX_SNAPSHOTS_ENABLED', INDEX_SNAPSHOTS_ENABLED):
+        flush_index_snapshots(force=True)
+
+atexit.register(flush_index_snapshots_at_exit)
+
+def parse_serve_args(argv):
+    parser = argparse.ArgumentParser(prog='app.py serve', description='Run TeXHandler under a production WSGI server')
+    parser.add_argument('--bind', default=os.environ.get('TEXHANDLER_BIND', '127.0.0.1:5000'),
+                        help='host:port to listen on (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('TEXHANDLER_WORKERS', min(4, os.cpu_count() or 1))),
+                        help='Number of worker processes (default: %(default)s)')
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('TEXHANDLER_THREADS', 8)),
+                        help='Threads per worker (default: %(default)s)')
+    parser.add_argument('--timeout', type=int, default=300,
+                        help='Seconds before a stuck request gets its worker restarted (default: %(default)s)')
+    parser.add_argument('--graceful-timeout', type=int, default=30,
+                        help='Seconds workers get to finish requests on reload or shutdown (default: %(default)s)')
+    parser.add_argument('--keep-alive', type=int, default=5,
+                        help='Seconds to keep idle connections open (default: %(default)s)')
+    parser.add_argument('--max-requests', type=int, default=1000,
+                        help='Recycle a worker after this many requests, 0 to disable (default: %(default)s)')
+    parser.add_argument('--max-requests-jitter', type=int, default=100,
+                        help='Random extra requests before recycling, to stagger restarts (default: %(default)s)')
+    parser.add_argument('--server', choices=('auto', 'gunicorn', 'waitress', 'werkzeug'), default='auto',
+                        help='WSGI server to use; auto prefers gunicorn, then waitress (default: %(default)s)')
+    parser.add_argument('--compile-workers', type=int, default=0,
+                        help='Start this many local compile_worker.py processes and send builds to them (default: %(default)s)')
+    parser.add_argument('--compile-worker-port', type=int, default=7001,
+                        help='First port for the local compile workers (default: %(default)s)')
+    return parser.parse_args(argv)
+
+def start_local_compile_workers(count, first_port):
+    """Spawn compile workers on consecutive ports and point the remote backend at them"""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'compile_worker.py')
+    store_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'worker-store')
+    processes = []
+    urls = []
+    for i in range(count):
+        port = first_port + i
+        processes.append(subprocess.Popen([
+            sys.executable, script, '--bind', f'127.0.0.1:{port}', '--jobs', '1',
+            '--store', os.path.join(store_root, f'local-{i}'),
+        ]))
+        urls.append(f'http://127.0.0.1:{port}')
+    
+    owner_pid = os.getpid()
+    
+    def stop_workers():
+        if os.getpid() != owner_pid:
+            return  # A forked server worker exiting; the workers belong to the master
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+    atexit.register(stop_workers)
+    
+    app.config['COMPILE_BACKEND'] = 'remote'
+    app.config['COMPILE_WORKERS'] = urls
+    return processes
+
+def gunicorn_options(args):
+    """Map serve arguments onto gunicorn settings"""
+    return {
+        'bind': args.bind,
+        'workers': args.workers,
+        'threads': args.threads,
+        'worker_class': 'gthread',
+        'timeout': args.timeout,
+        'graceful_timeout': args.graceful_timeout,
+        'keepalive': args.keep_alive,
+        'max_requests': args.max_requests,
+        'max_requests_jitter': args.max_requests_jitter,
+        # Workers load the app through load_worker_app after the fork
+        'preload_app': False,
+    }
+
+def load_worker_app(config):
+    """The Flask app for a gunicorn worker, from a fresh import of this module.
+
+    `python app.py serve` runs this file as __main__, so importing `app`
+    here creates a new module in the worker: its thread pools, locks,
+    admission controller and metrics are made after the fork instead of
+    being copied from the master. `config` carries what the master set up
+    (e.g. local compile workers).
+    """
+    import app as worker_module
+    worker_module.app.config.update(config)
+    return worker_module.app
+
+def serve(argv):
+    """Entry point for `python app.py serve`.
+
+    gunicorn runs multiple worker processes with threads, restarts stuck
+    workers after --timeout, recycles them after --max-requests, reloads
+    gracefully on SIGHUP and shuts down gracefully on SIGTERM. Without
+    gunicorn (e.g. on Windows) waitress serves with threads in one process.
+    State that must be shared between workers (import progress, build locks,
+    download archives) lives under the projects folder, not in memory.
+    """
+    args = parse_serve_args(argv)
+    server = args.server
+    if args.compile_workers:
+        start_local_compile_workers(args.compile_workers, args.compile_worker_port)
+    
+    if server in ('auto', 'gunicorn'):
+        try:
+            from gunicorn.app.base import BaseApplication
+        except ImportError:
+            if server == 'gunicorn':
+                print('Error: gunicorn is not installed (pip install gunicorn)', file=sys.stderr)
+                return 1
+        else:
+            class TeXHandlerServer(BaseApplication):
+                def __init__(self, app_config, options):
+                    self.app_config = app_config
+                    self.options = options
+                    super().__init__()
+                
+                def load_config(self):
+                    for key, value in self.options.items():
+                        self.cfg.set(key, value)
+                
+                def load(self):
+                    return load_worker_app(self.app_config)
+            
+            TeXHandlerServer(dict(app.config), gunicorn_options(args)).run()
+            return 0
+    
+    host, _, port = args.bind.rpartition(':')
+    host = host or '127.0.0.1'
+    
+    if server in ('auto', 'waitress'):
+        try:
+            import waitress
+        except ImportError:
+            if server == 'waitress':
+                print('Error: waitress is not installed (pip install waitress)', file=sys.stderr)
+                return 1
+        else:
+            if args.workers > 1:
+                print('Note: waitress runs a single process; use gunicorn for multiple workers')
+            waitress.serve(app, host=host, port=int(port), threads=args.threads,
+                           channel_timeout=args.timeout)
+            return 0
+    
+    print('Warning: neither gunicorn nor waitress is installed; falling back to the '
+          'threaded development server', file=sys.stderr)
+    from werkzeug.serving import run_simple
+    run_simple(host, int(port), app, threaded=True)
+    return 0
+
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        sys.exit(serve(sys.argv[2:]))
     app.run(debug=True, port=5000, use_reloader=False)
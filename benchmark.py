@@ -0,0 +1,319 @@
+"""Benchmarks for the TeXHandler API.
+
+Generates a synthetic LaTeX project, then times the main endpoints through
+Flask's test client against a scratch projects folder, so runs don't depend
+on the network or on what is in projects/. Compiling and the SyncTeX
+resolvers are only timed when pdflatex is installed.
+
+Results are written as JSON and can be compared against a stored baseline;
+a benchmark whose median got slower by more than the threshold counts as a
+regression and makes the run exit with status 1.
+
+Usage:
+    python benchmark.py                                  # print results
+    python benchmark.py --output results.json            # also save them
+    python benchmark.py --save-baseline baseline.json    # record a baseline
+    python benchmark.py --baseline baseline.json --threshold 0.25
+    python benchmark.py --files 500 --depth 4 --bib-entries 2000 --only list_files,download_project
+"""
+import argparse
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+import zlib
+
+import app
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor '
+         'incididunt ut labore et dolore magna aliqua ut enim ad minim veniam quis nostrud').split()
+PARAGRAPHS_PER_PAGE = 4
+
+
+def tiny_png(width=8, height=8, seed=0):
+    """A valid RGB PNG with a flat colour derived from seed"""
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    colour = bytes(((seed * 67) % 256, (seed * 131) % 256, (seed * 199) % 256))
+    rows = b''.join(b'\x00' + colour * width for _ in range(height))
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(rows))
+            + chunk(b'IEND', b''))
+
+
+def paragraph(rng, words=80):
+    return ' '.join(rng.choice(WORDS) for _ in range(words)) + '.'
+
+
+def generate_project(path, files=20, depth=2, pages=10, figures=5, labels=20, bib_entries=100, seed=0):
+    """Write a synthetic LaTeX project to path and return the list of relative file paths.
+
+    main.tex \\input's `files` section files spread over `depth` levels of
+    directories, with roughly `pages` pages of text, `figures` PNG figures,
+    `labels` labelled sections referenced from main.tex and a references.bib
+    with `bib_entries` entries, a few of which are cited.
+    """
+    rng = random.Random(seed)
+    os.makedirs(path, exist_ok=True)
+    written = []
+
+    def write(rel_path, data):
+        full_path = os.path.join(path, rel_path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'wb' if isinstance(data, bytes) else 'w') as f:
+            f.write(data)
+        written.append(rel_path)
+
+    figure_paths = []
+    for i in range(figures):
+        figure_paths.append(f'figures/figure{i}.png')
+        write(figure_paths[-1], tiny_png(seed=i))
+
+    bib = []
+    for i in range(bib_entries):
+        bib.append(f'@article{{ref{i},\n  author = {{Author {i} and Other {i}}},\n'
+                   f'  title = {{{paragraph(rng, 8)}}},\n  journal = {{Journal {i % 17}}},\n'
+                   f'  year = {{{1950 + i % 70}}},\n}}\n')
+    write('references.bib', '\n'.join(bib))
+
+    files = max(1, files)
+    paragraphs_left = pages * PARAGRAPHS_PER_PAGE
+    sections = []
+    for i in range(files):
+        parts = [f'level{d}' for d in range(i % (depth + 1))]
+        rel_path = '/'.join(parts + [f'section{i}.tex'])
+        body = [f'\\section{{Section {i}}}']
+        if i < labels:
+            body.append(f'\\label{{sec:{i}}}')
+        count = paragraphs_left // (files - i)
+        paragraphs_left -= count
+        for j in range(count):
+            text = paragraph(rng)
+            if bib_entries and j == 0:
+                text += f' See~\\cite{{ref{rng.randrange(bib_entries)}}}.'
+            body.append(text + '\n')
+        if i < len(figure_paths):
+            body.append('\\begin{figure}[h]\\centering\n'
+                        f'\\includegraphics[width=2cm]{{{figure_paths[i]}}}\n'
+                        f'\\caption{{Figure {i}}}\\end{{figure}}')
+        write(rel_path, '\n'.join(body) + '\n')
+        sections.append(rel_path[:-len('.tex')])
+
+    main = ['\\documentclass{article}', '\\usepackage{graphicx}', '\\begin{document}']
+    main += [f'\\input{{{section}}}' for section in sections]
+    main.append('Sections ' + ', '.join(f'\\ref{{sec:{i}}}' for i in range(min(labels, files))) + '.')
+    if bib_entries:
+        main += ['\\bibliographystyle{plain}', '\\bibliography{references}']
+    main.append('\\end{document}')
+    write('main.tex', '\n'.join(main) + '\n')
+    return written
+
+
+def time_calls(call, repeats, warmup, setup=None):
+    """Run call() warmup + repeats times and return summary statistics in milliseconds"""
+    samples = []
+    for i in range(warmup + repeats):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        call()
+        elapsed = (time.perf_counter() - start) * 1000
+        if i >= warmup:
+            samples.append(elapsed)
+    samples.sort()
+    return {
+        'repeats': len(samples),
+        'min_ms': round(samples[0], 3),
+        'median_ms': round(statistics.median(samples), 3),
+        'mean_ms': round(statistics.fmean(samples), 3),
+        'p95_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 3),
+        'stdev_ms': round(statistics.stdev(samples), 3) if len(samples) > 1 else 0.0,
+    }
+
+
+def expect_ok(response):
+    response.get_data()  # Drain streamed bodies so their cost is included
+    response.close()  # Like a server after sending, which frees the request's admission slot
+    if response.status_code >= 400:
+        raise RuntimeError(f'{response.request.path} returned {response.status_code}: {response.get_data(as_text=True)[:200]}')
+    return response
+
+
+def run_benchmarks(options, repeats=5, warmup=1, only=None):
+    """Run the benchmarks on a freshly generated project; returns {name: stats}"""
+    workdir = tempfile.mkdtemp(prefix='texhandler-bench-')
+    saved = (app.UPLOAD_FOLDER, dict(app.app.config))
+    app.UPLOAD_FOLDER = workdir
+    app.app.config['UPLOAD_FOLDER'] = workdir
+    app.app.config['TRACE_LOG'] = None
+    client = app.app.test_client()
+    project = 'bench'
+    project_path = os.path.join(workdir, project)
+    files = generate_project(project_path, **options)
+    tex_files = [f for f in files if f.endswith('.tex')]
+    have_tex = shutil.which('pdflatex') is not None
+    results = {}
+
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for rel_path in files:
+            zf.write(os.path.join(project_path, rel_path), rel_path)
+    archive_bytes = archive.getvalue()
+    uploads = itertools.count()
+    sample_file = tex_files[len(tex_files) // 2]
+    with open(os.path.join(project_path, sample_file)) as f:
+        sample_content = f.read()
+
+    def upload():
+        name = f'upload{next(uploads)}'
+        expect_ok(client.post('/api/upload', data={'file': (io.BytesIO(archive_bytes), f'{name}.zip')},
+                              content_type='multipart/form-data'))
+        shutil.rmtree(os.path.join(workdir, name), ignore_errors=True)
+
+    def make_artifacts():
+        for ext in ('.aux', '.log', '.toc', '.out', '.synctex.gz'):
+            with open(os.path.join(project_path, 'main' + ext), 'wb') as f:
+                f.write(b'x' * 1024)
+
+    def uncached_download():
+        app.app.config['ARCHIVE_CACHE_ENABLED'] = False
+        try:
+            expect_ok(client.get(f'/api/download/{project}'))
+        finally:
+            app.app.config['ARCHIVE_CACHE_ENABLED'] = True
+
+    benchmarks = [
+        ('list_projects', lambda: expect_ok(client.get('/api/projects')), None),
+        ('list_files', lambda: expect_ok(client.get(f'/api/files/{project}')), None),
+        ('list_tex_files', lambda: expect_ok(client.get(f'/api/tex_files/{project}')), None),
+        ('get_file', lambda: expect_ok(client.get(f'/api/file/{project}/{sample_file}')), None),
+        ('get_image', lambda: expect_ok(client.get(f'/api/file/{project}/figures/figure0.png')), None)
+        if options.get('figures') else None,
+        ('save_file', lambda: expect_ok(client.put(f'/api/file/{project}/{sample_file}',
+                                                   json={'content': sample_content})), None),
+        ('upload_file', upload, None),
+        ('download_project', uncached_download, None),
+        ('download_project_cached', lambda: expect_ok(client.get(f'/api/download/{project}')), None),
+        ('clean_project', lambda: expect_ok(client.post(f'/api/clean/{project}')), make_artifacts),
+    ]
+    if have_tex:
+        benchmarks += [
+            ('compile_latex', lambda: expect_ok(client.get(f'/api/compile/{project}?file=main.tex')), None),
+            ('synctex_resolve', lambda: expect_ok(client.post(f'/api/synctex/{project}/resolve',
+                                                              json={'page': 1, 'x': 100, 'y': 100})), None),
+            ('synctex_resolve_reverse', lambda: expect_ok(client.post(f'/api/synctex/{project}/resolve_reverse',
+                                                                      json={'file': sample_file, 'line': 3})), None),
+        ]
+
+    try:
+        for entry in benchmarks:
+            if entry is None or (only and entry[0] not in only):
+                continue
+            name, call, setup = entry
+            results[name] = time_calls(call, repeats, warmup, setup)
+            print(f'{name:26} median {results[name]["median_ms"]:10.2f} ms   p95 {results[name]["p95_ms"]:10.2f} ms')
+        if not have_tex:
+            print('pdflatex not found: skipped compile_latex and the SyncTeX resolvers')
+    finally:
+        app.UPLOAD_FOLDER = saved[0]
+        app.app.config.clear()
+        app.app.config.update(saved[1])
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def compare_results(results, baseline, threshold, min_delta_ms=1.0):
+    """Compare medians with a baseline; returns a list of (name, baseline ms, current ms, change).
+
+    A benchmark regressed when its median grew by more than `threshold` (a
+    fraction) and by at least min_delta_ms, so sub-millisecond noise on fast
+    endpoints doesn't fail the run.
+    """
+    regressions = []
+    for name, stats in results.items():
+        base = baseline.get('results', {}).get(name)
+        if not base:
+            continue
+        change = (stats['median_ms'] - base['median_ms']) / base['median_ms'] if base['median_ms'] else 0.0
+        if change > threshold and stats['median_ms'] - base['median_ms'] >= min_delta_ms:
+            regressions.append((name, base['median_ms'], stats['median_ms'], change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the TeXHandler API on a synthetic project')
+    parser.add_argument('--files', type=int, default=20, help='Number of section files (default: %(default)s)')
+    parser.add_argument('--depth', type=int, default=2, help='Directory nesting depth (default: %(default)s)')
+    parser.add_argument('--pages', type=int, default=10, help='Approximate pages of text (default: %(default)s)')
+    parser.add_argument('--figures', type=int, default=5, help='Number of PNG figures (default: %(default)s)')
+    parser.add_argument('--labels', type=int, default=20, help='Number of labelled sections (default: %(default)s)')
+    parser.add_argument('--bib-entries', type=int, default=100, help='Entries in references.bib (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the generated text (default: %(default)s)')
+    parser.add_argument('--repeats', type=int, default=5, help='Timed runs per benchmark (default: %(default)s)')
+    parser.add_argument('--warmup', type=int, default=1, help='Untimed runs per benchmark (default: %(default)s)')
+    parser.add_argument('--only', help='Comma-separated benchmark names to run')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--save-baseline', help='Write the results to this JSON file as the new baseline')
+    parser.add_argument('--baseline', help='Compare against this baseline JSON file')
+    parser.add_argument('--threshold', type=float, default=0.20,
+                        help='Allowed median slowdown before a benchmark counts as regressed (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    options = {
+        'files': args.files, 'depth': args.depth, 'pages': args.pages, 'figures': args.figures,
+        'labels': args.labels, 'bib_entries': args.bib_entries, 'seed': args.seed,
+    }
+    only = set(args.only.split(',')) if args.only else None
+    results = run_benchmarks(options, repeats=args.repeats, warmup=args.warmup, only=only)
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'pdflatex': shutil.which('pdflatex') is not None,
+            'project': options,
+            'repeats': args.repeats,
+        },
+        'results': results,
+    }
+    for path in filter(None, (args.output, args.save_baseline)):
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print(f'Wrote {path}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('meta', {}).get('project') != options:
+            print('Warning: the baseline was recorded with different project options', file=sys.stderr)
+        regressions = compare_results(results, baseline, args.threshold)
+        for name, before, after, change in regressions:
+            print(f'REGRESSION {name}: {before:.2f} ms -> {after:.2f} ms (+{change:.0%})')
+        if regressions:
+            return 1
+        print(f'No regressions beyond {args.threshold:.0%} against {args.baseline}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
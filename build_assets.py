@@ -0,0 +1,171 @@
+"""Build step for the frontend assets.
+
+Vendors the third-party libraries the editor uses (CodeMirror and PDF.js) into
+static/vendor, bundles them together with the application's own CSS and
+JavaScript into content-hashed files under static/dist, and writes gzip (and,
+when the ``brotli`` package is installed, brotli) variants next to every file.
+
+The server picks up static/dist/manifest.json automatically; without it the
+page falls back to loading the libraries from the CDN.
+
+Usage:
+    python build_assets.py            # download missing vendor files, then bundle
+    python build_assets.py --offline  # bundle from an already populated static/vendor
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sys
+import urllib.request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(BASE_DIR, 'static')
+VENDOR_DIR = os.path.join(STATIC_DIR, 'vendor')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+
+CODEMIRROR_URL = 'https://cdnjs.cloudflare.com/ajax/libs/codemirror/5.65.2'
+PDFJS_URL = 'https://cdnjs.cloudflare.com/ajax/libs/pdf.js/3.11.174'
+
+# Vendor files as (download URL, path under static/vendor)
+VENDOR_ASSETS = [
+    (f'{CODEMIRROR_URL}/codemirror.min.css', 'codemirror/codemirror.min.css'),
+    (f'{CODEMIRROR_URL}/theme/monokai.min.css', 'codemirror/theme/monokai.min.css'),
+    (f'{CODEMIRROR_URL}/addon/hint/show-hint.min.css', 'codemirror/addon/hint/show-hint.min.css'),
+    (f'{CODEMIRROR_URL}/addon/dialog/dialog.min.css', 'codemirror/addon/dialog/dialog.min.css'),
+    (f'{CODEMIRROR_URL}/codemirror.min.js', 'codemirror/codemirror.min.js'),
+    (f'{CODEMIRROR_URL}/mode/stex/stex.min.js', 'codemirror/mode/stex/stex.min.js'),
+    (f'{CODEMIRROR_URL}/mode/xml/xml.min.js', 'codemirror/mode/xml/xml.min.js'),
+    (f'{CODEMIRROR_URL}/mode/javascript/javascript.min.js', 'codemirror/mode/javascript/javascript.min.js'),
+    (f'{CODEMIRROR_URL}/mode/css/css.min.js', 'codemirror/mode/css/css.min.js'),
+    (f'{CODEMIRROR_URL}/addon/hint/show-hint.min.js', 'codemirror/addon/hint/show-hint.min.js'),
+    (f'{CODEMIRROR_URL}/addon/hint/anyword-hint.min.js', 'codemirror/addon/hint/anyword-hint.min.js'),
+    (f'{CODEMIRROR_URL}/addon/search/search.min.js', 'codemirror/addon/search/search.min.js'),
+    (f'{CODEMIRROR_URL}/addon/search/searchcursor.min.js', 'codemirror/addon/search/searchcursor.min.js'),
+    (f'{CODEMIRROR_URL}/addon/dialog/dialog.min.js', 'codemirror/addon/dialog/dialog.min.js'),
+    (f'{PDFJS_URL}/pdf.min.js', 'pdfjs/pdf.min.js'),
+    (f'{PDFJS_URL}/pdf.worker.min.js', 'pdfjs/pdf.worker.min.js'),
+]
+
+# Bundles as (logical name, list of sources). Sources starting with "vendor/"
+# come from the vendor directory, the rest are relative to static/. The order
+# matches the order the page used to load them in.
+BUNDLES = [
+    ('app.css', [
+        'css/style.css',
+        'vendor/codemirror/codemirror.min.css',
+        'vendor/codemirror/theme/monokai.min.css',
+        'vendor/codemirror/addon/hint/show-hint.min.css',
+        'vendor/codemirror/addon/dialog/dialog.min.css',
+    ]),
+    ('app.js', [
+        'vendor/codemirror/codemirror.min.js',
+        'vendor/codemirror/mode/stex/stex.min.js',
+        'vendor/codemirror/mode/xml/xml.min.js',
+        'vendor/codemirror/mode/javascript/javascript.min.js',
+        'vendor/codemirror/mode/css/css.min.js',
+        'vendor/codemirror/addon/hint/show-hint.min.js',
+        'vendor/codemirror/addon/hint/anyword-hint.min.js',
+        'vendor/codemirror/addon/search/search.min.js',
+        'vendor/codemirror/addon/search/searchcursor.min.js',
+        'vendor/codemirror/addon/dialog/dialog.min.js',
+        'vendor/pdfjs/pdf.min.js',
+        'js/app.js',
+    ]),
+    # The PDF.js worker is loaded by URL, so it stays a separate file
+    ('pdf.worker.js', [
+        'vendor/pdfjs/pdf.worker.min.js',
+    ]),
+]
+
+
+def vendor_assets(vendor_dir=VENDOR_DIR, offline=False):
+    """Download every vendor file that is not present yet"""
+    for url, rel_path in VENDOR_ASSETS:
+        target = os.path.join(vendor_dir, rel_path)
+        if os.path.exists(target):
+            continue
+        if offline:
+            raise FileNotFoundError(f'Missing vendor file {target} (run without --offline to download it)')
+        print(f'Downloading {url}')
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with urllib.request.urlopen(url, timeout=60) as response:
+            data = response.read()
+        with open(target + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(target + '.tmp', target)
+
+
+def read_source(source, vendor_dir):
+    if source.startswith('vendor/'):
+        path = os.path.join(vendor_dir, source[len('vendor/'):])
+    else:
+        path = os.path.join(STATIC_DIR, source)
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def write_variants(path, data):
+    """Write precompressed variants of a bundle next to it"""
+    with open(path + '.gz', 'wb') as f:
+        # mtime=0 keeps the output reproducible
+        f.write(gzip.compress(data, compresslevel=9, mtime=0))
+    if brotli is not None:
+        with open(path + '.br', 'wb') as f:
+            f.write(brotli.compress(data, quality=11))
+
+
+def build_bundles(vendor_dir=VENDOR_DIR, dist_dir=DIST_DIR):
+    """Concatenate, fingerprint and precompress the bundles; return the manifest"""
+    if os.path.exists(dist_dir):
+        shutil.rmtree(dist_dir)
+    os.makedirs(dist_dir)
+
+    manifest = {}
+    for name, sources in BUNDLES:
+        # Separate files with a newline (and a semicolon for scripts) so that
+        # files without a trailing newline or semicolon don't run together
+        separator = b'\n;\n' if name.endswith('.js') else b'\n'
+        data = separator.join(read_source(source, vendor_dir) for source in sources)
+        stem, ext = os.path.splitext(name)
+        hashed_name = f'{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}'
+        path = os.path.join(dist_dir, hashed_name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        write_variants(path, data)
+        manifest[name] = hashed_name
+        print(f'{name} -> {hashed_name} ({len(data)} bytes)')
+
+    with open(os.path.join(dist_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Vendor, bundle and precompress the frontend assets')
+    parser.add_argument('--offline', action='store_true',
+                        help='Do not download anything; fail if a vendor file is missing')
+    parser.add_argument('--vendor-dir', default=VENDOR_DIR, help='Directory holding the vendored libraries')
+    parser.add_argument('--dist-dir', default=DIST_DIR, help='Output directory for the bundles')
+    args = parser.parse_args(argv)
+
+    try:
+        vendor_assets(args.vendor_dir, offline=args.offline)
+    except OSError as e:
+        print(f'Error: {e}', file=sys.stderr)
+        return 1
+    build_bundles(args.vendor_dir, args.dist_dir)
+    if brotli is None:
+        print('Note: install the brotli package to also generate .br variants')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
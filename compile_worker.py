@@ -0,0 +1,230 @@
+"""Compile worker for TeXHandler's remote compile backend.
+
+The web tier (app.py with COMPILE_BACKEND = 'remote') talks to one or more of
+these processes over HTTP:
+
+    GET  /health          -> {"capacity": N, "active": N}
+    POST /blobs/missing   {"blobs": [sha256, ...]} -> {"missing": [...]}
+    PUT  /blobs/<sha256>  raw file content (verified against the digest)
+    GET  /blobs/<sha256>  raw file content
+    POST /compile         {"project": name, "main": "main.tex", "files": {path: sha256},
+                           "focus": path or null, "profile": "full" | "draft"}
+
+Blobs are stored once under <store>/blobs and hardlinked into a persistent
+workspace per project, so unchanged files are neither sent nor copied again
+and the aux files of the previous build are reused; TikZ figures and converted
+graphics are cached under <store>/figures and .bbl files under
+<store>/bibliography. Build outputs are stored as blobs too and returned by
+digest.
+
+Usage:
+    python compile_worker.py --bind 127.0.0.1:7001 --jobs 2
+"""
+import argparse
+import hashlib
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+
+from flask import Flask, jsonify, request, send_file
+
+import app as texhandler
+
+DEFAULT_STORE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'worker-store')
+BLOB_NAME_LENGTH = 64  # Hex digits of a sha256
+
+
+def valid_digest(digest):
+    return len(digest) == BLOB_NAME_LENGTH and all(c in '0123456789abcdef' for c in digest)
+
+
+def valid_project_name(name):
+    return bool(name) and not name.startswith('.') and '/' not in name and '\\' not in name
+
+
+def create_worker_app(store_dir=DEFAULT_STORE, jobs=None):
+    """Build the worker's Flask app; `jobs` builds run at once, extra ones get a 503"""
+    jobs = jobs or os.cpu_count() or 1
+    blob_dir = os.path.join(store_dir, 'blobs')
+    workspace_dir = os.path.join(store_dir, 'workspaces')
+    figure_dir = os.path.join(store_dir, 'figures')
+    bibliography_dir = os.path.join(store_dir, 'bibliography')
+    os.makedirs(blob_dir, exist_ok=True)
+    os.makedirs(workspace_dir, exist_ok=True)
+
+    worker = Flask(__name__)
+    slots = threading.BoundedSemaphore(jobs)
+    state = {'active': 0}
+    state_lock = threading.Lock()
+    workspace_locks = {}
+
+    def blob_path(digest):
+        return os.path.join(blob_dir, digest[:2], digest)
+
+    def store_blob(path):
+        """Move a finished file into the blob store and return its digest"""
+        digest = texhandler.file_digest(path)
+        target = blob_path(digest)
+        if not os.path.exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(path, target)
+            os.chmod(target, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        return digest
+
+    def materialize(workspace, files):
+        """Make workspace hold exactly `files` (path -> digest), keeping build artifacts"""
+        wanted = {}
+        for rel_path, digest in files.items():
+            target = texhandler.safe_member_path(workspace, rel_path)
+            if target is None or not valid_digest(digest):
+                raise ValueError(f'Invalid manifest entry: {rel_path}')
+            wanted[target] = digest
+
+        for root, dirs, names in os.walk(workspace):
+            dirs[:] = [d for d in dirs if d != texhandler.TIKZ_EXTERNAL_DIR]  # Externalized figures
+            for name in names:
+                path = os.path.join(root, name)
+                if path in wanted or texhandler.is_build_artifact(name) or texhandler.is_output_pdf(name, names):
+                    continue
+                os.remove(path)
+
+        for target, digest in wanted.items():
+            source = blob_path(digest)
+            try:
+                if os.path.samefile(source, target):
+                    continue  # Already linked to this content
+                os.remove(target)
+            except FileNotFoundError:
+                pass
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            try:
+                os.link(source, target)
+            except OSError:
+                shutil.copyfile(source, target)
+
+    @worker.route('/health')
+    def health():
+        with state_lock:
+            active = state['active']
+        return jsonify({'status': 'ok', 'capacity': jobs, 'active': active})
+
+    @worker.route('/blobs/missing', methods=['POST'])
+    def missing_blobs():
+        digests = (request.get_json(silent=True) or {}).get('blobs', [])
+        if not isinstance(digests, list) or not all(isinstance(d, str) and valid_digest(d) for d in digests):
+            return jsonify({'error': 'Invalid blob list'}), 400
+        return jsonify({'missing': [d for d in digests if not os.path.exists(blob_path(d))]})
+
+    @worker.route('/blobs/<digest>', methods=['PUT'])
+    def put_blob(digest):
+        if not valid_digest(digest):
+            return jsonify({'error': 'Invalid digest'}), 400
+        target = blob_path(digest)
+        if os.path.exists(target):
+            return jsonify({'stored': False}), 200
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+
+        hasher = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in iter(lambda: request.stream.read(1024 * 1024), b''):
+                    hasher.update(chunk)
+                    f.write(chunk)
+            if hasher.hexdigest() != digest:
+                return jsonify({'error': 'Content does not match digest'}), 400
+            os.chmod(tmp_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.replace(tmp_path, target)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return jsonify({'stored': True}), 201
+
+    @worker.route('/blobs/<digest>', methods=['GET'])
+    def get_blob(digest):
+        if not valid_digest(digest) or not os.path.exists(blob_path(digest)):
+            return jsonify({'error': 'Blob not found'}), 404
+        return send_file(blob_path(digest), mimetype='application/octet-stream')
+
+    @worker.route('/compile', methods=['POST'])
+    def compile_project():
+        data = request.get_json(silent=True) or {}
+        project = data.get('project', '')
+        main = data.get('main', '')
+        files = data.get('files')
+        focus = data.get('focus')
+        profile = data.get('profile') or 'full'
+        if not valid_project_name(project) or not isinstance(files, dict) or main not in files \
+                or not (focus is None or isinstance(focus, str)) or profile not in texhandler.COMPILE_PROFILES:
+            return jsonify({'error': 'Invalid compile request'}), 400
+
+        missing = sorted({d for d in files.values() if not os.path.exists(blob_path(d))})
+        if missing:
+            return jsonify({'error': f'{len(missing)} blobs are missing', 'missing': missing}), 409
+
+        if not slots.acquire(blocking=False):
+            return jsonify({'error': 'Worker is busy'}), 503
+        try:
+            with state_lock:
+                state['active'] += 1
+                lock = workspace_locks.setdefault(project, threading.Lock())
+            with lock:
+                workspace = os.path.join(workspace_dir, project)
+                try:
+                    materialize(workspace, files)
+                except ValueError as e:
+                    return jsonify({'error': str(e)}), 400
+
+                main_file = texhandler.safe_member_path(workspace, main)
+                figure_cache = os.path.join(figure_dir, project) if texhandler.FIGURE_CACHE_ENABLED else None
+                bib_cache = os.path.join(bibliography_dir, project) if texhandler.BIB_CACHE_ENABLED else None
+                payload, status = texhandler.run_latex_pipeline(main_file, focus, profile, figure_cache, bib_cache)
+
+                artifacts = {}
+                base = os.path.splitext(main_file)[0]
+                if profile == 'draft':
+                    base += texhandler.DRAFT_JOB_SUFFIX
+                outputs = {'log': base + '.log'}
+                if payload.get('success'):
+                    outputs['pdf'] = payload.pop('pdf_file')
+                    synctex_file = payload.pop('synctex_file')
+                    if synctex_file:
+                        outputs['synctex'] = synctex_file
+                for kind, path in outputs.items():
+                    if os.path.exists(path):
+                        artifacts[kind] = {
+                            'path': os.path.relpath(path, workspace).replace(os.sep, '/'),
+                            'blob': store_blob(path),
+                        }
+                payload['artifacts'] = artifacts
+                payload['workdir'] = workspace
+                return jsonify(payload), status
+        finally:
+            with state_lock:
+                state['active'] -= 1
+            slots.release()
+
+    return worker
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a TeXHandler compile worker')
+    parser.add_argument('--bind', default='127.0.0.1:7001', help='host:port to listen on (default: %(default)s)')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                        help='Builds to run at once; more are refused with 503 (default: %(default)s)')
+    parser.add_argument('--store', default=DEFAULT_STORE,
+                        help='Directory for blobs and project workspaces (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    from werkzeug.serving import run_simple
+    host, _, port = args.bind.rpartition(':')
+    print(f'Compile worker on {args.bind} running {args.jobs} builds at once, store {args.store}')
+    run_simple(host or '127.0.0.1', int(port), create_worker_app(args.store, args.jobs), threaded=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
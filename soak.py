@@ -0,0 +1,381 @@
+"""Concurrency soak test for capacity planning.
+
+Simulates authors editing at the same time over HTTP: each session opens its
+own project (file tree, .tex list, main file), autosaves every second,
+compiles every minute, clicks into the PDF (SyncTeX) after each compile and
+refreshes the file tree now and then. The number of sessions ramps up stage
+by stage until a latency SLO or the error budget is broken, and every stage
+reports throughput, tail latency and error rate per endpoint.
+
+Without --url a local server is started (`app.py serve`) on a scratch
+projects folder. Unless --real-tex is given it gets a stub pdflatex that
+writes a small PDF, aux, log and SyncTeX file after --stub-compile-seconds,
+so runs work on machines without TeX.
+
+Usage:
+    python soak.py                                   # local server, stub pdflatex
+    python soak.py --start-users 5 --step 5 --max-users 100 --stage-seconds 60
+    python soak.py --url http://texhandler.internal:8000 --output soak.json
+"""
+import argparse
+import gzip
+import http.client
+import io
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import zipfile
+
+import benchmark
+
+# p95 latency objectives in milliseconds, per endpoint
+DEFAULT_SLOS = {
+    'open_project': 1000,
+    'get_file': 300,
+    'autosave': 300,
+    'refresh_tree': 500,
+    'compile': 30000,
+    'synctex': 500,
+}
+MAX_ERROR_RATE = 0.01  # Fraction of failed requests (5xx or no response) allowed per stage
+
+STUB_PDFLATEX = """#!{python}
+import gzip, os, sys, time
+args = sys.argv[1:]
+out_dir = args[args.index('-output-directory') + 1]
+job = args[args.index('-jobname') + 1]
+time.sleep({delay})
+for ext, data in (('.pdf', b'%PDF-1.4 stub'), ('.aux', b'\\\\relax'), ('.log', b'stub log')):
+    with open(os.path.join(out_dir, job + ext), 'wb') as f:
+        f.write(data)
+with gzip.open(os.path.join(out_dir, job + '.synctex.gz'), 'wt') as f:
+    f.write('SyncTeX Version:1\\nInput:1:' + os.path.join(os.getcwd(), '.', args[-1]) + '\\n')
+print('Output written on ' + job + '.pdf')
+"""
+
+
+class Recorder:
+    """Collects (endpoint, latency, ok) samples for the current stage"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = []
+
+    def record(self, endpoint, latency, ok):
+        with self.lock:
+            self.samples.append((endpoint, latency, ok))
+
+    def drain(self):
+        with self.lock:
+            samples, self.samples = self.samples, []
+        return samples
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def summarize(samples, duration):
+    """Per-endpoint count, throughput, latency percentiles (ms) and error rate"""
+    by_endpoint = {}
+    for endpoint, latency, ok in samples:
+        by_endpoint.setdefault(endpoint, []).append((latency, ok))
+    summary = {}
+    for endpoint, entries in sorted(by_endpoint.items()):
+        latencies = sorted(latency * 1000 for latency, _ in entries)
+        errors = sum(1 for _, ok in entries if not ok)
+        summary[endpoint] = {
+            'requests': len(entries),
+            'throughput_rps': round(len(entries) / duration, 3),
+            'p50_ms': round(percentile(latencies, 0.50), 2),
+            'p95_ms': round(percentile(latencies, 0.95), 2),
+            'p99_ms': round(percentile(latencies, 0.99), 2),
+            'max_ms': round(latencies[-1], 2),
+            'error_rate': round(errors / len(entries), 4),
+        }
+    return summary
+
+
+def slo_violations(summary, slos, max_error_rate):
+    violations = []
+    for endpoint, stats in summary.items():
+        if endpoint in slos and stats['p95_ms'] > slos[endpoint]:
+            violations.append(f'{endpoint} p95 {stats["p95_ms"]:.0f} ms > {slos[endpoint]} ms')
+        if stats['error_rate'] > max_error_rate:
+            violations.append(f'{endpoint} error rate {stats["error_rate"]:.1%} > {max_error_rate:.1%}')
+    return violations
+
+
+class Connection:
+    """A keep-alive HTTP connection that records every request it sends"""
+
+    def __init__(self, base_url, recorder):
+        parsed = urllib.parse.urlsplit(base_url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.prefix = parsed.path.rstrip('/')
+        self.recorder = recorder
+        self.connection = None
+
+    def request(self, endpoint, method, path, body=None):
+        """Send one request and record it; returns the body, or None on failure"""
+        headers = {'Accept-Encoding': 'gzip'}
+        if body is not None:
+            body = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        start = time.perf_counter()
+        try:
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.host, self.port, timeout=120)
+            self.connection.request(method, self.prefix + path, body=body, headers=headers)
+            response = self.connection.getresponse()
+            data = response.read()
+            if response.getheader('Content-Encoding') == 'gzip':
+                data = gzip.decompress(data)
+            ok = response.status < 500
+        except (OSError, http.client.HTTPException):
+            self.close()
+            data, ok = b'', False
+        self.recorder.record(endpoint, time.perf_counter() - start, ok)
+        return data if ok else None
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class Session(threading.Thread):
+    """One simulated author working on one project.
+
+    Like the browser, the session keeps autosaving while a compile runs: the
+    compile and the SyncTeX click that follows it go over a second connection
+    from a separate thread.
+    """
+
+    def __init__(self, base_url, project, recorder, stop, autosave_interval, compile_interval, seed):
+        super().__init__(daemon=True)
+        self.editor = Connection(base_url, recorder)
+        self.builder = Connection(base_url, recorder)
+        self.project = urllib.parse.quote(project)
+        self.stop = stop
+        self.autosave_interval = autosave_interval
+        self.compile_interval = compile_interval
+        self.rng = random.Random(seed)
+        self.build_thread = None
+
+    def compile_and_click(self, x, y):
+        if self.builder.request('compile', 'GET', f'/api/compile/{self.project}?file=main.tex') is not None:
+            self.builder.request('synctex', 'POST', f'/api/synctex/{self.project}/resolve',
+                                 {'page': 1, 'x': x, 'y': y})
+
+    def run(self):
+        project = self.project
+        self.editor.request('open_project', 'GET', f'/api/files/{project}')
+        self.editor.request('open_project', 'GET', f'/api/tex_files/{project}')
+        data = self.editor.request('get_file', 'GET', f'/api/file/{project}/main.tex')
+        try:
+            content = json.loads(data)['content']
+        except (TypeError, ValueError, KeyError):
+            content = '\\documentclass{article}\n\\begin{document}\nSoak\n\\end{document}\n'
+
+        # Spread sessions out so they don't all compile at the same moment
+        now = time.monotonic()
+        next_compile = now + self.rng.uniform(0, self.compile_interval)
+        next_refresh = now + self.rng.uniform(5, 15)
+        while not self.stop.wait(self.autosave_interval * self.rng.uniform(0.8, 1.2)):
+            content = content.replace('\\end{document}', f'% edit {self.rng.random()}\n\\end{{document}}', 1)
+            self.editor.request('autosave', 'PUT', f'/api/file/{project}/main.tex', {'content': content})
+            now = time.monotonic()
+            if now >= next_refresh:
+                self.editor.request('refresh_tree', 'GET', f'/api/files/{project}')
+                next_refresh = now + self.rng.uniform(5, 15)
+            if now >= next_compile and not (self.build_thread and self.build_thread.is_alive()):
+                self.build_thread = threading.Thread(
+                    target=self.compile_and_click, args=(self.rng.uniform(50, 500), self.rng.uniform(50, 700)),
+                    daemon=True)
+                self.build_thread.start()
+                next_compile = now + self.compile_interval
+        if self.build_thread:
+            self.build_thread.join()
+        self.editor.close()
+        self.builder.close()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_local_server(args, workdir):
+    """Start app.py serve on a scratch projects folder; returns (process, base URL)"""
+    # Every session connects from this machine, so the per-client admission limit is off
+    env = dict(os.environ, TEXHANDLER_PROJECTS_DIR=os.path.join(workdir, 'projects'), TEXHANDLER_ADMISSION_PER_CLIENT='0')
+    if not args.real_tex:
+        bin_dir = os.path.join(workdir, 'bin')
+        os.makedirs(bin_dir)
+        stub = os.path.join(bin_dir, 'pdflatex')
+        with open(stub, 'w') as f:
+            f.write(STUB_PDFLATEX.format(python=sys.executable, delay=args.stub_compile_seconds))
+        os.chmod(stub, 0o755)
+        env['PATH'] = bin_dir + os.pathsep + env.get('PATH', '')
+
+    port = free_port()
+    app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+    process = subprocess.Popen(
+        [sys.executable, app_path, 'serve', '--bind', f'127.0.0.1:{port}', '--workers', str(args.server_workers)],
+        env=env,
+    )
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return process, base_url
+        except OSError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('Local server did not start')
+
+
+def upload_project(base_url, name, archive_bytes):
+    """Create a session's project by uploading the generated archive"""
+    parsed = urllib.parse.urlsplit(base_url)
+    boundary = 'soak' + os.urandom(8).hex()
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{name}.zip"\r\n'
+            f'Content-Type: application/zip\r\n\r\n').encode() + archive_bytes + f'\r\n--{boundary}--\r\n'.encode()
+    connection = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=120)
+    try:
+        connection.request('POST', parsed.path.rstrip('/') + '/api/upload', body=body,
+                           headers={'Content-Type': f'multipart/form-data; boundary={boundary}'})
+        response = connection.getresponse()
+        response.read()
+        if response.status != 200:
+            raise RuntimeError(f'Uploading {name} failed with HTTP {response.status}')
+    finally:
+        connection.close()
+
+
+def run_soak(args, base_url, workdir):
+    project_dir = os.path.join(workdir, 'template')
+    files = benchmark.generate_project(project_dir, files=args.files, pages=args.pages, figures=2, bib_entries=50)
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for rel_path in files:
+            zf.write(os.path.join(project_dir, rel_path), rel_path)
+    archive_bytes = archive.getvalue()
+
+    slos = dict(DEFAULT_SLOS)
+    for item in args.slo or []:
+        endpoint, _, limit = item.partition('=')
+        slos[endpoint] = float(limit)
+
+    recorder = Recorder()
+    stop = threading.Event()
+    sessions = []
+    stages = []
+    users = args.start_users
+    try:
+        while users <= args.max_users:
+            while len(sessions) < users:
+                name = f'soak-{os.getpid()}-{len(sessions)}'
+                upload_project(base_url, name, archive_bytes)
+                session = Session(base_url, name, recorder, stop, args.autosave_interval,
+                                  args.compile_interval, seed=len(sessions))
+                session.start()
+                sessions.append(session)
+            recorder.drain()  # Only measure the stage itself
+            time.sleep(args.stage_seconds)
+            summary = summarize(recorder.drain(), args.stage_seconds)
+            violations = slo_violations(summary, slos, args.max_error_rate)
+            stages.append({'users': users, 'endpoints': summary, 'violations': violations})
+
+            total = sum(stats['throughput_rps'] for stats in summary.values())
+            print(f'\n{users} users: {total:.1f} req/s')
+            for endpoint, stats in summary.items():
+                print(f'  {endpoint:14} {stats["throughput_rps"]:8.2f} req/s  p50 {stats["p50_ms"]:9.1f} ms  '
+                      f'p95 {stats["p95_ms"]:9.1f} ms  p99 {stats["p99_ms"]:9.1f} ms  errors {stats["error_rate"]:.2%}')
+            if violations:
+                print('  SLO broken: ' + '; '.join(violations))
+                break
+            users += args.step
+    finally:
+        stop.set()
+        for session in sessions:
+            session.join(timeout=150)
+
+    sustained = [stage['users'] for stage in stages if not stage['violations']]
+    return {
+        'target': base_url,
+        'slos_ms': slos,
+        'max_error_rate': args.max_error_rate,
+        'autosave_interval': args.autosave_interval,
+        'compile_interval': args.compile_interval,
+        'stub_pdflatex': not args.real_tex and not args.url,
+        'max_sustained_users': max(sustained) if sustained else 0,
+        'stages': stages,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Ramp simulated editing sessions until latency SLOs break')
+    parser.add_argument('--url', help='Server to test; without it a local server is started')
+    parser.add_argument('--start-users', type=int, default=2, help='Sessions in the first stage (default: %(default)s)')
+    parser.add_argument('--step', type=int, default=2, help='Sessions added per stage (default: %(default)s)')
+    parser.add_argument('--max-users', type=int, default=50, help='Stop ramping here (default: %(default)s)')
+    parser.add_argument('--stage-seconds', type=float, default=30, help='Length of each stage (default: %(default)s)')
+    parser.add_argument('--autosave-interval', type=float, default=1.0,
+                        help='Seconds between autosaves of a session (default: %(default)s)')
+    parser.add_argument('--compile-interval', type=float, default=60.0,
+                        help='Seconds between compiles of a session (default: %(default)s)')
+    parser.add_argument('--slo', action='append', metavar='ENDPOINT=MS',
+                        help='Override a p95 objective, e.g. --slo autosave=200 (defaults: %s)'
+                             % ', '.join(f'{k}={v}' for k, v in DEFAULT_SLOS.items()))
+    parser.add_argument('--max-error-rate', type=float, default=MAX_ERROR_RATE,
+                        help='Allowed fraction of failed requests (default: %(default)s)')
+    parser.add_argument('--files', type=int, default=10, help='Section files per project (default: %(default)s)')
+    parser.add_argument('--pages', type=int, default=5, help='Pages of text per project (default: %(default)s)')
+    parser.add_argument('--server-workers', type=int, default=2,
+                        help='Worker processes of the local server (default: %(default)s)')
+    parser.add_argument('--real-tex', action='store_true', help='Use the installed pdflatex on the local server')
+    parser.add_argument('--stub-compile-seconds', type=float, default=1.0,
+                        help='How long the stub pdflatex takes per run (default: %(default)s)')
+    parser.add_argument('--output', help='Write the report to this JSON file')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='texhandler-soak-')
+    process = None
+    try:
+        base_url = args.url
+        if base_url is None:
+            process, base_url = start_local_server(args, workdir)
+        report = run_soak(args, base_url, workdir)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f'\nMaximum sustained sessions: {report["max_sustained_users"]}')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Wrote {args.output}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
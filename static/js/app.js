@@ -15,6 +15,9 @@ let editorSearchCaseSensitive = false;
 let editorSearchRegexMode = false;
 let autosaveEnabled = false;
 let autosaveTimeout = null;
+let pagedFile = null; // State of a large file being loaded page by page
+const PAGED_LOAD_THRESHOLD = 2 * 1024 * 1024; // Files larger than this are loaded in pages
+const PAGED_LOAD_LINES = 5000; // Lines fetched per page
 
 // LaTeX commands and environments for autocomplete
 const latexCommands = [
@@ -170,6 +173,45 @@ function latexHint(editor, options) {
     return null;
 }
 
+// \cite-like commands, capturing the keys typed so far inside the braces
+const CITE_COMMAND_RE = /\\(?:no|paren|text|auto|foot|super|full)?cite(?:[pt]|author|year|num)?\*?(?:\[[^\]]*\]){0,2}\{([^}]*)$/;
+let citeSearchController = null;
+
+// Citation key completion from the project's .bib files, searched on the server
+function citeHint(editor, callback) {
+    const cursor = editor.getCursor();
+    const match = editor.getLine(cursor.line).slice(0, cursor.ch).match(CITE_COMMAND_RE);
+    if (!match || !currentProject) {
+        callback(null);
+        return;
+    }
+    
+    // Complete the key after the last comma
+    const prefix = match[1].split(',').pop().trimStart();
+    if (citeSearchController) citeSearchController.abort();
+    citeSearchController = new AbortController();
+    const params = new URLSearchParams({q: prefix, limit: '20'});
+    fetch(`/api/cite_search/${currentProject}?${params}`, {signal: citeSearchController.signal})
+        .then(response => response.ok ? response.json() : {results: []})
+        .then(data => {
+            if (!data.results.length) {
+                callback(null);
+                return;
+            }
+            callback({
+                list: data.results.map(result => ({
+                    text: result.key,
+                    displayText: `${result.key}  ${result.author}${result.year ? ` (${result.year})` : ''}: ${result.title}`,
+                    className: 'latex-citation'
+                })),
+                from: CodeMirror.Pos(cursor.line, cursor.ch - prefix.length),
+                to: CodeMirror.Pos(cursor.line, cursor.ch)
+            });
+        })
+        .catch(() => callback(null));
+}
+citeHint.async = true;
+
 // Initialize CodeMirror editor
 function initEditor() {
     const editorElement = document.getElementById('editor');
@@ -249,8 +291,13 @@ function initEditor() {
             const line = cm.getLine(cursor.line);
             const ch = cursor.ch;
             
-            // Check if we're typing after a backslash
-            if (ch > 0) {
+            // Check if we're typing a citation key, or after a backslash
+            if (CITE_COMMAND_RE.test(line.slice(0, ch))) {
+                clearTimeout(autocompleteTimeout);
+                autocompleteTimeout = setTimeout(() => {
+                    CodeMirror.showHint(cm, citeHint, {completeSingle: false});
+                }, 150);
+            } else if (ch > 0) {
                 const char = line[ch - 1];
                 const beforeBackslash = line.lastIndexOf('\\', ch - 1);
                 
@@ -280,6 +327,15 @@ function initEditor() {
         }
     });
     
+    // Fetch more of a large file when scrolling close to the end of what is loaded
+    editor.on('scroll', (cm) => {
+        if (!pagedFile) return;
+        const info = cm.getScrollInfo();
+        if (info.top + info.clientHeight > info.height - info.clientHeight * 2) {
+            loadNextFilePage();
+        }
+    });
+    
     // Ensure editor fills the container
     const resizeEditor = () => {
         if (editor) {
@@ -741,7 +797,7 @@ function renderProjectsList(projects) {
                 <h3 class="project-name">${project.name}</h3>
             </div>
             <div class="project-info">
-                <div>Size: ${formatFileSize(project.size)}</div>
+                <div>Size: ${formatFileSize(project.size)}${project.disk_size !== undefined && project.disk_size < project.size ? ` (${formatFileSize(project.disk_size)} on disk)` : ''}</div>
                 <div>Modified: ${formatDate(project.modified)}</div>
             </div>
             <div class="project-actions">
@@ -1219,12 +1275,18 @@ function updateUploadButton() {
 function updateDownloadButton() {
     const downloadBtn = document.getElementById('downloadBtn');
     const compileCleanBtn = document.getElementById('compileCleanBtn');
+    const compileFocusBtn = document.getElementById('compileFocusBtn');
+    const compileDraftBtn = document.getElementById('compileDraftBtn');
     if (currentProject) {
         downloadBtn.style.display = 'inline-block';
         compileCleanBtn.style.display = 'inline-block';
+        compileFocusBtn.style.display = 'inline-block';
+        compileDraftBtn.style.display = 'inline-block';
     } else {
         downloadBtn.style.display = 'none';
         compileCleanBtn.style.display = 'none';
+        compileFocusBtn.style.display = 'none';
+        compileDraftBtn.style.display = 'none';
     }
 }
 
@@ -1262,6 +1324,7 @@ async function loadFile(projectName, filePath) {
         isImageFile = isImage(filePath);
         
         currentFilePath = filePath;
+        pagedFile = null;
         document.getElementById('currentFile').textContent = filePath;
         
         if (isImageFile) {
@@ -1283,7 +1346,14 @@ async function loadFile(projectName, filePath) {
             imageViewer.style.display = 'none';
             editorContainer.style.display = 'block';
             
-            const response = await fetch(`/api/file/${projectName}/${filePath}`);
+            // Large files are opened with their first page of lines, the rest
+            // is fetched as the user scrolls
+            const fileSize = findFileSize(filePath);
+            const paged = fileSize !== null && fileSize > PAGED_LOAD_THRESHOLD;
+            const url = paged
+                ? `/api/file/${projectName}/${filePath}?offset=0&limit=${PAGED_LOAD_LINES}`
+                : `/api/file/${projectName}/${filePath}`;
+            const response = await fetch(url);
             const data = await response.json();
             
             if (data.error) {
@@ -1302,13 +1372,83 @@ async function loadFile(projectName, filePath) {
             editor.setValue(data.content);
             editor.refresh(); // Refresh to ensure proper sizing
             
-            showStatus('File loaded: ' + filePath);
+            if (paged && data.next_offset < data.total_lines) {
+                pagedFile = {
+                    project: projectName,
+                    path: filePath,
+                    etag: response.headers.get('ETag'),
+                    nextOffset: data.next_offset,
+                    totalLines: data.total_lines,
+                    loading: false
+                };
+                // Editing a partially loaded file would truncate it on save
+                editor.setOption('readOnly', true);
+                showStatus(`Large file: loaded ${data.next_offset} of ${data.total_lines} lines (read-only until fully loaded)`);
+            } else {
+                editor.setOption('readOnly', false);
+                showStatus('File loaded: ' + filePath);
+            }
         }
     } catch (error) {
         showStatus('Error loading file: ' + error.message);
     }
 }
 
+// Look up a file's size in the loaded file tree (null if unknown)
+function findFileSize(filePath, nodes = fileTreeData) {
+    if (!nodes) return null;
+    for (const node of nodes) {
+        if (node.type === 'file' && node.path === filePath) {
+            return node.size;
+        }
+        if (node.type === 'directory' && filePath.startsWith(node.path + '/')) {
+            return findFileSize(filePath, node.children);
+        }
+    }
+    return null;
+}
+
+// Fetch the next page of a large file and append it to the editor
+async function loadNextFilePage() {
+    if (!pagedFile || pagedFile.loading || pagedFile.nextOffset >= pagedFile.totalLines) {
+        return;
+    }
+    const state = pagedFile;
+    state.loading = true;
+    try {
+        const response = await fetch(`/api/file/${state.project}/${state.path}?offset=${state.nextOffset}&limit=${PAGED_LOAD_LINES}`);
+        const data = await response.json();
+        // Ignore the page if the user opened another file meanwhile
+        if (pagedFile !== state) return;
+        if (data.error) {
+            showStatus('Error: ' + data.error);
+            return;
+        }
+        if (response.headers.get('ETag') !== state.etag) {
+            // The file changed on disk, start over
+            pagedFile = null;
+            await loadFile(state.project, state.path);
+            return;
+        }
+        
+        const lastLine = editor.lastLine();
+        editor.replaceRange(data.content, { line: lastLine, ch: editor.getLine(lastLine).length });
+        state.nextOffset = data.next_offset;
+        
+        if (state.nextOffset >= state.totalLines) {
+            pagedFile = null;
+            editor.setOption('readOnly', false);
+            showStatus('File loaded: ' + state.path);
+        } else {
+            showStatus(`Large file: loaded ${state.nextOffset} of ${state.totalLines} lines (read-only until fully loaded)`);
+        }
+    } catch (error) {
+        showStatus('Error loading file: ' + error.message);
+    } finally {
+        state.loading = false;
+    }
+}
+
 // Save file
 async function saveFile(isAutosave = false) {
     if (!currentProject || !currentFilePath) {
@@ -1325,6 +1465,13 @@ async function saveFile(isAutosave = false) {
         return;
     }
     
+    if (pagedFile) {
+        if (!isAutosave) {
+            showStatus('Cannot save until the whole file has been loaded');
+        }
+        return;
+    }
+    
     try {
         const content = editor.getValue();
         const response = await fetch(`/api/file/${currentProject}/${currentFilePath}`, {
@@ -1486,7 +1633,7 @@ async function createNewFolder() {
 }
 
 // Compile LaTeX
-async function compileLaTeX(cleanFirst = false) {
+async function compileLaTeX(cleanFirst = false, focus = false, profile = 'full') {
     if (!currentProject) {
         showStatus('No project selected');
         return;
@@ -1518,15 +1665,33 @@ async function compileLaTeX(cleanFirst = false) {
     try {
         // Build compile URL with selected file
         let url = `/api/compile/${currentProject}`;
+        const params = new URLSearchParams();
         if (compileFile) {
-            url += `?file=${encodeURIComponent(compileFile)}`;
+            params.set('file', compileFile);
+        }
+        // Focus compile: only the \include containing the open file is typeset
+        if (focus && currentFilePath) {
+            params.set('focus', currentFilePath);
+        }
+        // Draft profile: one pass with figure placeholders into a separate <name>-draft.pdf
+        if (profile !== 'full') {
+            params.set('profile', profile);
+        }
+        if (params.toString()) {
+            url += `?${params}`;
         }
         
         const response = await fetch(url);
         const data = await response.json();
         
         if (data.success) {
-            showStatus('Compilation successful');
+            if (focus && data.focus) {
+                showStatus(`Compiled only ${data.focus}`);
+            } else if (data.profile === 'draft') {
+                showStatus('Draft preview ready');
+            } else {
+                showStatus('Compilation successful');
+            }
             loadPDF(currentProject, data.pdf_path, data.synctex_path);
             // Display log even on success
             if (data.log) {
@@ -1673,7 +1838,8 @@ async function loadPDF(projectName, pdfPath, synctexPath = null) {
     
     try {
         // Set PDF.js worker
-        pdfjsLib.GlobalWorkerOptions.workerSrc = 'https://cdnjs.cloudflare.com/ajax/libs/pdf.js/3.11.174/pdf.worker.min.js';
+        // Use the self-hosted worker when the assets were built with build_assets.py
+        pdfjsLib.GlobalWorkerOptions.workerSrc = window.PDFJS_WORKER_SRC || 'https://cdnjs.cloudflare.com/ajax/libs/pdf.js/3.11.174/pdf.worker.min.js';
         
         // Load PDF
         const loadingTask = pdfjsLib.getDocument(`/api/pdf/${projectName}/${pdfPath}`);
@@ -1724,10 +1890,32 @@ async function renderAllPDFPages(scale = null) {
         container.id = 'pdfContainer';
         showStatus(`Rendering ${pdfDoc.numPages} pages...`);
         
-        // Render all pages
+        // Page sizes and server-rendered page images, when the server has them
+        const previews = await fetchPDFPagePreviews();
+        
+        // Lay out every page at once; PDF.js only renders the pages that come into view
+        if (pdfPageObserver) {
+            pdfPageObserver.disconnect();
+        }
+        pdfPageObserver = new IntersectionObserver((entries) => {
+            entries.forEach((entry) => {
+                if (entry.isIntersecting) {
+                    renderPDFPageContent(entry.target, scale);
+                }
+            });
+        }, { root: viewer, rootMargin: '100% 0px' });
+        
         for (let pageNum = 1; pageNum <= pdfDoc.numPages; pageNum++) {
-            const page = await pdfDoc.getPage(pageNum);
-            const viewport = page.getViewport({ scale });
+            const preview = previews ? previews.pages[pageNum - 1] : null;
+            let width, height;
+            if (preview) {
+                width = preview.width * scale;
+                height = preview.height * scale;
+            } else {
+                const viewport = (await pdfDoc.getPage(pageNum)).getViewport({ scale });
+                width = viewport.width;
+                height = viewport.height;
+            }
             
             // Create page container
             const pageContainer = document.createElement('div');
@@ -1737,165 +1925,11 @@ async function renderAllPDFPages(scale = null) {
                 box-shadow: 0 2px 8px rgba(0,0,0,0.3);
                 background: white;
                 position: relative;
+                width: ${width}px;
+                height: ${height}px;
             `;
             pageContainer.dataset.pageNum = pageNum;
-            
-            // Create canvas
-            const canvas = document.createElement('canvas');
-            const context = canvas.getContext('2d');
-            canvas.height = viewport.height;
-            canvas.width = viewport.width;
-            canvas.style.display = 'block';
-            canvas.className = 'pdf-page-canvas';
-            canvas.style.pointerEvents = 'none'; // Allow clicks to pass through to text layer
-            
-            // Render PDF page
-            const renderContext = {
-                canvasContext: context,
-                viewport: viewport
-            };
-            
-            await page.render(renderContext).promise;
-            
-            // Add text layer for text selection
-            const textLayerDiv = document.createElement('div');
-            textLayerDiv.className = 'textLayer';
-            textLayerDiv.style.cssText = `
-                position: absolute;
-                left: 0;
-                top: 0;
-                width: ${viewport.width}px;
-                height: ${viewport.height}px;
-                overflow: hidden;
-                opacity: 1; /* Ensure selection highlight is visible */
-                line-height: 1.0;
-                user-select: text;
-                -webkit-user-select: text;
-                -moz-user-select: text;
-                -ms-user-select: text;
-                pointer-events: auto;
-                z-index: 2;
-            `;
-            
-            // Render text layer for text selection
-            const textContent = await page.getTextContent();
-            
-            // Render text items manually for better control
-            textContent.items.forEach((item) => {
-                if (!item.str || item.str.trim() === '') return;
-                
-                // Calculate transform - item.transform is already in PDF coordinates
-                // We need to apply viewport scaling
-                const itemTransform = item.transform || [1, 0, 0, 1, 0, 0];
-                
-                // Apply viewport scale to the transform
-                const scaleX = viewport.transform ? viewport.transform[0] : scale;
-                const scaleY = viewport.transform ? viewport.transform[3] : scale;
-                
-                // Calculate position and size
-                const x = itemTransform[4] * scaleX;
-                const y = itemTransform[5] * scaleY;
-                const fontSize = Math.abs(itemTransform[0] * scaleX);
-                
-                const span = document.createElement('span');
-                span.textContent = item.str;
-                span.setAttribute('role', 'presentation');
-                span.style.cssText = `
-                    position: absolute;
-                    left: ${x}px;
-                    top: ${y}px;
-                    font-size: ${fontSize}px;
-                    font-family: ${item.fontName || 'sans-serif'};
-                    transform: matrix(${itemTransform[0] * scaleX}, ${itemTransform[1] * scaleY}, ${itemTransform[2] * scaleX}, ${itemTransform[3] * scaleY}, 0, 0);
-                    transform-origin: 0% 0%;
-                    white-space: pre;
-                    cursor: text;
-                    color: transparent;
-                `;
-                textLayerDiv.appendChild(span);
-            });
-            
-            // Add link layer for clickable links
-            const linkService = {
-                getDestinationHash: () => '',
-                getAnchorUrl: () => '',
-                navigateTo: (dest) => {
-                    // Handle internal navigation
-                    if (dest && dest.dest) {
-                        // Try to resolve destination
-                        pdfDoc.getDestination(dest.dest).then((destArray) => {
-                            if (destArray && destArray[0]) {
-                                pdfDoc.getPageIndex(destArray[0]).then((pageIndex) => {
-                                    scrollToPDFPage(pageIndex + 1);
-                                });
-                            }
-                        });
-                    }
-                },
-                executeNamedAction: (action) => {
-                    // Handle named actions
-                },
-                cachePageRef: () => {},
-                isPageVisible: () => true,
-                isPageCached: () => true
-            };
-            
-            const linkDiv = document.createElement('div');
-            linkDiv.className = 'linkLayer';
-            linkDiv.style.cssText = `
-                position: absolute;
-                left: 0;
-                top: 0;
-                width: ${viewport.width}px;
-                height: ${viewport.height}px;
-                pointer-events: none; /* Allow clicks to pass through to text layer */
-                z-index: 3;
-            `;
-            
-            // Handle link clicks - need to ensure links are clickable despite container pointer-events: none
-            // We'll add a global style for links in the linkLayer to have pointer-events: auto
-            const style = document.createElement('style');
-            style.textContent = `
-                .linkLayer a {
-                    pointer-events: auto;
-                    cursor: pointer;
-                }
-            `;
-            linkDiv.appendChild(style);
-            
-            // Get annotations (links)
-            page.getAnnotations().then((annotations) => {
-                if (annotations && annotations.length > 0) {
-                    pdfjsLib.AnnotationLayer.render({
-                        viewport: viewport,
-                        div: linkDiv,
-                        annotations: annotations,
-                        linkService: linkService,
-                        downloadManager: null,
-                        annotationStorage: null
-                    });
-                }
-            }).catch(err => {
-                console.log('No annotations for page', pageNum);
-            });
-            
-            // Handle link clicks
-            linkDiv.addEventListener('click', (event) => {
-                const link = event.target.closest('a');
-                if (link) {
-                    const url = link.href;
-                    if (url && url.startsWith('http')) {
-                        // External link - open in new tab
-                        window.open(url, '_blank');
-                        event.preventDefault();
-                    } else if (url && url.startsWith('#')) {
-                        // Internal reference - try to jump
-                        event.preventDefault();
-                        // Handle internal references
-                        handlePDFReference(url);
-                    }
-                }
-            });
+            setPDFPagePreview(pageContainer, preview);
             
             // Add page number label
             const pageLabel = document.createElement('div');
@@ -1912,16 +1946,7 @@ async function renderAllPDFPages(scale = null) {
                 z-index: 5;
             `;
             pageLabel.textContent = `Page ${pageNum}`;
-            
-            // Append in correct order: canvas (background), then text layer (selectable), then links (clickable)
             pageContainer.appendChild(pageLabel);
-            pageContainer.appendChild(canvas);
-            pageContainer.appendChild(textLayerDiv);
-            pageContainer.appendChild(linkDiv);
-            
-            // Make sure text layer is on top for selection
-            textLayerDiv.style.zIndex = '2';
-            linkDiv.style.zIndex = '3'; // Links should be on top
             
             // Track focus on PDF
             pageContainer.addEventListener('mousedown', () => {
@@ -1929,11 +1954,11 @@ async function renderAllPDFPages(scale = null) {
             });
             
             container.appendChild(pageContainer);
-            
-            // Update status
-            if (pageNum % 5 === 0 || pageNum === pdfDoc.numPages) {
-                showStatus(`Rendered ${pageNum} of ${pdfDoc.numPages} pages...`);
-            }
+            pdfPageObserver.observe(pageContainer);
+        }
+        
+        if (previews && previews.pending) {
+            pollPDFPagePreviews(currentPdfPath);
         }
         
         viewer.appendChild(container);
@@ -1957,6 +1982,244 @@ async function renderAllPDFPages(scale = null) {
     }
 }
 
+// Server-rendered page images shown until PDF.js has drawn a page
+let pdfPageObserver = null;
+
+async function fetchPDFPagePreviews() {
+    try {
+        const response = await fetch(`/api/pages/${currentProject}/${currentPdfPath}`);
+        if (!response.ok) return null;
+        const data = await response.json();
+        return data.pages.length === pdfDoc.numPages ? data : null;
+    } catch (error) {
+        return null;
+    }
+}
+
+function setPDFPagePreview(pageContainer, preview) {
+    const url = preview && (preview.preview || preview.thumb);
+    if (!url || pageContainer.dataset.rendered) return;
+    let img = pageContainer.querySelector('.pdf-page-preview');
+    if (!img) {
+        img = document.createElement('img');
+        img.className = 'pdf-page-preview';
+        img.alt = '';
+        img.style.cssText = 'position: absolute; left: 0; top: 0; width: 100%; height: 100%; pointer-events: none;';
+        pageContainer.insertBefore(img, pageContainer.firstChild);
+    }
+    img.src = url;
+}
+
+// Pick up page images that the server finishes after the PDF was opened
+function pollPDFPagePreviews(pdfPath, attempt = 0) {
+    if (attempt >= 10) return;
+    setTimeout(async () => {
+        if (pdfPath !== currentPdfPath || !pdfDoc) return;
+        const previews = await fetchPDFPagePreviews();
+        if (!previews) return;
+        document.querySelectorAll('#pdfContainer .pdf-page-container').forEach((pageContainer) => {
+            setPDFPagePreview(pageContainer, previews.pages[parseInt(pageContainer.dataset.pageNum) - 1]);
+        });
+        if (previews.pending) {
+            pollPDFPagePreviews(pdfPath, attempt + 1);
+        }
+    }, 2000);
+}
+
+// Make sure a page has its canvas and text layer (e.g. before highlighting text on it)
+async function ensurePDFPageRendered(pageNum) {
+    const pageContainer = document.querySelector(`#pdfContainer [data-page-num="${pageNum}"]`);
+    if (pageContainer) {
+        await renderPDFPageContent(pageContainer, pdfZoomScale);
+    }
+}
+
+// Render one page with PDF.js: canvas, text layer for selection and link layer
+async function renderPDFPageContent(pageContainer, scale) {
+    if (pageContainer.renderPromise) {
+        return pageContainer.renderPromise;
+    }
+    pageContainer.dataset.rendered = 'true';
+    pageContainer.renderPromise = (async () => {
+        const pageNum = parseInt(pageContainer.dataset.pageNum);
+        const page = await pdfDoc.getPage(pageNum);
+        const viewport = page.getViewport({ scale });
+        
+        // Create canvas
+        const canvas = document.createElement('canvas');
+        const context = canvas.getContext('2d');
+        canvas.height = viewport.height;
+        canvas.width = viewport.width;
+        canvas.style.display = 'block';
+        canvas.className = 'pdf-page-canvas';
+        canvas.style.pointerEvents = 'none'; // Allow clicks to pass through to text layer
+        
+        // Render PDF page
+        const renderContext = {
+            canvasContext: context,
+            viewport: viewport
+        };
+        
+        await page.render(renderContext).promise;
+        
+        // Add text layer for text selection
+        const textLayerDiv = document.createElement('div');
+        textLayerDiv.className = 'textLayer';
+        textLayerDiv.style.cssText = `
+            position: absolute;
+            left: 0;
+            top: 0;
+            width: ${viewport.width}px;
+            height: ${viewport.height}px;
+            overflow: hidden;
+            opacity: 1; /* Ensure selection highlight is visible */
+            line-height: 1.0;
+            user-select: text;
+            -webkit-user-select: text;
+            -moz-user-select: text;
+            -ms-user-select: text;
+            pointer-events: auto;
+            z-index: 2;
+        `;
+        
+        // Render text layer for text selection
+        const textContent = await page.getTextContent();
+        
+        // Render text items manually for better control
+        textContent.items.forEach((item) => {
+            if (!item.str || item.str.trim() === '') return;
+        
+            // Calculate transform - item.transform is already in PDF coordinates
+            // We need to apply viewport scaling
+            const itemTransform = item.transform || [1, 0, 0, 1, 0, 0];
+        
+            // Apply viewport scale to the transform
+            const scaleX = viewport.transform ? viewport.transform[0] : scale;
+            const scaleY = viewport.transform ? viewport.transform[3] : scale;
+        
+            // Calculate position and size
+            const x = itemTransform[4] * scaleX;
+            const y = itemTransform[5] * scaleY;
+            const fontSize = Math.abs(itemTransform[0] * scaleX);
+        
+            const span = document.createElement('span');
+            span.textContent = item.str;
+            span.setAttribute('role', 'presentation');
+            span.style.cssText = `
+                position: absolute;
+                left: ${x}px;
+                top: ${y}px;
+                font-size: ${fontSize}px;
+                font-family: ${item.fontName || 'sans-serif'};
+                transform: matrix(${itemTransform[0] * scaleX}, ${itemTransform[1] * scaleY}, ${itemTransform[2] * scaleX}, ${itemTransform[3] * scaleY}, 0, 0);
+                transform-origin: 0% 0%;
+                white-space: pre;
+                cursor: text;
+                color: transparent;
+            `;
+            textLayerDiv.appendChild(span);
+        });
+        
+        // Add link layer for clickable links
+        const linkService = {
+            getDestinationHash: () => '',
+            getAnchorUrl: () => '',
+            navigateTo: (dest) => {
+                // Handle internal navigation
+                if (dest && dest.dest) {
+                    // Try to resolve destination
+                    pdfDoc.getDestination(dest.dest).then((destArray) => {
+                        if (destArray && destArray[0]) {
+                            pdfDoc.getPageIndex(destArray[0]).then((pageIndex) => {
+                                scrollToPDFPage(pageIndex + 1);
+                            });
+                        }
+                    });
+                }
+            },
+            executeNamedAction: (action) => {
+                // Handle named actions
+            },
+            cachePageRef: () => {},
+            isPageVisible: () => true,
+            isPageCached: () => true
+        };
+        
+        const linkDiv = document.createElement('div');
+        linkDiv.className = 'linkLayer';
+        linkDiv.style.cssText = `
+            position: absolute;
+            left: 0;
+            top: 0;
+            width: ${viewport.width}px;
+            height: ${viewport.height}px;
+            pointer-events: none; /* Allow clicks to pass through to text layer */
+            z-index: 3;
+        `;
+        
+        // Handle link clicks - need to ensure links are clickable despite container pointer-events: none
+        // We'll add a global style for links in the linkLayer to have pointer-events: auto
+        const style = document.createElement('style');
+        style.textContent = `
+            .linkLayer a {
+                pointer-events: auto;
+                cursor: pointer;
+            }
+        `;
+        linkDiv.appendChild(style);
+        
+        // Get annotations (links)
+        page.getAnnotations().then((annotations) => {
+            if (annotations && annotations.length > 0) {
+                pdfjsLib.AnnotationLayer.render({
+                    viewport: viewport,
+                    div: linkDiv,
+                    annotations: annotations,
+                    linkService: linkService,
+                    downloadManager: null,
+                    annotationStorage: null
+                });
+            }
+        }).catch(err => {
+            console.log('No annotations for page', pageNum);
+        });
+        
+        // Handle link clicks
+        linkDiv.addEventListener('click', (event) => {
+            const link = event.target.closest('a');
+            if (link) {
+                const url = link.href;
+                if (url && url.startsWith('http')) {
+                    // External link - open in new tab
+                    window.open(url, '_blank');
+                    event.preventDefault();
+                } else if (url && url.startsWith('#')) {
+                    // Internal reference - try to jump
+                    event.preventDefault();
+                    // Handle internal references
+                    handlePDFReference(url);
+                }
+            }
+        });
+        
+    
+        // Append in correct order: canvas (background), then text layer (selectable), then links (clickable)
+        pageContainer.appendChild(canvas);
+        pageContainer.appendChild(textLayerDiv);
+        pageContainer.appendChild(linkDiv);
+        
+        // Make sure text layer is on top for selection
+        textLayerDiv.style.zIndex = '2';
+        linkDiv.style.zIndex = '3'; // Links should be on top
+        
+        const img = pageContainer.querySelector('.pdf-page-preview');
+        if (img) {
+            img.remove();
+        }
+    })();
+    return pageContainer.renderPromise;
+}
+
 // Helper function to render a single page (for compatibility)
 async function renderPDFPage(pageNum) {
     // Scroll to the requested page
@@ -2004,9 +2267,8 @@ async function handlePDFClick(event) {
     const pageContainer = event.target.closest('.pdf-page-container');
     if (!pageContainer) return;
     
-    // Find the canvas to determine relative coordinates
-    const canvas = pageContainer.querySelector('canvas');
-    if (!canvas) return;
+    // Find the canvas to determine relative coordinates (the page itself while only its preview image is shown)
+    const canvas = pageContainer.querySelector('canvas') || pageContainer;
     
     // Check if user is selecting text (if selection is not empty, don't jump)
     const selection = window.getSelection();
@@ -2097,6 +2359,39 @@ function handlePDFReference(refUrl) {
     }
 }
 
+// Fetch several project files in one request. The server streams one JSON
+// record per line (NDJSON); onRecord is called as each record arrives.
+async function fetchFilesBulk(projectName, paths, onRecord, etags = {}) {
+    const response = await fetch(`/api/files/${projectName}/bulk`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ paths: paths, etags: etags })
+    });
+    if (!response.ok) {
+        const data = await response.json();
+        throw new Error(data.error || 'Bulk fetch failed');
+    }
+    
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const { done, value } = await reader.read();
+        if (value) {
+            buffer += decoder.decode(value, { stream: !done });
+        }
+        let newlineIndex;
+        while ((newlineIndex = buffer.indexOf('\n')) !== -1) {
+            const line = buffer.slice(0, newlineIndex);
+            buffer = buffer.slice(newlineIndex + 1);
+            if (line.trim()) {
+                onRecord(JSON.parse(line));
+            }
+        }
+        if (done) break;
+    }
+}
+
 // Find reference in source files
 async function findReferenceInSource(refName) {
     try {
@@ -2105,23 +2400,27 @@ async function findReferenceInSource(refName) {
         const data = await response.json();
         
         if (data.tex_files) {
-            // Search through all .tex files
+            // Fetch all .tex files in one request, then search them in project order
+            const contents = {};
+            await fetchFilesBulk(currentProject, data.tex_files.map(f => f.path), record => {
+                if (record.content) {
+                    contents[record.path] = record.content;
+                }
+            });
+            
+            // Look for \label{refName}
+            const labelPattern = new RegExp(`\\\\label\\{${refName}\\}`, 'i');
             for (const texFile of data.tex_files) {
-                const fileResponse = await fetch(`/api/file/${currentProject}/${texFile.path}`);
-                const fileData = await fileResponse.json();
+                const content = contents[texFile.path];
+                if (!content) continue;
                 
-                if (fileData.content) {
-                    // Look for \label{refName} or \ref{refName}
-                    const labelPattern = new RegExp(`\\\\label\\{${refName}\\}`, 'i');
-                    const lines = fileData.content.split('\n');
-                    
-                    for (let i = 0; i < lines.length; i++) {
-                        if (labelPattern.test(lines[i])) {
-                            // Found the label, load the file and jump to line
-                            await loadFileAndJumpToLine(currentProject, texFile.path, i + 1);
-                            showStatus(`Found reference "${refName}" in ${texFile.path}:${i + 1}`);
-                            return;
-                        }
+                const lines = content.split('\n');
+                for (let i = 0; i < lines.length; i++) {
+                    if (labelPattern.test(lines[i])) {
+                        // Found the label, load the file and jump to line
+                        await loadFileAndJumpToLine(currentProject, texFile.path, i + 1);
+                        showStatus(`Found reference "${refName}" in ${texFile.path}:${i + 1}`);
+                        return;
                     }
                 }
             }
@@ -2138,6 +2437,7 @@ let pdfSearchResults = [];
 let currentPdfSearchIndex = -1;
 let pdfSearchCaseSensitive = false;
 let pdfSearchRegexMode = false;
+let pdfSearchSequence = 0; // Incremented per search, so stale results are dropped
 let pdfZoomScale = 1.5; // Default zoom scale
 let pdfOriginalScale = 1.5; // Store original scale for reset
 let isRenderingPDF = false; // Flag to prevent concurrent renders
@@ -2269,9 +2569,31 @@ function initPDFSearch() {
     });
 }
 
+// Search with the server's per-page text index; null when it cannot answer yet
+async function searchPDFOnServer(query) {
+    const params = new URLSearchParams({ q: query });
+    if (pdfSearchRegexMode) params.set('regex', '1');
+    if (pdfSearchCaseSensitive) params.set('case', '1');
+    try {
+        const response = await fetch(`/api/pdf_search/${currentProject}/${currentPdfPath}?${params}`);
+        if (!response.ok) return null;
+        const data = await response.json();
+        if (!data.available || data.pending) return null;
+        return data.results.map(result => ({
+            page: result.page,
+            text: result.text,
+            matchText: result.text,
+            rects: result.rects
+        }));
+    } catch (error) {
+        return null;
+    }
+}
+
 // Search in PDF
 async function searchPDF(query) {
     if (!pdfDoc || !query.trim()) {
+        pdfSearchSequence++;
         clearPDFSearchHighlights();
         pdfSearchResults = [];
         currentPdfSearchIndex = -1;
@@ -2302,31 +2624,39 @@ async function searchPDF(query) {
         searchPattern = new RegExp(escapedQuery, flags);
     }
     
-    // Search through all pages
-    for (let pageNum = 1; pageNum <= pdfDoc.numPages; pageNum++) {
-        const page = await pdfDoc.getPage(pageNum);
-        const textContent = await page.getTextContent();
-        
-        const items = textContent.items;
-        for (let i = 0; i < items.length; i++) {
-            const item = items[i];
-            if (item.str) {
-                // Search for matches within the text item (word boundaries)
-                let match;
-                // Reset regex lastIndex to search from beginning
-                searchPattern.lastIndex = 0;
-                while ((match = searchPattern.exec(item.str)) !== null) {
-                    pdfSearchResults.push({
-                        page: pageNum,
-                        text: item.str,
-                        matchText: match[0],
-                        matchIndex: match.index,
-                        matchLength: match[0].length,
-                        transform: item.transform,
-                        itemIndex: i
-                    });
-                    // If not global flag, break after first match
-                    if (!searchPattern.global) break;
+    // The server's text index answers at once; extract the text here while it is not ready
+    const searchId = ++pdfSearchSequence;
+    const serverResults = await searchPDFOnServer(query);
+    if (searchId !== pdfSearchSequence) return; // A newer search has started
+    if (serverResults) {
+        pdfSearchResults = serverResults;
+    } else {
+        // Search through all pages
+        for (let pageNum = 1; pageNum <= pdfDoc.numPages; pageNum++) {
+            const page = await pdfDoc.getPage(pageNum);
+            const textContent = await page.getTextContent();
+            
+            const items = textContent.items;
+            for (let i = 0; i < items.length; i++) {
+                const item = items[i];
+                if (item.str) {
+                    // Search for matches within the text item (word boundaries)
+                    let match;
+                    // Reset regex lastIndex to search from beginning
+                    searchPattern.lastIndex = 0;
+                    while ((match = searchPattern.exec(item.str)) !== null) {
+                        pdfSearchResults.push({
+                            page: pageNum,
+                            text: item.str,
+                            matchText: match[0],
+                            matchIndex: match.index,
+                            matchLength: match[0].length,
+                            transform: item.transform,
+                            itemIndex: i
+                        });
+                        // If not global flag, break after first match
+                        if (!searchPattern.global) break;
+                    }
                 }
             }
         }
@@ -2383,42 +2713,71 @@ function updatePDFSearchResults() {
 }
 
 // Highlight PDF search result
-function highlightPDFSearchResult(result, scrollToResult = true) {
+async function highlightPDFSearchResult(result, scrollToResult = true) {
     clearPDFSearchHighlights();
     
     // Find the text layer element for this page
     const container = document.getElementById('pdfContainer');
     if (!container) return;
     
-        const pageContainer = container.querySelector(`[data-page-num="${result.page}"]`);
-        if (!pageContainer) return;
-        
-        const textLayer = pageContainer.querySelector('.textLayer');
-        if (!textLayer) return;
-        
-        // Get the span element for this text item
-        const spans = textLayer.querySelectorAll('span');
-        const targetSpan = spans[result.itemIndex];
+    const pageContainer = container.querySelector(`[data-page-num="${result.page}"]`);
+    if (!pageContainer) return;
+    
+    // Results of the server-side search come with match boxes in points from the top left
+    if (result.rects) {
+        const overlays = result.rects.map((rect) => {
+            const overlay = document.createElement('div');
+            overlay.className = 'pdf-search-highlight';
+            overlay.style.cssText = `
+                position: absolute;
+                left: ${rect[0] * pdfZoomScale}px;
+                top: ${rect[1] * pdfZoomScale}px;
+                width: ${(rect[2] - rect[0]) * pdfZoomScale}px;
+                height: ${(rect[3] - rect[1]) * pdfZoomScale}px;
+                background: rgba(255, 255, 0, 0.4);
+                pointer-events: none;
+                z-index: 4;
+            `;
+            pageContainer.appendChild(overlay);
+            return overlay;
+        });
+        if (scrollToResult && overlays.length > 0) {
+            scrollToPDFPage(result.page);
+            setTimeout(() => {
+                overlays[0].scrollIntoView({ behavior: 'smooth', block: 'center' });
+            }, 200);
+        }
+        return;
+    }
+    
+    await ensurePDFPageRendered(result.page);
+    const textLayer = pageContainer.querySelector('.textLayer');
+    if (!textLayer) return;
+    
+    // Get the span element for this text item
+    const spans = textLayer.querySelectorAll('span');
+    const targetSpan = spans[result.itemIndex];
+    
+    if (targetSpan) {
+        // Highlight the matching text
+        targetSpan.style.backgroundColor = 'yellow';
+        targetSpan.style.color = 'black';
         
-        if (targetSpan) {
-            // Highlight the matching text
-            targetSpan.style.backgroundColor = 'yellow';
-            targetSpan.style.color = 'black';
-            
-            // Scroll to the page and then to the span if requested
-            if (scrollToResult) {
-                // Scroll to page first (gently)
-                scrollToPDFPage(result.page);
-                // Wait a bit for page scroll, then scroll to the specific span
-                setTimeout(() => {
-                    targetSpan.scrollIntoView({ behavior: 'smooth', block: 'center' });
-                }, 200);
-            }
+        // Scroll to the page and then to the span if requested
+        if (scrollToResult) {
+            // Scroll to page first (gently)
+            scrollToPDFPage(result.page);
+            // Wait a bit for page scroll, then scroll to the specific span
+            setTimeout(() => {
+                targetSpan.scrollIntoView({ behavior: 'smooth', block: 'center' });
+            }, 200);
         }
+    }
 }
 
 // Clear PDF search highlights
 function clearPDFSearchHighlights() {
+    document.querySelectorAll('.pdf-search-highlight').forEach(overlay => overlay.remove());
     const textLayers = document.querySelectorAll('.textLayer span');
     textLayers.forEach(span => {
         span.style.backgroundColor = '';
@@ -2590,6 +2949,7 @@ async function highlightPDFLocation(pageNum, x, y) {
     
     // Wait a bit for scroll to complete
     await new Promise(resolve => setTimeout(resolve, 300));
+    await ensurePDFPageRendered(pageNum);
     
     // Find the canvas for this page
     const container = viewer.querySelector('#pdfContainer');
@@ -2649,14 +3009,32 @@ async function highlightPDFLocation(pageNum, x, y) {
 async function uploadFile(file) {
     const formData = new FormData();
     formData.append('file', file);
+    // Lets us poll the server for extraction progress while the request runs
+    const uploadId = Date.now().toString(36) + Math.random().toString(36).slice(2);
+    formData.append('upload_id', uploadId);
     
     showStatus('Uploading...');
     
+    const progressTimer = setInterval(async () => {
+        try {
+            const progressResponse = await fetch(`/api/upload/progress/${uploadId}`);
+            if (!progressResponse.ok) return;
+            const progress = await progressResponse.json();
+            if (progress.state === 'extracting' && progress.bytes_total) {
+                const percent = Math.min(100, Math.round(100 * (progress.bytes_done || 0) / progress.bytes_total));
+                showStatus(`Extracting... ${percent}% (${formatFileSize(progress.bytes_done || 0)} of ${formatFileSize(progress.bytes_total)})`);
+            }
+        } catch (error) {
+            // Progress is best effort
+        }
+    }, 1000);
+    
     try {
         const response = await fetch('/api/upload', {
             method: 'POST',
             body: formData
         });
+        clearInterval(progressTimer);
         
         const data = await response.json();
         if (data.success) {
@@ -2668,6 +3046,7 @@ async function uploadFile(file) {
             showStatus('Upload failed: ' + (data.error || 'Unknown error'));
         }
     } catch (error) {
+        clearInterval(progressTimer);
         showStatus('Error uploading: ' + error.message);
     }
 }
@@ -3205,6 +3584,8 @@ document.addEventListener('DOMContentLoaded', () => {
     // Compile button
     document.getElementById('compileBtn').addEventListener('click', () => compileLaTeX(false));
     document.getElementById('compileCleanBtn').addEventListener('click', compileClean);
+    document.getElementById('compileFocusBtn').addEventListener('click', () => compileLaTeX(false, true));
+    document.getElementById('compileDraftBtn').addEventListener('click', () => compileLaTeX(false, false, 'draft'));
     
     // Log panel controls
     document.getElementById('toggleLogPanelBtn').addEventListener('click', toggleLogPanel);
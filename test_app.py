@@ -4,6 +4,9 @@ import shutil
 import tempfile
 import zipfile
 import json
+import io
+import subprocess
+import sys
 from pathlib import Path
 import app
 
@@ -31,6 +34,7 @@ def client():
     
     # Restore original
     app.UPLOAD_FOLDER = original_upload_folder
+    app.admission_controller = app.AdmissionController()  # Slots of responses the test client never closed
 
 @pytest.fixture
 def test_project(client):
@@ -148,6 +152,17 @@ def test_get_file(client, test_project):
     assert 'content' in data
     assert '\\documentclass' in data['content']
 
+def test_get_file_etag(client, test_project):
+    """Test that only an exact entity tag or * gives a 304"""
+    etag = client.get(f'/api/file/{test_project}/main.tex').headers['ETag']
+    for header in (etag, f'"other", W/{etag}', '*'):
+        response = client.get(f'/api/file/{test_project}/main.tex', headers={'If-None-Match': header})
+        assert response.status_code == 304
+    # A tag that merely contains the current one is a different tag
+    for header in (f'"x{etag[1:]}', '"other"', etag[:-2] + '"'):
+        response = client.get(f'/api/file/{test_project}/main.tex', headers={'If-None-Match': header})
+        assert response.status_code == 200
+
 def test_get_file_not_found(client, test_project):
     """Test getting a non-existent file"""
     response = client.get(f'/api/file/{test_project}/nonexistent.tex')
@@ -448,6 +463,1209 @@ def test_file_path_security(client, test_project):
     response = client.get(f'/api/file/{test_project}/../../etc/passwd')
     assert response.status_code in [400, 404]
 
+def test_get_files_bulk(client, test_project):
+    """Test fetching several files in one NDJSON response"""
+    response = client.post(f'/api/files/{test_project}/bulk',
+                          json={'paths': ['main.tex', 'sections/intro.tex', 'missing.tex']})
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    records = {r['path']: r for r in map(json.loads, response.data.decode().splitlines())}
+    assert 'Hello World' in records['main.tex']['content']
+    assert 'introduction' in records['sections/intro.tex']['content']
+    assert records['missing.tex']['error'] == 'File not found'
+    
+    # Files whose ETag still matches come back without content
+    etag = records['main.tex']['etag']
+    response = client.post(f'/api/files/{test_project}/bulk',
+                          json={'paths': ['main.tex'], 'etags': {'main.tex': etag}})
+    record = json.loads(response.data.decode().splitlines()[0])
+    assert record['unchanged'] == True
+    assert 'content' not in record
+
+def test_get_files_bulk_path_security(client, test_project):
+    """Test that the bulk endpoint rejects path traversal per file"""
+    response = client.post(f'/api/files/{test_project}/bulk',
+                          json={'paths': ['../../etc/passwd']})
+    assert response.status_code == 200
+    record = json.loads(response.data.decode().splitlines()[0])
+    assert record['error'] == 'Invalid path'
+    
+    response = client.post(f'/api/files/{test_project}/bulk', json={'paths': 'main.tex'})
+    assert response.status_code == 400
+
+def test_get_file_paged(client, test_project):
+    """Test reading a line range of a text file with the total line count"""
+    file_path = os.path.join(app.UPLOAD_FOLDER, test_project, 'data.csv')
+    lines = [f'row {i}\n' for i in range(250)]
+    with open(file_path, 'w') as f:
+        f.writelines(lines)
+    
+    pages = []
+    offset = 0
+    while True:
+        response = client.get(f'/api/file/{test_project}/data.csv?offset={offset}&limit=100')
+        assert response.status_code == 200
+        data = json.loads(response.data)
+        # The trailing newline leaves an empty last line, as in the editor
+        assert data['total_lines'] == 251
+        pages.append(data['content'])
+        offset = data['next_offset']
+        if offset >= data['total_lines']:
+            break
+    
+    assert pages[0].splitlines()[0] == 'row 0'
+    assert pages[1].splitlines()[0] == 'row 100'
+    assert ''.join(pages) == ''.join(lines)
+    
+    response = client.get(f'/api/file/{test_project}/data.csv?offset=abc')
+    assert response.status_code == 400
+
+def test_upload_zip_nested(client):
+    """Test that nested ZIP files are extracted in place and removed"""
+    from io import BytesIO
+    inner = BytesIO()
+    with zipfile.ZipFile(inner, 'w') as z:
+        z.writestr('figures/plot.tex', '% plot')
+    middle = BytesIO()
+    with zipfile.ZipFile(middle, 'w') as z:
+        z.writestr('chapters/ch1.tex', '\\chapter{One}')
+        z.writestr('chapters/figs.zip', inner.getvalue())
+    outer = BytesIO()
+    with zipfile.ZipFile(outer, 'w') as z:
+        z.writestr('main.tex', '\\documentclass{book}')
+        z.writestr('bundle.zip', middle.getvalue())
+        z.writestr('../evil.tex', 'outside')
+    outer.seek(0)
+    
+    response = client.post('/api/upload',
+                          data={'file': (outer, 'nested.zip'), 'upload_id': 'abc123'},
+                          content_type='multipart/form-data')
+    assert response.status_code == 200
+    project_path = os.path.join(app.UPLOAD_FOLDER, 'nested')
+    assert os.path.exists(os.path.join(project_path, 'main.tex'))
+    assert os.path.exists(os.path.join(project_path, 'chapters', 'ch1.tex'))
+    assert os.path.exists(os.path.join(project_path, 'chapters', 'figures', 'plot.tex'))
+    assert not os.path.exists(os.path.join(project_path, 'bundle.zip'))
+    assert not os.path.exists(os.path.join(project_path, 'chapters', 'figs.zip'))
+    assert not os.path.exists(os.path.join(app.UPLOAD_FOLDER, 'evil.tex'))
+    
+    # Progress for the finished import stays queryable
+    response = client.get('/api/upload/progress/abc123')
+    assert json.loads(response.data)['state'] == 'done'
+    
+    # Staging directories are not listed as projects
+    response = client.get('/api/projects')
+    assert [p['name'] for p in json.loads(response.data)['projects']] == ['nested']
+
+def test_upload_zip_limits(client, test_project):
+    """Test that archives over the entry limit are rejected without touching the project"""
+    from io import BytesIO
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as z:
+        for i in range(5):
+            z.writestr(f'file{i}.tex', 'x')
+    buffer.seek(0)
+    
+    app.app.config['ZIP_MAX_ENTRIES'] = 3
+    try:
+        response = client.post('/api/upload',
+                              data={'file': (buffer, f'{test_project}.zip')},
+                              content_type='multipart/form-data')
+    finally:
+        app.app.config['ZIP_MAX_ENTRIES'] = app.ZIP_MAX_ENTRIES
+    assert response.status_code == 400
+    assert 'too many entries' in json.loads(response.data)['error']
+    assert os.path.exists(os.path.join(app.UPLOAD_FOLDER, test_project, 'main.tex'))
+
+def test_download_project_streaming_cache(client, test_project):
+    """Test that downloads store compressed formats and are cached by content"""
+    project_path = os.path.join(app.UPLOAD_FOLDER, test_project)
+    with open(os.path.join(project_path, 'figure.png'), 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n' + os.urandom(2048))
+    with open(os.path.join(project_path, 'main.aux'), 'w') as f:
+        f.write('\\relax')
+    
+    response = client.get(f'/api/download/{test_project}')
+    assert response.status_code == 200
+    first = response.data
+    with zipfile.ZipFile(io.BytesIO(first)) as z:
+        assert z.testzip() is None
+        assert z.getinfo('figure.png').compress_type == zipfile.ZIP_STORED
+        assert z.getinfo('main.tex').compress_type == zipfile.ZIP_DEFLATED
+        assert 'main.aux' in z.namelist()
+    
+    # The second download of an unchanged project comes from the archive cache
+    cache_dir = os.path.join(app.UPLOAD_FOLDER, '.cache', 'archives', test_project)
+    assert len(os.listdir(cache_dir)) == 1
+    response = client.get(f'/api/download/{test_project}')
+    assert response.data == first
+    
+    # Build artifacts can be left out
+    response = client.get(f'/api/download/{test_project}?exclude_artifacts=1')
+    with zipfile.ZipFile(io.BytesIO(response.data)) as z:
+        assert 'main.aux' not in z.namelist()
+        assert 'main.tex' in z.namelist()
+
+def test_open_directory_incremental(client):
+    """Test that re-opening a directory only syncs what changed"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        source = os.path.join(tmpdir, 'paper')
+        os.makedirs(os.path.join(source, 'figures'))
+        with open(os.path.join(source, 'main.tex'), 'w') as f:
+            f.write('\\documentclass{article}')
+        with open(os.path.join(source, 'notes.tex'), 'w') as f:
+            f.write('notes')
+        with open(os.path.join(source, 'figures', 'logo.png'), 'wb') as f:
+            f.write(b'\x89PNG\r\n\x1a\nlogo')
+        with open(os.path.join(source, 'main.pdf'), 'wb') as f:
+            f.write(b'%PDF-1.5 old build')
+        
+        response = client.post('/api/open_directory', json={'path': source})
+        assert response.status_code == 200
+        stats = json.loads(response.data)['sync']
+        assert stats['copied'] + stats['cloned'] + stats['linked'] == 4
+        
+        project_path = os.path.join(app.UPLOAD_FOLDER, 'paper')
+        # PDFs are never hardlinked, so a compile cannot rewrite the source's copy
+        assert not os.path.samefile(os.path.join(source, 'main.pdf'), os.path.join(project_path, 'main.pdf'))
+        with open(os.path.join(project_path, 'main.aux'), 'w') as f:
+            f.write('\\relax')
+        os.makedirs(os.path.join(project_path, '.tikz-cache'))
+        with open(os.path.join(project_path, '.tikz-cache', 'main-figure0.pdf'), 'w') as f:
+            f.write('%PDF-1.4 figure')
+        
+        # Change one file, delete another
+        with open(os.path.join(source, 'main.tex'), 'w') as f:
+            f.write('\\documentclass{report}')
+        os.remove(os.path.join(source, 'notes.tex'))
+        
+        response = client.post('/api/open_directory', json={'path': source})
+        stats = json.loads(response.data)['sync']
+        assert stats['unchanged'] == 2
+        assert stats['removed'] == 1
+        assert stats['copied'] + stats['cloned'] + stats['linked'] == 1
+        with open(os.path.join(project_path, 'main.tex')) as f:
+            assert 'report' in f.read()
+        assert not os.path.exists(os.path.join(project_path, 'notes.tex'))
+        # Build artifacts and externalized figures survive a resync
+        assert os.path.exists(os.path.join(project_path, 'main.aux'))
+        assert os.path.exists(os.path.join(project_path, '.tikz-cache', 'main-figure0.pdf'))
+        
+        response = client.post('/api/open_directory', json={'path': source, 'mode': 'bogus'})
+        assert response.status_code == 400
+
+def test_open_directory_symlinked_dirs(client, tmp_path):
+    """Test that symlinked directories are imported and symlink loops are not followed"""
+    shared = tmp_path / 'shared-figures'
+    shared.mkdir()
+    (shared / 'logo.png').write_bytes(b'\x89PNG\r\n\x1a\nlogo')
+    source = tmp_path / 'linked'
+    source.mkdir()
+    (source / 'main.tex').write_text('\\documentclass{article}')
+    (source / 'figures').symlink_to(shared, target_is_directory=True)
+    (shared / 'loop').symlink_to(source, target_is_directory=True)
+    
+    response = client.post('/api/open_directory', json={'path': str(source)})
+    assert response.status_code == 200
+    project_path = os.path.join(app.UPLOAD_FOLDER, 'linked')
+    assert os.path.isfile(os.path.join(project_path, 'figures', 'logo.png'))
+    assert not os.path.islink(os.path.join(project_path, 'figures'))
+    # figures/loop leads back to the source root and is cut off there
+    assert not os.path.exists(os.path.join(project_path, 'figures', 'loop'))
+
+def test_built_assets_served_precompressed(client, tmp_path, monkeypatch):
+    """Test that bundles from build_assets.py are used and served with immutable caching"""
+    import build_assets
+    vendor_dir = tmp_path / 'vendor'
+    for url, rel_path in build_assets.VENDOR_ASSETS:
+        target = vendor_dir / rel_path
+        target.parent.mkdir(parents=True, exist_ok=True)
+        target.write_text(f'/* {rel_path} */')
+    dist_dir = tmp_path / 'dist'
+    manifest = build_assets.build_bundles(str(vendor_dir), str(dist_dir))
+    monkeypatch.setattr(app, 'ASSET_DIST_FOLDER', str(dist_dir))
+    
+    # The page references the hashed bundles instead of the CDN
+    page = client.get('/').data.decode()
+    assert f'/assets/{manifest["app.js"]}' in page
+    assert f'/assets/{manifest["pdf.worker.js"]}' in page
+    assert 'cdnjs' not in page
+    
+    response = client.get(f'/assets/{manifest["app.js"]}', headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'immutable' in response.headers['Cache-Control']
+    import gzip
+    assert b'codemirror.min.js' in gzip.decompress(response.data)
+    
+    # Codings refused with q=0, or only named as part of another token, are not used
+    response = client.get(f'/assets/{manifest["app.js"]}', headers={'Accept-Encoding': 'br;q=0, gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    for header in ('gzip;q=0, br;q=0', 'x-gzipped, brx'):
+        response = client.get(f'/assets/{manifest["app.js"]}', headers={'Accept-Encoding': header})
+        assert 'Content-Encoding' not in response.headers
+    
+    response = client.get(f'/assets/{manifest["app.css"]}')
+    assert 'Content-Encoding' not in response.headers
+    assert b'monokai' in response.data
+    
+    assert client.get('/assets/manifest.json').status_code == 404
+
+def test_json_response_compression(client, test_project):
+    """Test that JSON and NDJSON responses are gzip-compressed when accepted"""
+    import gzip
+    project_path = os.path.join(app.UPLOAD_FOLDER, test_project)
+    for i in range(100):
+        with open(os.path.join(project_path, f'chapter{i:03d}.tex'), 'w') as f:
+            f.write('\\chapter{Chapter}\n' * 50)
+    
+    response = client.get(f'/api/files/{test_project}', headers={'Accept-Encoding': 'gzip, deflate'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    data = json.loads(gzip.decompress(response.data))
+    assert len(data['files']) == 102
+    
+    # Streamed NDJSON is compressed incrementally
+    response = client.post(f'/api/files/{test_project}/bulk',
+                          json={'paths': ['chapter000.tex', 'chapter001.tex']},
+                          headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    lines = gzip.decompress(response.data).decode().splitlines()
+    assert len(lines) == 2
+    
+    # Small responses and clients without gzip get plain JSON
+    response = client.get(f'/api/file/{test_project}/main.tex', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+    response = client.get(f'/api/files/{test_project}')
+    assert 'Content-Encoding' not in response.headers
+
+def test_get_file_streamed(client, test_project, monkeypatch):
+    """Test that large text files are streamed into the JSON response"""
+    monkeypatch.setattr(app, 'STREAM_JSON_MIN_BYTES', 16)
+    content = 'Line with "quotes" and \\commands\n' * 1000
+    with open(os.path.join(app.UPLOAD_FOLDER, test_project, 'big.tex'), 'w') as f:
+        f.write(content)
+    
+    response = client.get(f'/api/file/{test_project}/big.tex')
+    assert response.status_code == 200
+    assert response.is_streamed
+    data = json.loads(response.data)
+    assert data['content'] == content
+    assert data['path'] == 'big.tex'
+    
+    with open(os.path.join(app.UPLOAD_FOLDER, test_project, 'binary.dat'), 'wb') as f:
+        f.write(b'\xff\xfe' * 100)
+    response = client.get(f'/api/file/{test_project}/binary.dat')
+    assert response.status_code == 400
+
+def test_serve_options():
+    """Test that serve arguments map onto production server settings"""
+    args = app.parse_serve_args(['--bind', '0.0.0.0:8000', '--workers', '3', '--threads', '2',
+                                 '--max-requests', '500'])
+    options = app.gunicorn_options(args)
+    assert options['bind'] == '0.0.0.0:8000'
+    assert options['workers'] == 3
+    assert options['threads'] == 2
+    assert options['worker_class'] == 'gthread'
+    assert options['max_requests'] == 500
+    assert options['preload_app'] == False
+
+def test_serve_worker_app_is_fresh():
+    """Test that gunicorn workers get a fresh import of the app, not the master's module state"""
+    script = (
+        "import runpy, sys\n"
+        "sys.argv = ['app.py']\n"
+        "master = runpy.run_path('app.py', run_name='texhandler_master')\n"
+        "worker_app = master['load_worker_app']({'COMPILE_WORKERS': ['http://127.0.0.1:7001']})\n"
+        "import app\n"
+        "assert worker_app is app.app and worker_app is not master['app']\n"
+        "assert app.io_executor is not master['io_executor']\n"
+        "assert app.admission_controller is not master['admission_controller']\n"
+        "assert worker_app.config['COMPILE_WORKERS'] == ['http://127.0.0.1:7001']\n"
+    )
+    result = subprocess.run([sys.executable, '-c', script], cwd=os.path.dirname(os.path.abspath(app.__file__)),
+                            capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+
+def test_project_lock_serializes(client, test_project):
+    """Test that the per-project lock excludes concurrent holders"""
+    import threading
+    import time
+    events = []
+    
+    def hold(name):
+        with app.project_lock(test_project):
+            events.append(('enter', name))
+            time.sleep(0.05)
+            events.append(('exit', name))
+    
+    threads = [threading.Thread(target=hold, args=(i,)) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    # Every enter is immediately followed by the matching exit
+    for i in range(0, len(events), 2):
+        assert events[i][0] == 'enter'
+        assert events[i + 1] == ('exit', events[i][1])
+
+FAKE_PDFLATEX = """#!/usr/bin/env python3
+import gzip, os, sys
+args = sys.argv[1:]
+out_dir = args[args.index('-output-directory') + 1]
+job = args[args.index('-jobname') + 1]
+for ext, data in (('.pdf', b'%PDF-1.4 fake'), ('.aux', b'\\relax'), ('.log', b'fake log')):
+    with open(os.path.join(out_dir, job + ext), 'wb') as f:
+        f.write(data)
+with gzip.open(os.path.join(out_dir, job + '.synctex.gz'), 'wt') as f:
+    f.write('SyncTeX Version:1\\nInput:1:' + os.path.join(os.getcwd(), '.', args[-1]) + '\\n')
+print('Typesetting ' + args[-1])
+print('Output written on ' + job + '.pdf')
+"""
+
+@pytest.fixture
+def fake_pdflatex(monkeypatch, tmp_path):
+    """Put a pdflatex stand-in on PATH that writes a PDF, aux, log and synctex file"""
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    script = bin_dir / 'pdflatex'
+    script.write_text(FAKE_PDFLATEX)
+    script.chmod(0o755)
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ.get('PATH', ''))
+
+@pytest.fixture
+def compile_workers(client, tmp_path):
+    """Run two compile workers in threads and point the remote backend at them"""
+    import threading
+    from werkzeug.serving import make_server
+    import compile_worker
+    
+    servers = []
+    for i in range(2):
+        worker_app = compile_worker.create_worker_app(str(tmp_path / f'store{i}'), jobs=1)
+        server = make_server('127.0.0.1', 0, worker_app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    
+    original = (app.app.config['COMPILE_BACKEND'], app.app.config['COMPILE_WORKERS'])
+    app.app.config['COMPILE_BACKEND'] = 'remote'
+    app.app.config['COMPILE_WORKERS'] = [f'http://127.0.0.1:{server.server_port}' for server in servers]
+    yield servers
+    app.app.config['COMPILE_BACKEND'], app.app.config['COMPILE_WORKERS'] = original
+    for server in servers:
+        server.shutdown()
+
+def test_remote_compile(client, test_project, fake_pdflatex, compile_workers):
+    """Test compiling on a compile worker, sending only changed files the second time"""
+    import gzip
+    response = client.get(f'/api/compile/{test_project}?file=main.tex')
+    assert response.status_code == 200
+    data = json.loads(response.data)
+    assert data['success'] == True
+    assert data['pdf_path'] == 'main.pdf'
+    assert data['synctex_path'] == 'main.synctex.gz'
+    assert data['worker']['uploaded_blobs'] == data['worker']['files']
+    
+    project_path = os.path.join(app.UPLOAD_FOLDER, test_project)
+    with open(os.path.join(project_path, 'main.pdf'), 'rb') as f:
+        assert f.read() == b'%PDF-1.4 fake'
+    # SyncTeX points at the project, not at the worker's workspace
+    with gzip.open(os.path.join(project_path, 'main.synctex.gz'), 'rt') as f:
+        assert f'Input:1:{os.path.join(project_path, "")}./main.tex' in f.read()
+    
+    with open(os.path.join(project_path, 'main.tex'), 'a') as f:
+        f.write('% edit\n')
+    first_worker = data['worker']['url']
+    response = client.get(f'/api/compile/{test_project}?file=main.tex')
+    data = json.loads(response.data)
+    assert data['success'] == True
+    # Idle workers are ordered deterministically, so the same worker gets it
+    assert data['worker']['url'] == first_worker
+    assert data['worker']['uploaded_blobs'] == 1
+
+def test_remote_compile_skips_dead_worker(client, test_project, fake_pdflatex, compile_workers):
+    """Test that a build is retried on the next worker when one is down"""
+    live_url = app.app.config['COMPILE_WORKERS'][1]
+    app.app.config['COMPILE_WORKERS'] = ['http://127.0.0.1:9', live_url]
+    response = client.get(f'/api/compile/{test_project}?file=main.tex')
+    assert response.status_code == 200
+    data = json.loads(response.data)
+    assert data['success'] == True
+    assert data['worker']['url'] == live_url
+
+def test_snapshot_compile(client, test_project, fake_pdflatex, tmp_path):
+    """Test building in a snapshot directory and publishing the outputs back"""
+    import gzip
+    project_path = os.path.join(app.UPLOAD_FOLDER, test_project)
+    with open(os.path.join(project_path, 'figure.png'), 'wb') as f:
+        f.write(b'\x89PNG fake')
+    app.app.config['COMPILE_BACKEND'] = 'snapshot'
+    app.app.config['SNAPSHOT_BUILD_ROOT'] = str(tmp_path / 'shm')
+    try:
+        response = client.get(f'/api/compile/{test_project}?file=main.tex')
+        assert response.status_code == 200
+        data = json.loads(response.data)
+        assert data['success'] == True
+        assert data['pdf_path'] == 'main.pdf'
+        assert data['synctex_path'] == 'main.synctex.gz'
+        
+        build_dir = app.snapshot_build_dir(project_path)
+        assert os.path.isfile(os.path.join(build_dir, 'sections', 'intro.tex'))
+        assert os.path.islink(os.path.join(build_dir, 'figure.png'))
+        # Outputs were published into the project, SyncTeX pointing at the project
+        for name in ('main.pdf', 'main.aux', 'main.log'):
+            assert os.path.isfile(os.path.join(project_path, name))
+        with gzip.open(os.path.join(project_path, 'main.synctex.gz'), 'rt') as f:
+            assert f'Input:1:{os.path.join(os.path.abspath(project_path), "")}./main.tex' in f.read()
+        
+        # Deleted sources leave the snapshot; build outputs stay for reuse
+        os.remove(os.path.join(project_path, 'sections', 'intro.tex'))
+        response = client.get(f'/api/compile/{test_project}?file=main.tex')
+        assert response.status_code == 200
+        assert not os.path.exists(os.path.join(build_dir, 'sections', 'intro.tex'))
+        assert os.path.isfile(os.path.join(build_dir, 'main.aux'))
+    finally:
+        app.app.config['COMPILE_BACKEND'] = app.COMPILE_BACKEND
+        app.app.config['SNAPSHOT_BUILD_ROOT'] = app.SNAPSHOT_BUILD_ROOT
+
+def test_metrics_endpoint(client, test_project, fake_pdflatex):
+    """Test the Prometheus metrics, including snapshots written by other processes"""
+    response = client.get(f'/api/compile/{test_project}?file=main.tex')
+    assert response.status_code == 200
+    client.get(f'/api/files/{test_project}')
+    
+    # Another live worker process's snapshot is added to this process's values,
+    # however long that process has been idle
+    metrics_dir = os.path.join(app.UPLOAD_FOLDER, '.cache', 'metrics')
+    os.makedirs(metrics_dir, exist_ok=True)
+    live_snapshot = os.path.join(metrics_dir, f'{os.getppid()}.json')
+    with open(live_snapshot, 'w') as f:
+        json.dump({'texhandler_compiles_total': {'kind': 'counter', 'series': [[['local', 'timeout'], 7]]}}, f)
+    os.utime(live_snapshot, (0, 0))
+    # A snapshot of an exited process is folded into the retired totals, except for gauges
+    exited = subprocess.Popen([sys.executable, '-c', 'pass'])
+    exited.wait()
+    dead_snapshot = os.path.join(metrics_dir, f'{exited.pid}.json')
+    with open(dead_snapshot, 'w') as f:
+        json.dump({
+            'texhandler_compiles_total': {'kind': 'counter', 'series': [[['elsewhere', 'failure'], 3]]},
+            'texhandler_compiles_in_flight': {'kind': 'gauge', 'series': [[[], 2]]},
+        }, f)
+    
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    text = response.data.decode('utf-8')
+    assert '# TYPE texhandler_compile_pass_seconds histogram' in text
+    assert 'texhandler_compile_pass_seconds_count{tool="pdflatex",step="first"}' in text
+    assert 'texhandler_compile_pass_seconds_bucket{tool="pdflatex",step="first",le="+Inf"}' in text
+    assert 'texhandler_compiles_total{backend="local",outcome="success"}' in text
+    assert 'texhandler_compiles_total{backend="local",outcome="timeout"} 7' in text
+    assert 'texhandler_compiles_total{backend="elsewhere",outcome="failure"} 3' in text
+    assert not os.path.exists(dead_snapshot)
+    assert 'texhandler_compiles_in_flight 0' in text
+    # Retired counters keep counting on later scrapes
+    text = client.get('/metrics').data.decode('utf-8')
+    assert 'texhandler_compiles_total{backend="elsewhere",outcome="failure"} 3' in text
+    assert 'texhandler_http_requests_total{endpoint="/api/files/<project_name>",method="GET",status="200"}' in text
+    assert f'texhandler_project_disk_bytes{{project="{test_project}"}}' in text
+    assert 'texhandler_project_lock_wait_seconds_count{operation="compile_latex"}' in text
+
+def test_tracing_and_profiling(client, test_project, tmp_path):
+    """Test Server-Timing spans, the JSON trace log and admin-only profiling"""
+    trace_log = tmp_path / 'trace.jsonl'
+    app.app.config['TRACE_LOG'] = str(trace_log)
+    app.app.config['ADMIN_TOKEN'] = 'secret'
+    try:
+        response = client.get(f'/api/files/{test_project}')
+        assert response.status_code == 200
+        timing = response.headers['Server-Timing']
+        assert 'fs_walk;dur=' in timing
+        assert 'json_encode;dur=' in timing
+        assert 'total;dur=' in timing
+        record = json.loads(trace_log.read_text().splitlines()[-1])
+        assert record['path'] == f'/api/files/{test_project}'
+        assert 'fs_walk' in [span['name'] for span in record['spans']]
+        
+        # Profiling needs the admin token
+        response = client.get(f'/api/files/{test_project}', headers={'X-Profile': 'cprofile'})
+        assert 'X-Profile-Id' not in response.headers
+        assert client.get('/api/admin/profiles').status_code == 403
+        
+        admin = {'X-Admin-Token': 'secret'}
+        for mode in ('cprofile', 'sample'):
+            response = client.get(f'/api/files/{test_project}', headers={'X-Profile': mode, **admin})
+            profile_id = response.headers['X-Profile-Id']
+            response = client.get(f'/api/admin/profiles/{profile_id}', headers=admin)
+            assert response.status_code == 200
+            assert response.mimetype == 'text/plain'
+        data = json.loads(client.get('/api/admin/profiles', headers=admin).data)
+        assert sorted(p['type'] for p in data['profiles']) == ['cprofile', 'sample']
+    finally:
+        app.app.config['TRACE_LOG'] = app.TRACE_LOG
+        app.app.config['ADMIN_TOKEN'] = app.ADMIN_TOKEN
+
+def test_benchmark_generator_and_baseline(tmp_path):
+    """Test the synthetic project generator and the baseline comparison of benchmark.py"""
+    import benchmark
+    files = benchmark.generate_project(str(tmp_path / 'bench'), files=6, depth=2, pages=3,
+                                       figures=2, labels=4, bib_entries=10)
+    assert 'main.tex' in files and 'references.bib' in files
+    assert 'level0/level1/section5.tex' in files
+    with open(tmp_path / 'bench' / 'main.tex') as f:
+        main = f.read()
+    assert '\\input{level0/section1}' in main
+    assert '\\ref{sec:3}' in main
+    with open(tmp_path / 'bench' / 'figures' / 'figure0.png', 'rb') as f:
+        assert f.read(8) == b'\x89PNG\r\n\x1a\n'
+    
+    baseline = {'results': {'list_files': {'median_ms': 10.0}, 'get_file': {'median_ms': 0.5}}}
+    results = {'list_files': {'median_ms': 13.0}, 'get_file': {'median_ms': 0.9}}
+    # get_file is 80% slower but by less than a millisecond, which is noise
+    assert [r[0] for r in benchmark.compare_results(results, baseline, 0.2)] == ['list_files']
+    assert benchmark.compare_results(results, baseline, 0.5) == []
+
+def test_benchmark_run(client):
+    """Test that repeated benchmark calls each get through admission control"""
+    import benchmark
+    only = {'get_file', 'save_file', 'download_project', 'download_project_cached'}
+    results = benchmark.run_benchmarks({'files': 6, 'depth': 1, 'pages': 2, 'figures': 0, 'bib_entries': 5},
+                                       repeats=6, warmup=1, only=only)
+    assert set(results) == only
+    assert not app.admission_controller.active.get('download')
+
+def test_soak_stage_summary():
+    """Test the per-endpoint stage summary and SLO check of soak.py"""
+    import soak
+    samples = [('autosave', 0.010, True)] * 95 + [('autosave', 0.500, True)] * 5 + [('compile', 2.0, False)]
+    summary = soak.summarize(samples, duration=10)
+    assert summary['autosave']['requests'] == 100
+    assert summary['autosave']['throughput_rps'] == 10.0
+    assert summary['autosave']['p50_ms'] == 10.0
+    assert summary['autosave']['p99_ms'] == 500.0
+    assert summary['compile']['error_rate'] == 1.0
+    
+    violations = soak.slo_violations(summary, {'autosave': 300, 'compile': 30000}, 0.01)
+    assert violations == ['autosave p95 500 ms > 300 ms', 'compile error rate 100.0% > 1.0%']
+
+def test_blob_store_deduplicates(client):
+    """Test that identical files across projects share storage and stay copy-on-write"""
+    app.app.config['BLOB_STORE_ENABLED'] = True
+    try:
+        figure = os.urandom(64 * 1024)
+        for name in ('fork1', 'fork2'):
+            archive = io.BytesIO()
+            with zipfile.ZipFile(archive, 'w') as zf:
+                zf.writestr('main.tex', '\\documentclass{article}')
+                zf.writestr('figures/logo.png', figure)
+            response = client.post('/api/upload', data={'file': (io.BytesIO(archive.getvalue()), f'{name}.zip')},
+                                   content_type='multipart/form-data')
+            assert response.status_code == 200
+        dedup = json.loads(response.data)['dedup']
+        assert dedup == {'stored': 0, 'linked': 1, 'saved_bytes': len(figure)}
+        
+        logo1 = os.path.join(app.UPLOAD_FOLDER, 'fork1', 'figures', 'logo.png')
+        logo2 = os.path.join(app.UPLOAD_FOLDER, 'fork2', 'figures', 'logo.png')
+        assert os.path.samefile(logo1, logo2)
+        # Shared files stay writable for tools that rewrite them
+        assert os.stat(logo1).st_mode & 0o200
+        # Small files are not interned
+        assert os.stat(os.path.join(app.UPLOAD_FOLDER, 'fork1', 'main.tex')).st_nlink == 1
+        
+        data = json.loads(client.get('/api/projects').data)
+        sizes = {p['name']: p for p in data['projects']}
+        assert sizes['fork1']['disk_size'] < sizes['fork1']['size']
+        assert data['storage']['physical_size'] < data['storage']['logical_size']
+        
+        # Writing through the API replaces the link instead of changing the shared blob
+        response = client.put('/api/file/fork1/figures/logo.png', json={'content': 'changed'})
+        assert response.status_code == 200
+        assert not os.path.samefile(logo1, logo2)
+        with open(logo2, 'rb') as f:
+            assert f.read() == figure
+        
+        # Deleting the last user makes the blob garbage
+        client.delete('/api/projects/fork2')
+        app.collect_blob_garbage()  # Also scheduled in the background by the delete
+        assert not any(files for _, _, files in os.walk(os.path.join(app.UPLOAD_FOLDER, '.blobs')))
+    finally:
+        app.app.config['BLOB_STORE_ENABLED'] = app.BLOB_STORE_ENABLED
+
+def test_janitor_evicts_least_recently_used(client):
+    """Test that the janitor evicts build outputs of idle projects, oldest first"""
+    import time
+    now = time.time()
+    for age, name in ((3 * 86400, 'oldest'), (2 * 86400, 'busy'), (86400, 'older'), (0, 'recent')):
+        project_path = os.path.join(app.UPLOAD_FOLDER, name)
+        os.makedirs(project_path)
+        for file, size in (('main.tex', 100), ('main.pdf', 4000), ('main.aux', 1000), ('main.log', 1000)):
+            with open(os.path.join(project_path, file), 'wb') as f:
+                f.write(b'x' * size)
+        os.utime(project_path, (now - age, now - age))
+    
+    app.app.config.update(ADMIN_TOKEN='secret', ARTIFACT_DISK_BUDGET=12000, JANITOR_FILES_PER_SECOND=0)
+    admin = {'X-Admin-Token': 'secret'}
+    try:
+        assert client.post('/api/admin/janitor/run').status_code == 403
+        with app.project_lock('busy'):
+            response = client.post('/api/admin/janitor/run', headers=admin)
+        assert response.status_code == 200
+        report = json.loads(response.data)
+        assert report['artifact_bytes_before'] == 24000
+        # 'busy' is building, so eviction moves on to the next project
+        assert report['skipped_busy'] == ['busy']
+        assert [p['project'] for p in report['evicted_projects']] == ['oldest', 'older']
+        assert report['reclaimed_bytes'] == 12000
+        
+        for name in ('oldest', 'older'):
+            assert os.listdir(os.path.join(app.UPLOAD_FOLDER, name)) == ['main.tex']
+        assert len(os.listdir(os.path.join(app.UPLOAD_FOLDER, 'recent'))) == 4
+        
+        status = json.loads(client.get('/api/admin/janitor', headers=admin).data)
+        assert status['total_reclaimed_bytes'] == 12000
+        assert status['runs'] == 1
+    finally:
+        app.app.config.update(ADMIN_TOKEN=app.ADMIN_TOKEN, ARTIFACT_DISK_BUDGET=app.ARTIFACT_DISK_BUDGET,
+                              JANITOR_FILES_PER_SECOND=app.JANITOR_FILES_PER_SECOND)
+
+def make_pdf(page_texts, font_name):
+    """A small PDF in pdfTeX's layout: pages and fonts in an object stream, Flate content streams"""
+    import zlib
+    count = len(page_texts)
+    # 1 catalog, 2 pages, 3 font, 4.. page objects, then content streams, then the object stream
+    members = {1: b'<< /Type /Catalog /Pages 2 0 R >>',
+               2: b'<< /Type /Pages /Kids [' + b' '.join(b'%d 0 R' % (4 + i) for i in range(count))
+                  + b'] /Count %d /MediaBox [0 0 612 792] >>' % count,
+               3: b'<< /Type /Font /Subtype /Type1 /BaseFont /' + font_name.encode() + b' /FirstChar 32 >>'}
+    for i in range(count):
+        members[4 + i] = b'<< /Type /Page /Parent 2 0 R /Contents %d 0 R /Resources << /Font << /F1 3 0 R >> >> >>' % (
+            4 + count + i)
+    header, body = [], b''
+    for num, data in members.items():
+        header.append(b'%d %d' % (num, len(body)))
+        body += data + b'\n'
+    header = b' '.join(header) + b'\n'
+    
+    out = b'%PDF-1.5\n'
+    for i, text in enumerate(page_texts):
+        content = zlib.compress(b'BT /F1 12 Tf 72 720 Td (' + text.encode() + b') Tj ET')
+        out += b'%d 0 obj\n<< /Length %d /Filter /FlateDecode >>\nstream\n' % (4 + count + i, len(content))
+        out += content + b'\nendstream\nendobj\n'
+    objstm = zlib.compress(header + body)
+    out += b'%d 0 obj\n<< /Type /ObjStm /N %d /First %d /Length %d /Filter /FlateDecode >>\nstream\n' % (
+        4 + 2 * count, len(members), len(header), len(objstm))
+    return out + objstm + b'\nendstream\nendobj\n%%EOF\n'
+
+FAKE_PDFTOPPM = """#!/usr/bin/env python3
+import os, sys
+args = sys.argv[1:]
+first, last = int(args[args.index('-f') + 1]), int(args[args.index('-l') + 1])
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pdftoppm.log'), 'a') as log:
+    for page in range(first, last + 1):
+        with open('%s-%02d.png' % (args[-1], page), 'wb') as f:
+            f.write(b'\\x89PNG fake')
+        log.write('%d\\n' % page)
+"""
+
+def test_page_previews_reuse_unchanged_pages(client, test_project, tmp_path, monkeypatch):
+    """Test that page images are keyed by page content and only changed pages are rendered again"""
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    script = bin_dir / 'pdftoppm'
+    script.write_text(FAKE_PDFTOPPM)
+    script.chmod(0o755)
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ.get('PATH', ''))
+    rendered_pages = lambda: (bin_dir / 'pdftoppm.log').read_text().split()
+    pdf_file = os.path.join(app.UPLOAD_FOLDER, test_project, 'main.pdf')
+    
+    with open(pdf_file, 'wb') as f:
+        f.write(make_pdf(['One', 'Two', 'Three'], 'ABCDEF+CMR10'))
+    assert app.render_page_previews(test_project, 'main.pdf') == 6
+    response = client.get(f'/api/pages/{test_project}/main.pdf')
+    data = json.loads(response.data)
+    assert data['available'] is True and data['pending'] is False
+    assert [(p['page'], p['width'], p['height']) for p in data['pages']] == [(1, 612, 792), (2, 612, 792), (3, 612, 792)]
+    first = data['pages']
+    image = client.get(first[0]['thumb'])
+    assert image.status_code == 200
+    assert image.mimetype == 'image/png'
+    assert 'immutable' in image.headers['Cache-Control']
+    
+    # Page 2 changes; the new font subset tag must not invalidate pages 1 and 3
+    with open(pdf_file, 'wb') as f:
+        f.write(make_pdf(['One', 'Two, revised', 'Three'], 'GHIJKL+CMR10'))
+    assert app.render_page_previews(test_project, 'main.pdf') == 2
+    assert sorted(rendered_pages()) == ['1', '1', '2', '2', '2', '2', '3', '3']
+    second = json.loads(client.get(f'/api/pages/{test_project}/main.pdf').data)['pages']
+    assert [p['fingerprint'] == q['fingerprint'] for p, q in zip(first, second)] == [True, False, True]
+    assert client.get(first[1]['preview']).status_code == 404  # Images of the old page 2 were dropped
+    assert client.get(second[1]['preview']).status_code == 200
+    
+    assert client.get(f'/api/page_image/{test_project}/..%2Fmanifest.json').status_code in (400, 404)
+    assert client.get(f'/api/pages/{test_project}/missing.pdf').status_code == 404
+    app.app.config['PAGE_PREVIEWS_ENABLED'] = False
+    try:
+        data = json.loads(client.get(f'/api/pages/{test_project}/main.pdf').data)
+        assert data['available'] is False and len(data['pages']) == 3
+    finally:
+        app.app.config['PAGE_PREVIEWS_ENABLED'] = app.PAGE_PREVIEWS_ENABLED
+
+FAKE_PDFTOTEXT = """#!/usr/bin/env python3
+import os, sys
+args = sys.argv[1:]
+first, last = int(args[args.index('-f') + 1]), int(args[args.index('-l') + 1])
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pdftotext.log'), 'a') as log:
+    log.write('%d-%d\\n' % (first, last))
+print('<doc>')
+for page in range(first, last + 1):
+    print('<page width="612.000000" height="792.000000"><flow><block>')
+    print('<line><word xMin="72.0" yMin="700.0" xMax="100.0" yMax="712.0">Page</word>'
+          '<word xMin="104.0" yMin="700.0" xMax="112.0" yMax="712.0">%d</word></line>' % page)
+    print('<line><word xMin="72.0" yMin="720.0" xMax="152.0" yMax="732.0">Tom&amp;Jerry</word></line>')
+    print('</block></flow></page>')
+print('</doc>')
+"""
+
+def test_pdf_text_search(client, test_project, tmp_path, monkeypatch):
+    """Test that page text is indexed once per page fingerprint and searched with match boxes"""
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    script = bin_dir / 'pdftotext'
+    script.write_text(FAKE_PDFTOTEXT)
+    script.chmod(0o755)
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ.get('PATH', ''))
+    pdf_file = os.path.join(app.UPLOAD_FOLDER, test_project, 'main.pdf')
+    search = lambda query, **params: json.loads(client.get(
+        f'/api/pdf_search/{test_project}/main.pdf', query_string=dict(q=query, **params)).data)
+    
+    with open(pdf_file, 'wb') as f:
+        f.write(make_pdf(['One', 'Two', 'Three'], 'ABCDEF+CMR10'))
+    assert app.index_page_text(test_project, 'main.pdf') == 3
+    
+    data = search('jerry')
+    assert data['available'] is True and data['pending'] is False
+    assert [r['page'] for r in data['results']] == [1, 2, 3]
+    # 'Tom&Jerry' is 9 characters over 80pt, so 'Jerry' starts 4 characters in
+    assert data['results'][0]['text'] == 'Jerry'
+    assert data['results'][0]['rects'] == [[107.56, 720.0, 152.0, 732.0]]
+    assert search('jerry', case='1')['results'] == []
+    
+    # A match across two words is one box on their line
+    data = search(r'page \d', regex='1')
+    assert [r['text'] for r in data['results']] == ['Page 1', 'Page 2', 'Page 3']
+    assert data['results'][1]['rects'] == [[72.0, 700.0, 112.0, 712.0]]
+    assert client.get(f'/api/pdf_search/{test_project}/main.pdf?q=(&regex=1').status_code == 400
+    assert client.get(f'/api/pdf_search/{test_project}/main.pdf').status_code == 400
+    
+    # Only the changed page is extracted again
+    with open(pdf_file, 'wb') as f:
+        f.write(make_pdf(['One', 'Two, revised', 'Three'], 'ABCDEF+CMR10'))
+    assert app.index_page_text(test_project, 'main.pdf') == 1
+    assert (bin_dir / 'pdftotext.log').read_text().split() == ['1-3', '2-2']
+    assert len(search('Tom')['results']) == 3
+    
+    # Regexes that run too long are stopped; literal queries are unaffected
+    monkeypatch.setattr(app, 'PDF_SEARCH_REGEX_TIMEOUT', 0.001)
+    response = client.get(f'/api/pdf_search/{test_project}/main.pdf', query_string={'q': '(a+)+$', 'regex': '1'})
+    assert response.status_code == 400
+    assert len(search('jerry')['results']) == 3
+    # Each query scans a bounded amount of page text
+    monkeypatch.setattr(app, 'PDF_SEARCH_MAX_TEXT', 40)
+    data = search('jerry')
+    assert data['truncated'] is True and len(data['results']) == 2
+
+def test_focus_compile(client, test_project, fake_pdflatex):
+    """Test that a focus compile typesets only the \\include containing the open file"""
+    project_path = os.path.join(app.UPLOAD_FOLDER, test_project)
+    os.makedirs(os.path.join(project_path, 'chapters'))
+    files = {
+        'main.tex': '\\documentclass{book}\n\\begin{document}\n\\input{front}\n\\include{chapters/two}\n\\end{document}',
+        'front.tex': '% \\include{chapters/old}\n\\include{chapters/one}',
+        'chapters/one.tex': '\\chapter{One}\n\\input{chapters/one-table}',
+        'chapters/one-table.tex': 'A table',
+        'chapters/two.tex': '\\chapter{Two}',
+    }
+    for name, content in files.items():
+        with open(os.path.join(project_path, name), 'w') as f:
+            f.write(content)
+    assert app.find_focus_include(os.path.join(project_path, 'main.tex'), 'chapters/one-table.tex') == (
+        'chapters/one', ['chapters/one', 'chapters/two'])
+    compile_focus = lambda focus: json.loads(client.get(f'/api/compile/{test_project}?file=main.tex&focus={focus}').data)
+    
+    # Without the chapters' .aux files from a full build, everything is built
+    data = compile_focus('chapters/one-table.tex')
+    assert data['success'] and data['focus'] is None
+    assert 'no .aux yet for main, chapters/two' in data['log']
+    assert 'Typesetting main.tex' in data['log']
+    
+    for name in ('chapters/one.aux', 'chapters/two.aux'):
+        with open(os.path.join(project_path, name), 'w') as f:
+            f.write('\\relax')
+    data = compile_focus('chapters/one-table.tex')
+    assert data['success'] and data['focus'] == 'chapters/one'
+    assert 'Typesetting \\includeonly{chapters/one}\\input{main.tex}' in data['log']
+    assert data['pdf_path'] == 'main.pdf'
+    
+    # Files outside any chapter build the whole document
+    data = compile_focus('main.tex')
+    assert data['focus'] is None and 'Typesetting main.tex' in data['log']
+    assert client.get(f'/api/compile/{test_project}?file=main.tex&focus=../x.tex').status_code == 400
+
+# Like FAKE_PDFLATEX, but the .aux lists the \cite keys of main.tex
+FAKE_CITING_PDFLATEX = FAKE_PDFLATEX.replace("('.aux', b'\\relax')", "('.aux', aux)").replace(
+    "for ext, data in",
+    "import re\n"
+    "with open(os.path.join(out_dir, 'main.tex')) as f:\n"
+    "    keys = re.findall(r'\\\\cite\\{([^}]*)\\}', f.read())\n"
+    "aux = ''.join('\\\\citation{%s}\\n' % key for key in keys).encode() + b'\\\\bibdata{refs}'\n"
+    "for ext, data in")
+
+def test_draft_compile(client, test_project, tmp_path, fake_pdflatex):
+    """Test that a draft compile makes one pass into its own PDF, reusing the full build's .bbl"""
+    import time
+    (tmp_path / 'bin' / 'pdflatex').write_text(FAKE_CITING_PDFLATEX)
+    project_path = os.path.join(app.UPLOAD_FOLDER, test_project)
+    with open(os.path.join(project_path, 'main.tex'), 'w') as f:
+        f.write('\\documentclass{article}\n\\begin{document}\nHello \\cite{knuth}\n\\bibliography{refs}\n\\end{document}')
+    with open(os.path.join(project_path, 'refs.bib'), 'w') as f:
+        f.write('@book{knuth, title={The TeXbook}}')
+    past = time.time() - 100
+    os.utime(os.path.join(project_path, 'refs.bib'), (past, past))
+    
+    data = json.loads(client.get(f'/api/compile/{test_project}?file=main.tex').data)
+    assert data['success'] and data['profile'] == 'full' and data['pdf_path'] == 'main.pdf'
+    with open(os.path.join(project_path, 'main.bbl'), 'w') as f:
+        f.write('\\begin{thebibliography}{1}\\end{thebibliography}')
+    full_pdf = os.stat(os.path.join(project_path, 'main.pdf'))
+    
+    data = json.loads(client.get(f'/api/compile/{test_project}?file=main.tex&profile=draft').data)
+    assert data['success'] and data['profile'] == 'draft'
+    assert data['pdf_path'] == 'main-draft.pdf'
+    assert data['synctex_path'] == 'main-draft.synctex.gz'
+    assert data['bibliography_reused'] is True
+    assert 'Typesetting \\PassOptionsToPackage{draft}{graphicx}\\input{main.tex}' in data['log']
+    assert 'Second pdflatex pass' not in data['log'] and 'BibTeX' not in data['log']
+    assert os.path.isfile(os.path.join(project_path, 'main-draft.bbl'))
+    assert os.stat(os.path.join(project_path, 'main.pdf')).st_mtime_ns == full_pdf.st_mtime_ns
+    assert app.is_output_pdf('main-draft.pdf', ['main.tex', 'main-draft.pdf'])
+    
+    # A citation added since the full build makes the draft run the bibliography
+    with open(os.path.join(project_path, 'main.tex'), 'w') as f:
+        f.write('\\documentclass{article}\n\\begin{document}\nHello \\cite{knuth} \\cite{lamport}\n'
+                '\\bibliography{refs}\n\\end{document}')
+    data = json.loads(client.get(f'/api/compile/{test_project}?file=main.tex&profile=draft').data)
+    assert data['bibliography_reused'] is False
+    assert 'Second pdflatex pass' in data['log']
+    
+    # After a full build the draft cites the same keys again; an edited .bib
+    # makes it run the bibliography and a second pass
+    client.get(f'/api/compile/{test_project}?file=main.tex')
+    with open(os.path.join(project_path, 'main.bbl'), 'w') as f:
+        f.write('\\begin{thebibliography}{1}\\end{thebibliography}')
+    data = json.loads(client.get(f'/api/compile/{test_project}?file=main.tex&profile=draft').data)
+    assert data['bibliography_reused'] is True
+    os.utime(os.path.join(project_path, 'refs.bib'), (time.time() + 10, time.time() + 10))
+    data = json.loads(client.get(f'/api/compile/{test_project}?file=main.tex&profile=draft').data)
+    assert data['bibliography_reused'] is False
+    assert 'Second pdflatex pass' in data['log']
+    assert client.get(f'/api/compile/{test_project}?file=main.tex&profile=final').status_code == 400
+
+FAKE_TIKZ_PDFLATEX = """#!/usr/bin/env python3
+import hashlib, os, sys
+args = sys.argv[1:]
+out_dir = args[args.index('-output-directory') + 1]
+job = args[args.index('-jobname') + 1]
+if job.startswith('.tikz-cache/'):
+    # A figure job: count the builds next to the figures
+    with open(os.path.join(out_dir, job + '.pdf'), 'w') as f:
+        f.write('figure ' + args[-1])
+    with open(os.path.join(out_dir, 'builds.txt'), 'a') as f:
+        f.write(job + '\\n')
+    sys.exit(0)
+# The document pass lists the picture and rewrites its .md5 when the code changed
+with open(os.path.join(out_dir, 'picture.txt')) as f:
+    md5 = '\\\\def\\\\tikzexternallastkey{%s}%%' % hashlib.md5(f.read().encode()).hexdigest()
+with open(os.path.join(out_dir, job + '.figlist'), 'w') as f:
+    f.write('.tikz-cache/' + job + '-figure0\\n')
+md5_file = os.path.join(out_dir, '.tikz-cache', job + '-figure0.md5')
+if not os.path.exists(md5_file) or open(md5_file).read() != md5:
+    with open(md5_file, 'w') as f:
+        f.write(md5)
+with open(os.path.join(out_dir, job + '.pdf'), 'w') as f:
+    f.write('%PDF-1.4 fake')
+print('Typesetting ' + args[-1])
+"""
+
+def test_figure_cache(client, test_project, monkeypatch, tmp_path):
+    """Test that TikZ figures are built once per picture code and EPS conversions are reused"""
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    for name, script in (('pdflatex', FAKE_TIKZ_PDFLATEX),
+                         ('epstopdf', '#!/bin/sh\necho converted > "${1#--outfile=}"\necho x >> "$(dirname "$2")/conversions.txt"\n')):
+        (bin_dir / name).write_text(script)
+        (bin_dir / name).chmod(0o755)
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ.get('PATH', ''))
+    project_path = os.path.join(app.UPLOAD_FOLDER, test_project)
+    with open(os.path.join(project_path, 'main.tex'), 'w') as f:
+        f.write('\\documentclass{article}\n\\usepackage{tikz}\n\\input{macros}\n\\begin{document}\n'
+                '\\begin{tikzpicture}\\draw (0,0) -- (1,1);\\end{tikzpicture}\n\\end{document}')
+    with open(os.path.join(project_path, 'macros.tex'), 'w') as f:
+        f.write('\\tikzset{every picture/.style={thin}}')
+    with open(os.path.join(project_path, 'picture.txt'), 'w') as f:
+        f.write('\\draw (0,0) -- (1,1);')
+    with open(os.path.join(project_path, 'plot.eps'), 'w') as f:
+        f.write('%!PS-Adobe-3.0 EPSF-3.0')
+    
+    def compile_project():
+        data = json.loads(client.get(f'/api/compile/{test_project}?file=main.tex').data)
+        assert data['success'], data
+        return data
+    
+    def builds():
+        with open(os.path.join(project_path, 'builds.txt')) as f:
+            return f.read().split()
+    
+    data = compile_project()
+    assert '\\tikzexternalize[mode=list and make,prefix=.tikz-cache/]' in data['log']
+    assert data['figures'] == {'externalized': 1, 'cached': 0, 'built': 1, 'failed': []}
+    assert data['graphics'] == {'cached': 0, 'converted': 1, 'failed': []}
+    assert builds() == ['.tikz-cache/main-figure0']
+    assert os.path.isfile(os.path.join(project_path, 'plot-eps-converted-to.pdf'))
+    # Externalized figures are neither listed nor downloaded with the sources
+    tree = json.loads(client.get(f'/api/files/{test_project}').data)['files']
+    assert '.tikz-cache' not in [item['name'] for item in tree]
+    with zipfile.ZipFile(io.BytesIO(client.get(f'/api/download/{test_project}').data)) as z:
+        assert not [name for name in z.namelist() if name.startswith('.tikz-cache')]
+    assert app.is_build_artifact('plot-eps-converted-to.pdf')
+    
+    # Nothing changed: the figure and the conversion are up to date
+    data = compile_project()
+    assert data['figures'] == {'externalized': 1, 'cached': 0, 'built': 0, 'failed': []}
+    assert data['graphics']['converted'] == 0
+    
+    # New picture code is built; going back to the old code comes from the cache
+    with open(os.path.join(project_path, 'picture.txt'), 'w') as f:
+        f.write('\\draw (0,0) circle (1);')
+    assert compile_project()['figures']['built'] == 1
+    with open(os.path.join(project_path, 'picture.txt'), 'w') as f:
+        f.write('\\draw (0,0) -- (1,1);')
+    data = compile_project()
+    assert data['figures'] == {'externalized': 1, 'cached': 1, 'built': 0, 'failed': []}
+    assert len(builds()) == 2
+    
+    # A deleted conversion comes back from the cache without running epstopdf
+    os.remove(os.path.join(project_path, 'plot-eps-converted-to.pdf'))
+    assert compile_project()['graphics'] == {'cached': 1, 'converted': 0, 'failed': []}
+    with open(os.path.join(project_path, 'conversions.txt')) as f:
+        assert len(f.read().split()) == 1
+    
+    # An edited preamble, also in a file it \\inputs, rebuilds the unchanged picture
+    with open(os.path.join(project_path, 'macros.tex'), 'w') as f:
+        f.write('\\tikzset{every picture/.style={very thick}}')
+    assert compile_project()['figures'] == {'externalized': 1, 'cached': 0, 'built': 1, 'failed': []}
+    with open(os.path.join(project_path, 'main.tex')) as f:
+        content = f.read()
+    with open(os.path.join(project_path, 'main.tex'), 'w') as f:
+        f.write(content.replace('\\usepackage{tikz}', '\\usepackage{tikz}\n\\usepackage{xcolor}'))
+    assert compile_project()['figures']['built'] == 1
+    with open(os.path.join(project_path, 'main.tex'), 'w') as f:
+        f.write(content)
+    assert compile_project()['figures'] == {'externalized': 1, 'cached': 1, 'built': 0, 'failed': []}
+    assert len(builds()) == 4
+    
+    # Drafts typeset pictures inline instead of leaving them out
+    data = json.loads(client.get(f'/api/compile/{test_project}?file=main.tex&profile=draft').data)
+    assert data['success'] and data['figures'] is None
+    assert 'tikzexternalize' not in data['log']
+
+FAKE_BIB_PDFLATEX = """#!/usr/bin/env python3
+import os, re, sys
+args = sys.argv[1:]
+out_dir = args[args.index('-output-directory') + 1]
+job = args[args.index('-jobname') + 1]
+with open(os.path.join(out_dir, 'main.tex')) as f:
+    keys = re.findall(r'\\\\cite\\{([^}]*)\\}', f.read())
+with open(os.path.join(out_dir, job + '.aux'), 'w') as f:
+    f.write(''.join('\\\\citation{%s}\\n' % key for key in keys) + '\\\\bibstyle{plain}\\n\\\\bibdata{refs}\\n')
+with open(os.path.join(out_dir, job + '.pdf'), 'w') as f:
+    f.write('%PDF-1.4 fake')
+print('Typesetting ' + args[-1])
+"""
+
+def test_bibliography_cache(client, test_project, monkeypatch, tmp_path):
+    """Test that bibtex is skipped and the .bbl restored while citations and .bib files are unchanged"""
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    for name, script in (('pdflatex', FAKE_BIB_PDFLATEX),
+                         ('bibtex', '#!/bin/sh\ngrep citation "$1.aux" > "$1.bbl"\necho run >> bibtex-runs.txt\n')):
+        (bin_dir / name).write_text(script)
+        (bin_dir / name).chmod(0o755)
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ.get('PATH', ''))
+    project_path = os.path.join(app.UPLOAD_FOLDER, test_project)
+    
+    def compile_project(text, bib='@book{knuth, title={The TeXbook}}'):
+        with open(os.path.join(project_path, 'main.tex'), 'w') as f:
+            f.write('\\documentclass{article}\n\\begin{document}\n' + text + '\n\\bibliography{refs}\n\\end{document}')
+        with open(os.path.join(project_path, 'refs.bib'), 'w') as f:
+            f.write(bib)
+        data = json.loads(client.get(f'/api/compile/{test_project}?file=main.tex').data)
+        assert data['success'], data
+        return data['bibliography_cache']
+    
+    def bbl():
+        with open(os.path.join(project_path, 'main.bbl')) as f:
+            return f.read()
+    
+    assert compile_project('\\cite{knuth}') == {'tool': 'bibtex', 'hit': False}
+    assert compile_project('Edited text \\cite{knuth}') == {'tool': 'bibtex', 'hit': True}
+    assert compile_project('\\cite{knuth} \\cite{lamport}') == {'tool': 'bibtex', 'hit': False}
+    assert 'lamport' in bbl()
+    # Back to the first citations: that .bbl comes from the cache
+    assert compile_project('\\cite{knuth}') == {'tool': 'bibtex', 'hit': True}
+    assert 'lamport' not in bbl()
+    # A changed .bib file runs bibtex again
+    assert compile_project('\\cite{knuth}', bib='@book{knuth, title={TAOCP}}')['hit'] is False
+    with open(os.path.join(project_path, 'bibtex-runs.txt')) as f:
+        assert len(f.read().split()) == 3
+
+def test_cite_search(client, test_project):
+    """Test citation search by key prefix and author/title words, reparsing only edited entries"""
+    import time
+    project_path = os.path.join(app.UPLOAD_FOLDER, test_project)
+    bib_file = os.path.join(project_path, 'refs.bib')
+    entries = [
+        '@string{tug = "TeX Users Group"}\n',
+        '@comment{ignored}\n',
+        '@book{knuth1984,\n  author = {Donald E. Knuth},\n  title = {The {\\TeX}book},\n  year = 1984,\n}\n',
+        '@article{lamport1978,\n  title = "Time, Clocks, and the Ordering of Events",\n  author = {Leslie Lamport},\n  year = {1978}\n}\n',
+        '@inproceedings{knuth1977,\n  author = {Knuth, Donald and Morris, James},\n  title = {Fast Pattern Matching in Strings},\n  date = {1977-06}\n}\n',
+    ]
+    with open(bib_file, 'w') as f:
+        f.write(''.join(entries))
+    
+    def search(query):
+        response = client.get(f'/api/cite_search/{test_project}?q={query}')
+        assert response.status_code == 200
+        return [result['key'] for result in json.loads(response.data)['results']]
+    
+    assert search('knuth19') == ['knuth1984', 'knuth1977']
+    assert search('morris') == ['knuth1977']
+    assert search('clocks') == ['lamport1978']
+    assert search('knuth 1977') == ['knuth1977']
+    assert search('tug') == []
+    data = json.loads(client.get(f'/api/cite_search/{test_project}?q=lamport').data)
+    assert data['results'] == [{'key': 'lamport1978', 'type': 'article', 'author': 'Leslie Lamport',
+                                'title': 'Time, Clocks, and the Ordering of Events', 'year': '1978', 'file': 'refs.bib'}]
+    assert search('texbook') == ['knuth1984']
+    
+    # Editing one entry reparses only that entry
+    entries[3] = entries[3].replace('{1978}', '{1979}')
+    with open(bib_file, 'w') as f:
+        f.write(''.join(entries))
+    os.utime(bib_file, (time.time() + 10, time.time() + 10))
+    assert search('lamport') == ['lamport1978']
+    assert app.bib_index_cache[os.path.abspath(bib_file)][1].reparsed == 1
+    assert client.get(f'/api/cite_search/{test_project}?q=a&limit=x').status_code == 400
+    assert client.get('/api/cite_search/missing?q=a').status_code == 404
+
+def test_index_snapshots(client, test_project):
+    """Test that indexes written to snapshots are loaded after a restart while their files are unchanged"""
+    import time
+    project_path = os.path.join(app.UPLOAD_FOLDER, test_project)
+    main_tex = os.path.join(project_path, 'main.tex')
+    bib_file = os.path.join(project_path, 'refs.bib')
+    with open(bib_file, 'w') as f:
+        f.write('@book{knuth1984,\n  author = {Donald Knuth},\n  title = {The TeXbook},\n  year = 1984\n}\n@string{x = "y"}\n')
+    
+    offsets = app.get_line_index(main_tex, os.stat(main_tex))
+    digest = app.cached_file_digest(main_tex, os.stat(main_tex))
+    assert client.get(f'/api/cite_search/{test_project}?q=knuth').status_code == 200
+    app.flush_index_snapshots(force=True)
+    with open(os.path.join(app.UPLOAD_FOLDER, '.cache', 'indexes', test_project, 'bib.idx'), 'rb') as f:
+        assert f.read(4) == app.INDEX_SNAPSHOT_MAGIC
+    
+    # A restarted process loads them instead of reading and parsing the files
+    for cache in (app.line_index_cache, app.digest_cache, app.bib_index_cache, app.index_snapshots):
+        cache.clear()
+    app.activity_touched.clear()
+    app.touch_project_activity(test_project)
+    assert app.prewarm_indexes() == [test_project]
+    assert app.line_index_cache[os.path.abspath(main_tex)][1] == offsets
+    assert app.digest_cache[os.path.abspath(main_tex)][1] == digest
+    index = app.bib_index_cache[os.path.abspath(bib_file)][1]
+    assert index.reparsed == 0 and [entry[0] for entry in index.entries] == ['knuth1984']
+    
+    # Entries of changed files are ignored
+    app.bib_index_cache.clear()
+    with open(bib_file, 'a') as f:
+        f.write('@misc{lamport,\n  author = {Leslie Lamport}\n}\n')
+    os.utime(bib_file, (time.time() + 10, time.time() + 10))
+    data = json.loads(client.get(f'/api/cite_search/{test_project}?q=lamport').data)
+    assert [result['key'] for result in data['results']] == ['lamport']
+    assert app.bib_index_cache[os.path.abspath(bib_file)][1].reparsed == 3
+
+def test_admission_control(client, test_project, monkeypatch):
+    """Test bounded queues with 503/429 and Retry-After, priority for saves and release on stream close"""
+    import threading
+    import time
+    controller = app.admission_controller
+    limits = dict(app.ADMISSION_CLASSES, compile=(1, 1, 2))
+    monkeypatch.setitem(app.app.config, 'ADMISSION_CLASSES', limits)
+    monkeypatch.setitem(app.app.config, 'ADMISSION_QUEUE_TIMEOUT', 5)
+    
+    # One compile runs and one waits: the next one is turned away at once
+    owners = [('client', 'other', 8)]
+    assert controller.acquire('compile', owners, limits, 5) is None
+    waiter = threading.Thread(target=controller.acquire, args=('compile', owners, limits, 5))
+    waiter.start()
+    while not controller.waiting:
+        time.sleep(0.01)
+    response = client.get(f'/api/compile/{test_project}?file=main.tex')
+    assert response.status_code == 503 and int(response.headers['Retry-After']) >= 1
+    controller.release('compile', owners, 0.1)
+    waiter.join()
+    controller.release('compile', owners, 0.1)
+    assert controller.active['compile'] == 0 and not controller.holders
+    
+    # A project over its share of a class gets a 429
+    project_owner = [('project', test_project, app.ADMISSION_PER_PROJECT)]
+    for _ in range(app.ADMISSION_PER_PROJECT):
+        assert controller.acquire('download', project_owner, limits, 5) is None
+    response = client.get(f'/api/download/{test_project}')
+    assert response.status_code == 429 and 'Retry-After' in response.headers
+    for _ in range(app.ADMISSION_PER_PROJECT):
+        controller.release('download', project_owner, 0.1)
+    
+    # The slot of a streamed download is held until the response is closed
+    with client.get(f'/api/download/{test_project}') as response:
+        assert response.status_code == 200
+        assert controller.active['download'] == 1
+    assert controller.active['download'] == 0
+    
+    # With one slot left for bulk work, a queued save goes before a queued compile
+    monkeypatch.setattr(app, 'ADMISSION_MAX_ACTIVE', 2)
+    monkeypatch.setattr(app, 'ADMISSION_RESERVED_SLOTS', 1)
+    limits['compile'] = (4, 4, 2)
+    assert controller.acquire('compile', owners, limits, 5) is None
+    assert controller.acquire('save', owners, limits, 5) is None  # The reserved slot
+    admitted = []
+    threads = [threading.Thread(target=lambda c=c: admitted.append((c, controller.acquire(c, owners, limits, 5))))
+               for c in ('compile', 'save')]
+    for thread in threads:
+        thread.start()
+        while len(controller.waiting) < threads.index(thread) + 1:
+            time.sleep(0.01)
+    controller.release('save', owners, 0.1)
+    while not admitted:
+        time.sleep(0.01)
+    assert admitted == [('save', None)]
+    controller.release('save', owners, 0.1)
+    controller.release('compile', owners, 0.1)
+    for thread in threads:
+        thread.join()
+    assert admitted == [('save', None), ('compile', None)]
+
 if __name__ == '__main__':
     pytest.main([__file__, '-v', '--tb=short'])
 